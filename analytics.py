@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+"""analytics.py
+
+Organizer reports, computed in batch: fill rate and fill-rate curve,
+registration velocity, topic and month popularity and session-type mix
+across all of an organizer's conferences.
+
+The job (/crons/organizer_reports) streams every Conference, Session and
+Registration through cursor-paged queries, chained over as many tasks as
+it takes. Each task reads pages for ANALYTICS_TASK_SECONDS, then pickles
+the aggregator, the phase and the cursor into AnalyticsCheckpoint pieces
+numbered by step and queues the next step, so a retried task resumes
+from its own checkpoint rather than from scratch. Each page is reduced
+at once:
+conferences become rows of columnar NumPy arrays, and sessions and
+registrations are folded into per-organizer counts, so memory grows with
+the number of conferences and organizers, not with the sessions and
+registrations behind them. The reports are then vectorized passes over
+those columns, mostly bincounts over organizer codes, and are stored as
+OrganizerReport snapshots that getOrganizerReport serves as they are.
+
+Sessions and registrations are read with projection queries, and none of
+the pages go through ndb's context cache, which would otherwise keep
+every entity read.
+
+"""
+
+import cPickle as pickle
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+from budget import RequestBudget
+
+from models import AnalyticsCheckpoint
+from models import Conference
+from models import OrganizerReport
+from models import Registration
+from models import ReportTerm
+from models import Session
+
+ANALYTICS_BATCH = 1000
+REPORT_PUT_BATCH = 200
+CURVE_DAYS = (90, 60, 30, 14, 7, 1, 0)  # days before the start
+VELOCITY_DAYS = (7, 30)
+TOP_TERMS = 10
+_HORIZON = max(CURVE_DAYS)
+_PAGE_OPTIONS = {'use_cache': False, 'use_memcache': False}
+# reading stops after this long, leaving the rest of the 10 minute task
+# deadline for writing the checkpoint
+ANALYTICS_TASK_SECONDS = 300
+# below the 1MB entity limit
+CHECKPOINT_PIECE_BYTES = 900 * 1024
+ANALYTICS_PHASES = ('conferences', 'sessions', 'registrations', 'reports')
+
+
+class _Column(object):
+    """Growable NumPy array, extended a page at a time."""
+
+    def __init__(self, dtype):
+        self.data = np.zeros(ANALYTICS_BATCH, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        end = self.size + len(values)
+        if end > len(self.data):
+            grown = np.zeros(max(end, 2 * len(self.data)), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:end] = values
+        self.size = end
+
+    def values(self):
+        return self.data[:self.size]
+
+
+class _Codes(object):
+    """Dense integer codes for strings, in order of first appearance."""
+
+    def __init__(self):
+        self.codes = {}
+        self.names = []
+
+    def code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def __len__(self):
+        return len(self.names)
+
+
+def _grouped(groups, codes, counts, registrations):
+    """Return {group: top TOP_TERMS (code, count, registrations)} from
+    parallel arrays, most registrations first."""
+    order = np.lexsort((-counts, -registrations, groups))
+    result = {}
+    for i in order.tolist():
+        top = result.setdefault(int(groups[i]), [])
+        if len(top) < TOP_TERMS:
+            top.append((int(codes[i]), int(counts[i]), int(registrations[i])))
+    return result
+
+
+class _Aggregator(object):
+    """Columns of every conference, plus per-organizer session and
+    registration counts. Pages must arrive conferences first, then
+    sessions, then registrations."""
+
+    def __init__(self, now):
+        self.now = now
+        self.today = now.date().toordinal()
+        self.rows = {}                  # conference key -> row
+        self.organizers = _Codes()
+        self.topics = _Codes()
+        self.types = _Codes()
+        # one entry per conference row
+        self.org = _Column(np.int32)
+        self.capacity = _Column(np.int32)
+        self.registered = _Column(np.int32)
+        self.month = _Column(np.int32)
+        self.start = _Column(np.int32)  # date ordinal, 0 when unknown
+        # one entry per (conference, topic)
+        self.topicRow = _Column(np.int32)
+        self.topicCode = _Column(np.int32)
+        # per organizer
+        self.typeCounts = {}            # (organizer, type) -> sessions
+        self.curve = None
+        self.velocity = None
+
+    def addConferences(self, confs):
+        base = self.org.size
+        for i, conf in enumerate(confs):
+            self.rows[conf.key] = base + i
+        self.org.extend([self.organizers.code(conf.organizerUserId)
+                         for conf in confs])
+        self.capacity.extend([conf.maxAttendees or 0 for conf in confs])
+        # seatsAvailable is kept exact by registration
+        self.registered.extend([max(0, (conf.maxAttendees or 0) -
+                                       (conf.seatsAvailable or 0))
+                                for conf in confs])
+        self.month.extend([conf.month or 0 for conf in confs])
+        self.start.extend([conf.startDate.toordinal() if conf.startDate else 0
+                           for conf in confs])
+        pairs = [(base + i, self.topics.code(topic))
+                 for i, conf in enumerate(confs) for topic in set(conf.topics)]
+        self.topicRow.extend([row for row, topic in pairs])
+        self.topicCode.extend([topic for row, topic in pairs])
+
+    def _rowsOf(self, c_keys):
+        # rows of the conferences; -1 for those no longer in the catalog
+        return np.array([self.rows.get(c_key, -1) for c_key in c_keys],
+                        dtype=np.int64)
+
+    def addSessions(self, sessions):
+        # OrganizerReport.sessions and sessionTypes count typed sessions
+        sessions = [sess for sess in sessions if sess.typeOfSession]
+        rows = self._rowsOf([sess.key.parent() for sess in sessions])
+        known = rows >= 0
+        org = self.org.data[rows[known]]
+        types = np.array([self.types.code(sess.typeOfSession)
+                          for sess in sessions], dtype=np.int64)[known]
+        pairs = org.astype(np.int64) * (len(self.types) + 1) + types
+        found, inverse = np.unique(pairs, return_inverse=True)
+        for pair, n in zip(found.tolist(), np.bincount(inverse).tolist()):
+            key = divmod(pair, len(self.types) + 1)
+            self.typeCounts[key] = self.typeCounts.get(key, 0) + n
+
+    def _allocate(self):
+        # the organizers are all known once the conferences are in
+        if self.curve is None:
+            n = len(self.organizers)
+            self.curve = np.zeros(n * (_HORIZON + 1), dtype=np.int64)
+            self.velocity = np.zeros((len(VELOCITY_DAYS), n), dtype=np.int64)
+
+    def addRegistrations(self, regs):
+        self._allocate()
+        n = len(self.organizers)
+        rows = self._rowsOf([reg.conference for reg in regs])
+        known = rows >= 0
+        rows = rows[known]
+        org = self.org.data[rows]
+        created = np.array([reg.created.toordinal() for reg in regs],
+                           dtype=np.int64)[known]
+
+        # registrations by days before the start; the last bucket holds
+        # _HORIZON days or more, the first those made after the start
+        start = self.start.data[rows]
+        dated = start > 0
+        before = np.clip(start[dated] - created[dated], 0, _HORIZON)
+        self.curve += np.bincount(org[dated] * (_HORIZON + 1) + before,
+                                  minlength=len(self.curve))
+        for i, days in enumerate(VELOCITY_DAYS):
+            recent = created > self.today - days
+            self.velocity[i] += np.bincount(org[recent], minlength=n)
+
+    def reports(self):
+        """Yield an OrganizerReport for every organizer."""
+        n = len(self.organizers)
+        org = self.org.values()
+        capacity = self.capacity.values().astype(np.float64)
+        registered = self.registered.values().astype(np.float64)
+        month = self.month.values()
+        start = self.start.values()
+
+        conferences = np.bincount(org, minlength=n)
+        seats = np.bincount(org, weights=capacity, minlength=n)
+        taken = np.bincount(org, weights=registered, minlength=n)
+        fillRate = taken / np.maximum(seats, 1)
+
+        # share of the seats of dated conferences taken at least d days out
+        dated = start > 0
+        datedSeats = np.bincount(org[dated], weights=capacity[dated], minlength=n)
+        self._allocate()
+        early = self.curve.reshape(n, _HORIZON + 1)[:, ::-1].cumsum(axis=1)[:, ::-1]
+        fillCurve = early[:, list(CURVE_DAYS)] / np.maximum(datedSeats, 1)[:, None]
+
+        byMonth = np.bincount(org * 13 + np.clip(month, 0, 12),
+                              weights=registered, minlength=n * 13)
+        byMonth = byMonth.reshape(n, 13)[:, 1:]
+
+        topicRow = self.topicRow.values()
+        pairs = org[topicRow].astype(np.int64) * len(self.topics) + \
+            self.topicCode.values()
+        found, inverse = np.unique(pairs, return_inverse=True)
+        topics = _grouped(found // max(len(self.topics), 1),
+                          found % max(len(self.topics), 1),
+                          np.bincount(inverse),
+                          np.bincount(inverse, weights=registered[topicRow]))
+
+        typeKeys = sorted(self.typeCounts)
+        typeCounts = np.array([self.typeCounts[key] for key in typeKeys],
+                              dtype=np.int64)
+        types = _grouped(np.array([o for o, t in typeKeys], dtype=np.int64),
+                         np.array([t for o, t in typeKeys], dtype=np.int64),
+                         typeCounts, np.zeros(len(typeKeys), dtype=np.int64))
+        sessions = np.bincount(np.array([o for o, t in typeKeys], dtype=np.int64),
+                               weights=typeCounts, minlength=n)
+
+        for i, organizerUserId in enumerate(self.organizers.names):
+            if not organizerUserId:
+                continue
+            yield OrganizerReport(id=organizerUserId,
+                conferences=int(conferences[i]),
+                sessions=int(sessions[i]),
+                registrations=int(taken[i]),
+                maxAttendees=int(seats[i]),
+                fillRate=float(fillRate[i]),
+                fillCurve=[float(share) for share in fillCurve[i]],
+                velocity=[int(count) for count in self.velocity[:, i]],
+                months=[int(count) for count in byMonth[i]],
+                topics=[ReportTerm(term=self.topics.names[code], count=count,
+                                   registrations=regs)
+                        for code, count, regs in topics.get(i, [])],
+                sessionTypes=[ReportTerm(term=self.types.names[code], count=count)
+                              for code, count, regs in types.get(i, [])],
+                updated=self.now)
+
+
+def _phaseQuery(phase):
+    if phase == 'conferences':
+        return Conference.query(), _Aggregator.addConferences
+    if phase == 'sessions':
+        return Session.query(projection=[Session.typeOfSession]), \
+            _Aggregator.addSessions
+    return Registration.query(
+        projection=[Registration.conference, Registration.created]), \
+        _Aggregator.addRegistrations
+
+
+def _checkpointKeys(run, step, pieces):
+    return [ndb.Key(AnalyticsCheckpoint, '%s-%d-%d' % (run, step, i))
+            for i in range(pieces)]
+
+
+def _saveCheckpoint(run, step, state):
+    data = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+    pieces = max(1, -(-len(data) // CHECKPOINT_PIECE_BYTES))
+    for i, c_key in enumerate(_checkpointKeys(run, step, pieces)):
+        AnalyticsCheckpoint(key=c_key, pieces=pieces,
+            data=data[i * CHECKPOINT_PIECE_BYTES:(i + 1) * CHECKPOINT_PIECE_BYTES]
+        ).put(use_cache=False, use_memcache=False)
+
+
+def _checkpointPieces(run, step):
+    first = _checkpointKeys(run, step, 1)[0].get(use_cache=False,
+                                                 use_memcache=False)
+    if first is None:
+        return None
+    return [first] + ndb.get_multi(_checkpointKeys(run, step, first.pieces)[1:],
+                                   use_cache=False, use_memcache=False)
+
+
+def _loadCheckpoint(run, step):
+    pieces = _checkpointPieces(run, step)
+    if pieces is None or None in pieces:
+        return None
+    return pickle.loads(zlib.decompress(''.join(piece.data for piece in pieces)))
+
+
+def _deleteCheckpoint(run, step):
+    pieces = _checkpointPieces(run, step)
+    if pieces:
+        ndb.delete_multi([piece.key for piece in pieces if piece])
+
+
+def newReportRun():
+    """Return the id of a new organizer report run, to start at step 0."""
+    return datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+
+def computeOrganizerReports(run, step=0):
+    """Run one step of an organizer report run; return the step to
+    continue with, or None when the reports are stored. Used by the
+    organizer_reports task."""
+    if step == 0:
+        state = (ANALYTICS_PHASES[0], None, _Aggregator(datetime.utcnow()))
+    else:
+        state = _loadCheckpoint(run, step)
+        if state is None:
+            # a retry of a step whose successor has already taken over
+            return None
+        _deleteCheckpoint(run, step - 1)
+    phase, cursor, agg = state
+
+    if phase != 'reports':
+        budget = RequestBudget(seconds=ANALYTICS_TASK_SECONDS)
+        while not budget.expired():
+            q, add = _phaseQuery(phase)
+            page, next_cursor, more = q.fetch_page(ANALYTICS_BATCH,
+                start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+                **_PAGE_OPTIONS)
+            add(agg, page)
+            if more and next_cursor:
+                cursor = next_cursor.urlsafe()
+                continue
+            phase = ANALYTICS_PHASES[ANALYTICS_PHASES.index(phase) + 1]
+            cursor = None
+            if phase == 'reports':
+                # writing the reports gets a task of its own
+                break
+        _saveCheckpoint(run, step + 1, (phase, cursor, agg))
+        return step + 1
+
+    batch = []
+    for report in agg.reports():
+        batch.append(report)
+        if len(batch) == REPORT_PUT_BATCH:
+            ndb.put_multi(batch, use_cache=False)
+            batch = []
+    ndb.put_multi(batch, use_cache=False)
+    _deleteCheckpoint(run, step)
+    return None
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""archive.py
+
+Archival of conferences that have ended. A daily cron job moves each such
+Conference and its Sessions into the ArchivedConference/ArchivedSession
+kinds, which keep the same ids but index almost nothing, so the Conference
+indexes that every live query uses only hold upcoming events.
+
+Archived conferences are only read on request (includeArchived), by
+filtering candidates in memory rather than through composite indexes.
+A request reads at most ARCHIVE_SCAN_LIMIT candidates, in key order, and
+hands back a cursor for the rest, so it costs the same however many
+years of conferences the archive holds.
+
+"""
+
+import operator
+from datetime import date
+
+from google.appengine.ext import ndb
+
+from models import ArchivedConference
+from models import ArchivedSession
+from models import Conference
+from models import Session
+
+from searchcache import bumpGenerations
+from suggest import recordTerms
+from sync import tombstones
+
+ARCHIVE_BATCH = 20
+ARCHIVE_QUERY_BATCH = 500
+ARCHIVE_SCAN_LIMIT = 1000  # candidates read per request
+# conferences without an endDate sort before every date; never archive them
+EARLIEST_DATE = date(1900, 1, 1)
+
+_OPERATORS = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+
+def archiveKey(c_key):
+    return ndb.Key(ArchivedConference, c_key.id())
+
+
+@ndb.transactional(xg=True)
+def archiveConference(c_key):
+    """Move one Conference and its Sessions into the archive kinds."""
+    conf = c_key.get()
+    if conf is None:
+        return
+    a_key = archiveKey(c_key)
+    sessions = Session.query(ancestor=c_key).fetch()
+
+    toPut = [ArchivedConference(key=a_key,
+        **conf.to_dict(exclude=['geohashes', 'formerKey', 'modified']))]
+    toPut += [ArchivedSession(key=ndb.Key(ArchivedSession, sess.key.id(),
+        parent=a_key), **sess.to_dict(exclude=['modified']))
+        for sess in sessions]
+    deleted = [c_key] + [sess.key for sess in sessions]
+    # synced clients drop archived conferences like deleted ones
+    ndb.put_multi(toPut + tombstones(deleted))
+    ndb.delete_multi(deleted)
+    bumpGenerations()
+    recordTerms('topics', removed=conf.topics)
+    recordTerms('city', removed=[conf.city])
+    recordTerms('speaker', removed=[sess.speaker for sess in sessions])
+
+
+def archiveEnded(cursor=None):
+    """Archive one batch of ended conferences; return the cursor for the
+    next batch, or None when done. Used by the archive_conferences task.
+    """
+    c_keys, next_cursor, more = Conference.query(
+        Conference.endDate >= EARLIEST_DATE,
+        Conference.endDate < date.today()).fetch_page(
+        ARCHIVE_BATCH, start_cursor=cursor, keys_only=True)
+    for c_key in c_keys:
+        # conferences still under their organizer's Profile wait until
+        # /tasks/migrate_conference_keys has given them root keys
+        if c_key.parent() is None:
+            archiveConference(c_key)
+    return next_cursor if more else None
+
+
+def getArchivedConference(websafeConferenceKey):
+    """Return the ArchivedConference for a Conference (or ArchivedConference)
+    websafe key, or None."""
+    c_key = ndb.Key(urlsafe=websafeConferenceKey)
+    if c_key.kind() == 'ArchivedConference':
+        return c_key.get()
+    if c_key.kind() != 'Conference' or c_key.parent() is not None:
+        return None
+    return archiveKey(c_key).get()
+
+
+def conferenceKey(conf):
+    """Return the Conference key of a Conference or ArchivedConference;
+    archived conferences are shown under the key they had when live."""
+    return ndb.Key(Conference, conf.key.id())
+
+
+def getArchivedSessions(conf):
+    """Return the ArchivedSessions of an ArchivedConference."""
+    return ArchivedSession.query(ancestor=conf.key).fetch()
+
+
+def _matches(conf, filtr):
+    test = _OPERATORS[filtr['operator']]
+    value = getattr(conf, filtr['field'])
+    # like the datastore, a repeated property matches if any value does
+    if isinstance(value, list):
+        return any(test(v, filtr['value']) for v in value)
+    return test(value, filtr['value'])
+
+
+def sortKey(filters, inequalityField=None):
+    """Return a sort key that orders conferences as a Conference query with
+    filters does: on the inequality field, if any, then on name."""
+    if inequalityField is None:
+        return lambda conf: conf.name
+    tests = [filtr for filtr in filters if filtr['field'] == inequalityField]
+
+    def value(conf):
+        value = getattr(conf, inequalityField)
+        # the datastore sorts a repeated property on its smallest value
+        # that passes the filters
+        if isinstance(value, list):
+            value = min([v for v in value if all(
+                _OPERATORS[filtr['operator']](v, filtr['value'])
+                for filtr in tests)] or [None])
+        return value
+    return lambda conf: (value(conf), conf.name)
+
+
+def queryArchive(filters, inequalityField=None, cursor=None):
+    """Return (conferences, cursor): the ArchivedConferences matching
+    formatted filters (see ConferenceApi._formatFilters) among the next
+    ARCHIVE_SCAN_LIMIT candidates after cursor, ordered as sortKey() orders
+    them, and the cursor to continue from, or None once all were read."""
+    q = ArchivedConference.query()
+    filters = [dict(filtr) for filtr in filters]
+    for filtr in filters:
+        if filtr['field'] in ('month', 'maxAttendees'):
+            filtr['value'] = int(filtr['value'])
+
+    # narrow with the equality filters on indexed fields; with key order
+    # the built-in indexes serve them
+    for filtr in filters:
+        if filtr['operator'] == '=' and filtr['field'] in ('city', 'topics'):
+            q = q.filter(ndb.query.FilterNode(filtr['field'], '=', filtr['value']))
+    q = q.order(ArchivedConference.key)
+
+    candidates, next_cursor, more = q.fetch_page(ARCHIVE_SCAN_LIMIT,
+        start_cursor=cursor, batch_size=ARCHIVE_QUERY_BATCH)
+    confs = [conf for conf in candidates
+             if all(_matches(conf, filtr) for filtr in filters)]
+    return sorted(confs, key=sortKey(filters, inequalityField)), \
+        next_cursor if more else None
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""budget.py
+
+Time and size budget for endpoints that iterate over query results.
+
+A frontend request is cut off after 60 seconds with a
+DeadlineExceededError, and an endpoint that iterates a large result set
+then returns nothing at all. A RequestBudget stops the iteration
+REQUEST_BUDGET seconds after it was created, or once MAX_RESULTS results
+(settings.py) have been gathered, so that the endpoint can still return
+what it has: the results so far, a pageToken to resume from, and
+truncated=True.
+
+The Python runtime has no call for the time left before the deadline, so
+the budget counts from its own creation at the start of the endpoint
+method; REQUEST_BUDGET leaves room for what runs before and after it.
+
+"""
+
+import time
+
+import endpoints
+from google.appengine.ext import ndb
+
+from settings import MAX_RESULTS
+from settings import REQUEST_BUDGET
+
+BUDGET_BATCH = 100
+
+
+class RequestBudget(object):
+    """Deadline and result cap for one request. A maxResults given by the
+    client must be positive."""
+
+    def __init__(self, maxResults=None, seconds=REQUEST_BUDGET):
+        if maxResults is not None and maxResults <= 0:
+            raise endpoints.BadRequestException("maxResults must be positive")
+        self.deadline = time.time() + seconds
+        self.maxResults = min(maxResults or MAX_RESULTS, MAX_RESULTS)
+
+    def expired(self):
+        return time.time() >= self.deadline
+
+
+def fetchWithin(q, budget, cursor=None, predicate=None):
+    """Iterate q from cursor until budget runs out.
+
+    Return (entities, cursor, truncated): the entities that satisfy
+    predicate, if one is given, and when iteration stopped early the
+    cursor to resume from and True.
+    """
+    entities = []
+    it = q.iter(start_cursor=cursor, produce_cursors=True,
+                batch_size=BUDGET_BATCH)
+    for entity in it:
+        if predicate is None or predicate(entity):
+            entities.append(entity)
+        if budget.expired():
+            return entities, it.cursor_after(), True
+        if len(entities) >= budget.maxResults:
+            if it.has_next():
+                return entities, it.cursor_after(), True
+            break
+    return entities, None, False
+
+
+def getWithin(keys, budget):
+    """Get the entities with keys, BUDGET_BATCH at a time, until budget
+    runs out.
+
+    Return (entities, count): the entities found, and how many of keys
+    were read, which is less than len(keys) when iteration stopped early.
+    """
+    entities = []
+    count = 0
+    while count < len(keys) and not budget.expired() and \
+            len(entities) < budget.maxResults:
+        batch = keys[count:count + min(BUDGET_BATCH,
+                                       budget.maxResults - len(entities))]
+        entities.extend(entity for entity in ndb.get_multi(batch) if entity)
+        count += len(batch)
+    return entities, count
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Memcache helpers for computed values (announcements, featured speakers,
+other aggregates) with stampede protection.
+
+Values are stored as (value, refreshAt) pairs. Once refreshAt has passed
+the value is stale: readers keep getting it while the one request that
+wins a memcache.add() lock recomputes it. The memcache expiry is longer
+than the soft TTL so stale values survive the refresh, and the soft TTL
+is jittered so keys written together don't all go stale together.
+
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+
+LOCK_SUFFIX = ":lock"
+LOCK_TTL = 10           # seconds a recompute may hold the lock
+STALE_FACTOR = 2        # memcache keeps values STALE_FACTOR * ttl seconds
+JITTER = 0.1            # soft TTLs are shortened by up to this fraction
+WAIT_POLLS = 10         # polls while another request fills a missing key
+WAIT_INTERVAL = 0.1
+
+
+def setCached(key, value, ttl):
+    """Store value under key, fresh for about ttl seconds."""
+    refreshAt = time.time() + ttl * random.uniform(1 - JITTER, 1)
+    memcache.set(key, (value, refreshAt), time=int(ttl * STALE_FACTOR))
+
+
+def getCachedMulti(keys):
+    """Return a dict of the cached values for keys, fresh or stale."""
+    return dict((key, entry[0]) for key, entry in
+                memcache.get_multi(keys).iteritems())
+
+
+def _recompute(key, compute, ttl):
+    try:
+        value = compute()
+        setCached(key, value, ttl)
+    finally:
+        memcache.delete(key + LOCK_SUFFIX)
+    return value
+
+
+def getCached(key, compute, ttl):
+    """Return the value under key, calling compute() to (re)build it.
+
+    Only one request at a time runs compute() for a key; while it does,
+    others are served the stale value, or wait briefly if there is none.
+    """
+    entry = memcache.get(key)
+    if entry is not None:
+        value, refreshAt = entry
+        if time.time() < refreshAt or \
+                not memcache.add(key + LOCK_SUFFIX, 1, time=LOCK_TTL):
+            return value
+        return _recompute(key, compute, ttl)
+
+    if memcache.add(key + LOCK_SUFFIX, 1, time=LOCK_TTL):
+        return _recompute(key, compute, ttl)
+
+    # someone else is filling the key; give them a moment
+    for i in range(WAIT_POLLS):
+        time.sleep(WAIT_INTERVAL)
+        entry = memcache.get(key)
+        if entry is not None:
+            return entry[0]
+    return compute()
+
+
+def refreshCached(key, compute, ttl):
+    """Recompute the value under key now, e.g. from a cron job; returns
+    None without computing if another request is already refreshing it."""
+    if not memcache.add(key + LOCK_SUFFIX, 1, time=LOCK_TTL):
+        return None
+    return _recompute(key, compute, ttl)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""calendarfeed.py
+
+iCalendar feeds of a conference's agenda and of a user's wishlist.
+
+Calendar apps poll feeds often, so a feed is rendered only when its data
+changes: write paths call scheduleRender(), which enqueues a coalesced
+render task. The task stores the feed as text, with an ETag, and the
+/calendar/<token>.ics handler in main.py writes it out as it is; the
+frontend compresses responses for clients that accept gzip.
+
+Wishlist feeds show the name and city of each session's conference, so
+an update to those (or the conference's dates) also re-renders the
+wishlist feeds of everyone who wishlisted one of its sessions.
+
+"""
+
+import gzip
+import hashlib
+import time
+import uuid
+from cStringIO import StringIO
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import app_identity
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import CalendarFeed
+from models import CalendarFeedToken
+from models import Session
+from models import UserWishlist
+
+from conferencekeys import getConferences
+from conferencekeys import getSessions
+
+RENDER_TASK_URL = '/tasks/render_calendar'
+RENDER_DELAY = 10       # seconds; changes within this window share a render
+WISHLIST_IN_BATCH = 30  # the most values an IN filter takes
+GZIP_MAGIC = '\x1f\x8b'
+FEED_URL = '/calendar/%s.ics'
+
+
+def feedUrl(feed):
+    return FEED_URL % feed.key.id()
+
+
+def getOrCreateFeed(target):
+    """Return the CalendarFeed of target (a Conference or Profile key),
+    creating and rendering it on first use."""
+    # get_or_insert is transactional, so concurrent first calls agree on
+    # one token; a feed made before CalendarFeedToken existed keeps its own
+    t_key = ndb.Key(CalendarFeedToken, target.urlsafe())
+    feedToken = t_key.get()
+    if feedToken is None:
+        legacy = CalendarFeed.query(CalendarFeed.target == target).get(
+            keys_only=True)
+        feedToken = CalendarFeedToken.get_or_insert(t_key.id(),
+            token=legacy.id() if legacy else uuid.uuid4().hex)
+    feed = CalendarFeed.get_or_insert(feedToken.token, target=target)
+    if not feed.ics:
+        render(feed)
+    return feed
+
+
+def scheduleRender(target, wishlists=False):
+    """Queue a render of target's feeds, and with wishlists those of the
+    wishlists holding sessions of target, a Conference; a burst of changes
+    to the same target within RENDER_DELAY seconds is rendered once.
+    Inside a transaction this happens once it has committed."""
+    ndb.get_context().call_on_commit(lambda: _queueRender(target, wishlists))
+
+
+def _queueRender(target, wishlists=False):
+    bucket = int(time.time()) // RENDER_DELAY
+    name = 'calendar-%s-%s%d' % (hashlib.md5(target.urlsafe()).hexdigest(),
+                                 'w' if wishlists else '', bucket)
+    params = {'target': target.urlsafe()}
+    if wishlists:
+        params['wishlists'] = '1'
+    try:
+        taskqueue.add(url=RENDER_TASK_URL, name=name, countdown=RENDER_DELAY,
+                      params=params)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def renderTarget(target, wishlists=False):
+    """Re-render every feed of target, and with wishlists queue renders of
+    the wishlist feeds that show its sessions; used by the render_calendar
+    task."""
+    for feed in CalendarFeed.query(CalendarFeed.target == target):
+        render(feed)
+    if wishlists:
+        for p_key in _wishlistFeedsOf(target):
+            _queueRender(p_key)
+
+
+def _wishlistFeedsOf(c_key):
+    """Return the keys of the profiles that have a wishlist feed and
+    wishlisted a session of the conference c_key."""
+    wsks = [s_key.urlsafe()
+            for s_key in Session.query(ancestor=c_key).fetch(keys_only=True)]
+    p_keys = set()
+    for i in range(0, len(wsks), WISHLIST_IN_BATCH):
+        p_keys.update(w_key.parent() for w_key in UserWishlist.query(
+            UserWishlist.wishlistedSessionKey.IN(wsks[i:i + WISHLIST_IN_BATCH])
+        ).fetch(keys_only=True))
+    p_keys = list(p_keys)
+    tokens = ndb.get_multi([ndb.Key(CalendarFeedToken, p_key.urlsafe())
+                            for p_key in p_keys])
+    return [p_key for p_key, token in zip(p_keys, tokens) if token]
+
+
+def render(feed):
+    """Render feed and store it if its content changed."""
+    if feed.target.kind() == 'Conference':
+        events = _conferenceEvents(feed.target)
+    else:
+        events = _wishlistEvents(feed.target)
+    ics = _calendar(events)
+    etag = '"%s"' % hashlib.md5(ics).hexdigest()
+    # feeds rendered before they were stored as text are rewritten once
+    if etag == feed.etag and not feed.ics.startswith(GZIP_MAGIC):
+        return
+
+    feed.ics = ics
+    feed.etag = etag
+    feed.updated = datetime.utcnow().replace(microsecond=0)
+    feed.put()
+
+
+def feedText(feed):
+    """Return the rendered text of feed."""
+    if feed.ics.startswith(GZIP_MAGIC):
+        # stored gzipped by an older version, until it is rendered again
+        return gzip.GzipFile(fileobj=StringIO(feed.ics)).read()
+    return feed.ics
+
+
+# - - - Rendering - - - - - - - - - - - - - - - - - - - - - - -
+
+def _conferenceEvents(c_key):
+    conf = getConferences([c_key])[0]
+    if conf is None:
+        return []
+    return [(sess, conf) for sess in Session.query(ancestor=conf.key)]
+
+
+def _wishlistEvents(p_key):
+    entries = UserWishlist.query(ancestor=p_key).fetch()
+    sessions = [sess for sess in getSessions([ndb.Key(urlsafe=entry.wishlistedSessionKey)
+                for entry in entries]) if sess]
+    confs = getConferences([sess.key.parent() for sess in sessions])
+    return zip(sessions, confs)
+
+
+def _escape(text):
+    return unicode(text or '').replace('\\', '\\\\').replace(';', '\\;') \
+        .replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold(line):
+    """Split a content line into 75-octet pieces, as RFC 5545 requires."""
+    data = line.encode('utf-8')
+    pieces = []
+    while len(data) > 75:
+        cut = 75 if not pieces else 74
+        # don't split a multi-byte character
+        while cut > 0 and (ord(data[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        pieces.append(data[:cut])
+        data = data[cut:]
+    pieces.append(data)
+    return '\r\n '.join(pieces)
+
+
+def _event(sess, conf, stamp):
+    start = datetime.combine(sess.startDate, sess.startTime.time()) \
+        if sess.startDate and sess.startTime else None
+    lines = [
+        u'BEGIN:VEVENT',
+        u'UID:%s@%s' % (sess.key.urlsafe(), app_identity.get_application_id()),
+        u'DTSTAMP:%s' % stamp,
+        u'SUMMARY:%s' % _escape(sess.name),
+    ]
+    if start:
+        lines.append(u'DTSTART:%s' % start.strftime('%Y%m%dT%H%M%S'))
+        lines.append(u'DTEND:%s' % (start + timedelta(
+            minutes=sess.duration or 0)).strftime('%Y%m%dT%H%M%S'))
+    if conf and conf.city:
+        lines.append(u'LOCATION:%s' % _escape(conf.city))
+    details = [conf.name if conf else None, sess.typeOfSession,
+               sess.speaker and u'Speaker: %s' % sess.speaker] + \
+        list(sess.highlights)
+    lines.append(u'DESCRIPTION:%s' % _escape(u'\n'.join(d for d in details if d)))
+    lines.append(u'END:VEVENT')
+    return lines
+
+
+def _calendar(events):
+    # a fixed DTSTAMP rather than the render time means an unchanged
+    # agenda renders to identical bytes and keeps its ETag
+    stamp = '19700101T000000Z'
+    lines = [u'BEGIN:VCALENDAR', u'VERSION:2.0',
+             u'PRODID:-//Udacity//Conference Central//EN',
+             u'CALSCALE:GREGORIAN']
+    for sess, conf in sorted(events, key=lambda pair: (
+            pair[0].startDate, pair[0].startTime, pair[0].name)):
+        lines += _event(sess, conf, stamp)
+    lines.append(u'END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
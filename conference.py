@@ -16,13 +16,13 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 from datetime import datetime
 from datetime import date
 from datetime import timedelta
+import time
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
@@ -30,6 +30,9 @@ from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import Registration
+from models import AttendeeForm
+from models import AttendeeForms
 from models import StringMessage
 from models import BooleanMessage
 from models import Conference
@@ -47,6 +50,18 @@ from models import FeaturedSpeakerMemcacheEntry
 from models import FeaturedSpeakerMemcacheEntryForm
 from models import FeaturedSpeakerMemcacheEntryForms
 from models import FeaturedSpeakerMemcacheKeys
+from models import SessionRankForm
+from models import ConferenceStatsForm
+from models import OrganizerReport
+from models import OrganizerReportForm
+from models import ReportTermForm
+from models import TeeShirtTally
+from models import TeeShirtCountForm
+from models import TeeShirtTallyForm
+from models import ChangesForm
+from models import SuggestionForm
+from models import SuggestionForms
+from models import DeletedForm
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
@@ -55,12 +70,90 @@ from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
 
+from conferencekeys import currentConferenceKeys
+from conferencekeys import getConference
+from conferencekeys import getConferences
+from conferencekeys import getSessions
+
+from budget import RequestBudget
+from budget import fetchWithin
+from budget import getWithin
+
+from unitofwork import current
+from unitofwork import unitOfWork
+
+from geo import MAX_RADIUS_KM
+from geo import cityCoordinates
+from geo import coveringCells
+from geo import distanceKm
+from geo import encode
+from geo import prefixes
+
+from calendarfeed import feedUrl
+from calendarfeed import getOrCreateFeed
+from calendarfeed import scheduleRender
+
+from archive import conferenceKey
+from archive import getArchivedConference
+from archive import getArchivedSessions
+from archive import queryArchive
+from archive import sortKey
+
+from sync import changesSince
+from sync import registrationTombstone
+
+from recommend import recommendedSessionKeys
+
+from searchcache import bumpGenerations
+from searchcache import changedFields
+from searchcache import resultVersion
+from searchcache import searchConferences
+from searchcache import searchConferenceKeysWithin
+from searchcache import searchFields
+
+from suggest import MAX_SUGGESTIONS
+from suggest import recordTerms
+from suggest import suggest
+
+from profilecache import getProfile
+from profilecache import invalidateProfiles
+
+from analytics import CURVE_DAYS
+from analytics import VELOCITY_DAYS
+
+from profiler import profiled
+
+from cache import getCached
+from cache import getCachedMulti
+from cache import refreshCached
+from cache import setCached
+
+from stats import getCounter
+from stats import getLeaderboard
+from stats import reconcileConference
+from stats import recordSessionCreated
+from stats import recordSessionWishlisted
+from stats import sessionCounterName
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ANNOUNCEMENT_TTL = 60 * 60
 MEMCACHE_FEATURED_SPEAKER_KEY = "FeaturedSpeaker"
+FEATURED_SPEAKER_TTL = 24 * 60 * 60
+FEATURED_SPEAKER_TASK_URL = '/tasks/featured_speakers'
+FEATURED_SPEAKER_REBUILD_DELAY = 60
+ATTENDEES_PAGE_SIZE = 50
+REGISTRATION_MIGRATION_BATCH = 100
+REGISTRATION_MIGRATION_GROUPS = 10
+STATS_RECONCILE_BATCH = 20
+GEOCODE_BATCH = 100
+NEAR_DEFAULT_RADIUS_KM = 50
+NEAR_CELL_LIMIT = 500
+# pageTokens that continue into the archive, after every live result
+ARCHIVE_PAGE_PREFIX = 'archive:'
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 CONFERENCE_DEFAULTS = {
@@ -108,12 +201,34 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
 
 CONF_GET_BY_CITY = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    conferenceCity=messages.StringField(1)
+    conferenceCity=messages.StringField(1),
+    includeArchived=messages.BooleanField(2),
+    pageToken=messages.StringField(3),
+    maxResults=messages.IntegerField(4, variant=messages.Variant.INT32)
 )
 
 CONF_GET_BY_TOPIC = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    conferenceTopic=messages.StringField(2)
+    conferenceTopic=messages.StringField(2),
+    includeArchived=messages.BooleanField(3),
+    pageToken=messages.StringField(4)
+)
+
+CONF_ATTENDEES_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageToken=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32)
+)
+
+CONF_NEAR_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    latitude=messages.FloatField(1),
+    longitude=messages.FloatField(2),
+    city=messages.StringField(3),
+    radiusKm=messages.FloatField(4),
+    fromDate=messages.StringField(5),
+    toDate=messages.StringField(6)
 )
 
 SESS_POST_REQUEST = endpoints.ResourceContainer(
@@ -134,7 +249,9 @@ SESS_GET_BY_TYPE_REQUEST = endpoints.ResourceContainer(
 
 SESS_GET_BY_SPEAKER_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    speaker=messages.StringField(1)
+    speaker=messages.StringField(1),
+    pageToken=messages.StringField(2),
+    maxResults=messages.IntegerField(3, variant=messages.Variant.INT32)
 )
 
 SESS_ADD_TO_WISHLIST_REQUEST = endpoints.ResourceContainer(
@@ -142,10 +259,31 @@ SESS_ADD_TO_WISHLIST_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1)
 )
 
+SUGGEST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    field=messages.StringField(1, required=True),
+    prefix=messages.StringField(2),
+    limit=messages.IntegerField(3, variant=messages.Variant.INT32)
+)
+
+SYNC_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    syncToken=messages.StringField(1),
+    pageToken=messages.StringField(2)
+)
+
 GET_SESSIONS_BY_NONTYPE_AND_BEFORE_TIME = endpoints.ResourceContainer(
     message_types.VoidMessage,
     sessionType=messages.StringField(1, required=True),
-    endTime=messages.StringField(2, required=True)
+    endTime=messages.StringField(2, required=True),
+    pageToken=messages.StringField(3),
+    maxResults=messages.IntegerField(4, variant=messages.Variant.INT32)
+)
+
+FILTER_PLAYGROUND_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageToken=messages.StringField(1),
+    maxResults=messages.IntegerField(2, variant=messages.Variant.INT32)
 )
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -164,6 +302,45 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         return user;
 
+    @staticmethod
+    def _pageCursor(pageToken):
+        """Return the query cursor a pageToken stands for, or None."""
+        if not pageToken:
+            return None
+        try:
+            return ndb.Cursor(urlsafe=pageToken)
+        except Exception:
+            raise endpoints.BadRequestException("Invalid pageToken")
+
+    @staticmethod
+    def _archiveCursor(pageToken):
+        """Return the archive cursor a pageToken from _withArchive() stands
+        for, or None if it doesn't page through the archive."""
+        if not pageToken or not pageToken.startswith(ARCHIVE_PAGE_PREFIX):
+            return None
+        return ConferenceApi._pageCursor(pageToken[len(ARCHIVE_PAGE_PREFIX):])
+
+    @staticmethod
+    def _withArchive(forms, filters, pageToken, inequalityField=None):
+        """Add a page of archived conferences matching filters to forms
+        (ConferenceForms), and a pageToken for the next one."""
+        archived, next_cursor = queryArchive(filters, inequalityField,
+            ConferenceApi._archiveCursor(pageToken))
+        if next_cursor:
+            forms.nextPageToken = ARCHIVE_PAGE_PREFIX + next_cursor.urlsafe()
+            forms.truncated = True
+        return archived
+
+    @staticmethod
+    def _conferenceNotFound(websafeConferenceKey):
+        """Return the exception for a websafe key that finds no live
+        Conference; writes to an archived conference are refused."""
+        if getArchivedConference(websafeConferenceKey):
+            return endpoints.NotFoundException(
+                'Conference %s has ended and been archived' % websafeConferenceKey)
+        return endpoints.NotFoundException(
+            'No conference found with key: %s' % websafeConferenceKey)
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
     def _copyConferenceToForm(self, conf, displayName):
@@ -177,12 +354,32 @@ class ConferenceApi(remote.Service):
                 else:
                     setattr(cf, field.name, getattr(conf, field.name))
             elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+                setattr(cf, field.name, conferenceKey(conf).urlsafe())
+        if conf.location:
+            cf.latitude = conf.location.lat
+            cf.longitude = conf.location.lon
         if displayName:
             setattr(cf, 'organizerDisplayName', displayName)
         cf.check_initialized()
         return cf
 
+    @staticmethod
+    def _setConferenceLocation(conf, latitude=None, longitude=None):
+        """Place conf at latitude/longitude, or else at its city if known."""
+        if latitude is not None and longitude is not None:
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                raise endpoints.BadRequestException("Invalid latitude/longitude")
+            coords = (latitude, longitude)
+        else:
+            coords = cityCoordinates(conf.city)
+
+        if coords:
+            conf.location = ndb.GeoPt(*coords)
+            conf.geohashes = prefixes(encode(*coords))
+        else:
+            conf.location = None
+            conf.geohashes = []
+
     def _copySessionToForm(self, theSession):
         wl = SessionForm()
         
@@ -199,6 +396,7 @@ class ConferenceApi(remote.Service):
         return wl
 
 
+    @unitOfWork
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
@@ -212,6 +410,9 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['distanceKm']
+        latitude = data.pop('latitude')
+        longitude = data.pop('longitude')
 
         # add default values for those missing (both data model & outbound Message)
         for df in CONFERENCE_DEFAULTS:
@@ -231,36 +432,40 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
-        data['key'] = c_key
+        # Conferences are root entities, so each one is its own entity
+        # group; the organizer is referenced rather than being the parent
+        data['organizer'] = ndb.Key(Profile, user_id)
         data['organizerUserId'] = request.organizerUserId = user_id
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        conf = Conference(**data)
+        self._setConferenceLocation(conf, latitude, longitude)
+        current().put(conf)
+        current().afterFlush(bumpGenerations)
+        current().afterFlush(recordTerms, 'topics', list(conf.topics))
+        current().afterFlush(recordTerms, 'city', [conf.city])
+        current().addTask('/tasks/send_confirmation_email',
+            params={'email': user.email(), 'conferenceInfo': repr(request)})
         return request
                 
-    def _getUserWishlistByProfile(self, profile):
+    def _getUserWishlistByProfile(self, profile, wishlistEntries=None):
         #Given a profile, get its key and return the sessions on the wishlist 
         
         if not profile:
             raise endpoints.BadRequestException("Invalid profile!")
         
         #Get the wishlist entries and add them to the wishlist to return.
-        wishlistEntries = UserWishlist.query(ancestor=profile.key).fetch(limit=None)
+        if wishlistEntries is None:
+            wishlistEntries = UserWishlist.query(ancestor=profile.key).fetch(limit=None)
         finishedWishlist = SessionForms()
         
         if wishlistEntries:
-            for entry in wishlistEntries:
-                theSession = ndb.Key(urlsafe=getattr(entry, "wishlistedSessionKey")).get()
+            theSessions = getSessions([ndb.Key(urlsafe=getattr(entry, "wishlistedSessionKey"))
+                for entry in wishlistEntries])
+            for theSession in theSessions:
+                if not theSession:
+                    continue
                 sf = self._copySessionToForm(theSession)
                 sf.check_initialized()
                 finishedWishlist.items.append(sf)
@@ -268,6 +473,7 @@ class ConferenceApi(remote.Service):
         return finishedWishlist
         
         #TODO
+    @unitOfWork
     def _addSessionToWishlist(self, request):
         #Check if the user is logged in
         
@@ -275,48 +481,55 @@ class ConferenceApi(remote.Service):
         user_id = getUserId(user)
             
         #Check if the theSession exists
-        theSession = ndb.Key(urlsafe=request.websafeSessionKey).get()
+        theSession = getSessions([ndb.Key(urlsafe=request.websafeSessionKey)])[0]
         
         if not theSession:
             raise endpoints.BadRequestException("Invalid session key")
+        websafeSessionKey = theSession.key.urlsafe()
         
         #Get user profile
-        prof = ndb.Key(Profile, user_id).get()
+        prof = getProfile(ndb.Key(Profile, user_id))
         
         if not prof:
             raise endpoints.BadRequestException("Unable to find user profile")
         
-        wishlistEntry = UserWishlist.query(ancestor=prof.key).filter(
-            getattr(UserWishlist, "wishlistedSessionKey") == request.websafeSessionKey
-        ).get()
-        
-        print wishlistEntry
+        # one ancestor query serves both the duplicate check and the
+        # response, so the new entry needn't be written before returning
+        wishlistEntries = UserWishlist.query(ancestor=prof.key).fetch(limit=None)
         
         #If the desired wishlist entry doesn't already exist, create it.
-        if not wishlistEntry:
+        if websafeSessionKey not in [entry.wishlistedSessionKey
+                                     for entry in wishlistEntries]:
             wishlistEntry = UserWishlist(parent=prof.key)
-            setattr(wishlistEntry, "wishlistedSessionKey", request.websafeSessionKey)
-            wishlistEntry.put()
+            setattr(wishlistEntry, "wishlistedSessionKey", websafeSessionKey)
+            current().put(wishlistEntry)
+            wishlistEntries.append(wishlistEntry)
+            # counted and rendered only once the entry has been written
+            current().afterFlush(recordSessionWishlisted, theSession)
+            current().afterFlush(scheduleRender, prof.key)
             
-        return self._getUserWishlistByProfile(prof)     
+        return self._getUserWishlistByProfile(prof, wishlistEntries)
 
         
     #Same as above, but for sessions.
+    @unitOfWork
     def _createSessionObject(self, request):
         self._getLoggedInUser()
 
         if not request.websafeConferenceKey:
             raise endpoints.BadRequestException("Websafe Conference Key field required")
         
-        theConference = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        theConference = getConference(request.websafeConferenceKey)
         
         if not theConference:
+            if getArchivedConference(request.websafeConferenceKey):
+                raise self._conferenceNotFound(request.websafeConferenceKey)
             raise endpoints.BadRequestException("That conference doesn't exist!")
             
         # Same as above, copy SessionForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
        
-        theConferenceWebsafeKey = data['websafeConferenceKey']
+        theConferenceWebsafeKey = theConference.key.urlsafe()
        
         del data['websafeKey']
         del data['websafeConferenceKey']
@@ -341,54 +554,104 @@ class ConferenceApi(remote.Service):
             data['startTime'] = datetime.now()
 
         # Generate keys
-        Session(parent=theConference.key, **data).put()
+        newSession = Session(parent=theConference.key, **data)
+        current().put(newSession)
+        current().afterFlush(recordTerms, 'speaker', [newSession.speaker])
+        current().afterFlush(recordSessionCreated, theConference.key.urlsafe())
+        current().afterFlush(scheduleRender, theConference.key)
         
         if (data['speaker']):
             # Check speaker name at this conference for the Featured Speaker memcaches
+            # the new session is written when the request's unit of work
+            # flushes, so the query doesn't return it yet
             speakerSessions = Session.query(ancestor=theConference.key).filter(Session.speaker == data['speaker']).fetch(limit=None)
+            speakerSessions.append(newSession)
             
             if (speakerSessions) and (len(speakerSessions) > 1):
-                #Check if the memcache entry exists for this speaker and this conference.
-   
-                theEntry = memcache.get(data['speaker'] + "_" + theConferenceWebsafeKey)
-                theKeys = memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY)
-                
-                entryKey = key = (data['speaker'] + "_" + theConferenceWebsafeKey)
-                
-                if theKeys is None:
-                    theKeys = FeaturedSpeakerMemcacheKeys()
-                
-                if theEntry is None:
-                    theEntry = FeaturedSpeakerMemcacheEntry()
-                    theEntry.speaker = data['speaker']
-                    theEntry.conferenceWebsafeKey = theConferenceWebsafeKey
-                    
-                theEntry.sessions = []
-                
-                for speakerSession in speakerSessions:
-                    theEntry.sessions.append(speakerSession.name)
-                        
-                memcache.set(key = entryKey, 
-                    value = theEntry)
-                    
-                if entryKey not in theKeys.items:
+                entryKey = self._cacheFeaturedSpeaker(data['speaker'],
+                    theConferenceWebsafeKey, speakerSessions)
+
+                # if the list is missing, the queued rebuild will find
+                # this session; a one-entry list would hide the others
+                theKeys = self._getFeaturedSpeakerKeys()
+
+                if theKeys is not None and entryKey not in theKeys.items:
                     theKeys.items.append(entryKey)
-                    memcache.set(key = MEMCACHE_FEATURED_SPEAKER_KEY, value = theKeys)
+                    setCached(MEMCACHE_FEATURED_SPEAKER_KEY, theKeys,
+                        FEATURED_SPEAKER_TTL)
                     
                     
         return request
 
+    @staticmethod
+    def _cacheFeaturedSpeaker(speaker, theConferenceWebsafeKey, speakerSessions):
+        """Set one speaker's Featured Speaker memcache entry; return its key."""
+        entryKey = speaker + "_" + theConferenceWebsafeKey
+        theEntry = FeaturedSpeakerMemcacheEntry()
+        theEntry.speaker = speaker
+        theEntry.conferenceWebsafeKey = theConferenceWebsafeKey
+        theEntry.sessions = [speakerSession.name for speakerSession in speakerSessions]
+        setCached(entryKey, theEntry, FEATURED_SPEAKER_TTL)
+        return entryKey
+
+    @staticmethod
+    def _cacheFeaturedSpeakers():
+        """Rebuild every Featured Speaker memcache entry from the datastore;
+        return the FeaturedSpeakerMemcacheKeys listing them.
+        """
+        # group sessions by conference and speaker
+        bySpeaker = {}
+        for sess in Session.query():
+            if not sess.speaker:
+                continue
+            bySpeaker.setdefault((sess.key.parent().urlsafe(), sess.speaker),
+                []).append(sess)
+
+        theKeys = FeaturedSpeakerMemcacheKeys()
+        for (theConferenceWebsafeKey, speaker), speakerSessions in bySpeaker.iteritems():
+            if len(speakerSessions) > 1:
+                theKeys.items.append(ConferenceApi._cacheFeaturedSpeaker(
+                    speaker, theConferenceWebsafeKey, speakerSessions))
+        return theKeys
+
+    @staticmethod
+    def _refreshFeaturedSpeakers():
+        """Rebuild the Featured Speaker memcaches; used by the
+        featured_speakers task."""
+        setCached(MEMCACHE_FEATURED_SPEAKER_KEY,
+            ConferenceApi._cacheFeaturedSpeakers(), FEATURED_SPEAKER_TTL)
+
+    @staticmethod
+    def _getFeaturedSpeakerKeys():
+        """Return the cached FeaturedSpeakerMemcacheKeys, or None if
+        memcache has lost them. The rebuild scans every Session, so it is
+        queued rather than run on the request; a burst of misses within
+        FEATURED_SPEAKER_REBUILD_DELAY seconds queues it once."""
+        theKeys = getCachedMulti([MEMCACHE_FEATURED_SPEAKER_KEY]).get(
+            MEMCACHE_FEATURED_SPEAKER_KEY)
+        if theKeys is None:
+            bucket = int(time.time()) // FEATURED_SPEAKER_REBUILD_DELAY
+            try:
+                taskqueue.add(url=FEATURED_SPEAKER_TASK_URL,
+                              name='featured-speakers-%d' % bucket)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                pass
+        return theKeys
+
     def _getFeaturedSpeakersFromMemcache(self):
-        # inserted via key MEMCACHE_FEATURED_SPEAKER_KEY
-        theKeys = memcache.get(key = MEMCACHE_FEATURED_SPEAKER_KEY)
+        # inserted via key MEMCACHE_FEATURED_SPEAKER_KEY; kept fresh by
+        # the featured_speakers cron, and empty until a queued rebuild
+        # has run if memcache has lost it
+        theKeys = self._getFeaturedSpeakerKeys() or FeaturedSpeakerMemcacheKeys()
         thingsToReturn = FeaturedSpeakerMemcacheEntryForms()
         thingsToReturn.check_initialized()
         
-        if theKeys:
-            for speakerKey in theKeys.items:
-                entry = memcache.get(key = speakerKey)
-                if entry:
-                    thingsToReturn.items.append(self._copyFeaturedSpeakerToForm(entry))
+        entries = getCachedMulti(theKeys.items)
+        for speakerKey in theKeys.items:
+            entry = entries.get(speakerKey)
+            if entry:
+                thingsToReturn.items.append(self._copyFeaturedSpeakerToForm(entry))
                     
         return thingsToReturn
             
@@ -401,7 +664,8 @@ class ConferenceApi(remote.Service):
         
         return toReturn
         
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
+    @unitOfWork
     def _updateConferenceObject(self, request):
         user = self._getLoggedInUser()
         user_id = getUserId(user)
@@ -410,11 +674,10 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
 
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = getConference(request.websafeConferenceKey)
         # check that conference exists
         if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
+            raise self._conferenceNotFound(request.websafeConferenceKey)
 
         # check that user is owner
         if user_id != conf.organizerUserId:
@@ -423,6 +686,9 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        before = searchFields(conf)
+        # what wishlist feeds show of the conference
+        shown = (conf.name, conf.city, conf.startDate, conf.endDate)
         for field in request.all_fields():
             data = getattr(request, field.name)
             # only copy fields where we get data
@@ -434,10 +700,20 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+
+        if request.city or request.latitude is not None:
+            self._setConferenceLocation(conf, request.latitude, request.longitude)
                 
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        current().put(conf)
+        current().afterFlush(bumpGenerations, changedFields(before, conf))
+        current().afterFlush(recordTerms, 'topics', list(conf.topics), before['topics'])
+        current().afterFlush(recordTerms, 'city', [conf.city], [before['city']])
+        # the agenda feed shows the conference's name and city, and so do
+        # the wishlist feeds holding its sessions
+        current().afterFlush(scheduleRender, conf.key,
+            shown != (conf.name, conf.city, conf.startDate, conf.endDate))
+        prof = getProfile(ndb.Key(Profile, user_id))
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName', None))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -475,12 +751,105 @@ class ConferenceApi(remote.Service):
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = getConference(request.websafeConferenceKey) or \
+            getArchivedConference(request.websafeConferenceKey)
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        prof = ndb.Key(Profile, conf.organizerUserId).get()
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName', None))
+
+    @endpoints.method(CONF_GET_REQUEST, ConferenceStatsForm,
+            path='conference/{websafeConferenceKey}/stats',
+            http_method='GET', name='getConferenceStats')
+    def getConferenceStats(self, request):
+        """Return session/registration counts and most wishlisted sessions;
+        only the organizer may ask."""
+        user = self._getLoggedInUser()
+        user_id = getUserId(user)
+
+        conf = getConference(request.websafeConferenceKey)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can see the statistics.')
+        wsck = conf.key.urlsafe()
+
+        # seatsAvailable is kept exact by _conferenceRegistration
+        registered = (conf.maxAttendees or 0) - (conf.seatsAvailable or 0)
+        return ConferenceStatsForm(
+            websafeConferenceKey=wsck,
+            sessionCount=getCounter(sessionCounterName(wsck)),
+            registrationCount=registered,
+            maxAttendees=conf.maxAttendees,
+            fillRate=float(registered) / conf.maxAttendees if conf.maxAttendees else 0.0,
+            topSessions=[SessionRankForm(websafeKey=rank.websafeKey,
+                name=rank.name, wishlistCount=rank.wishlistCount)
+                for rank in getLeaderboard(wsck)]
+        )
+
+    @endpoints.method(message_types.VoidMessage, OrganizerReportForm,
+            path='organizer/report',
+            http_method='GET', name='getOrganizerReport')
+    def getOrganizerReport(self, request):
+        """Return the latest analytics snapshot across the user's conferences."""
+        user = self._getLoggedInUser()
+        report = OrganizerReport.get_by_id(getUserId(user))
+        if not report:
+            raise endpoints.NotFoundException(
+                'No report yet; reports are computed daily.')
+
+        return OrganizerReportForm(
+            conferences=report.conferences,
+            sessions=report.sessions,
+            registrations=report.registrations,
+            maxAttendees=report.maxAttendees,
+            fillRate=report.fillRate,
+            curveDays=list(CURVE_DAYS),
+            fillCurve=report.fillCurve,
+            velocityDays=list(VELOCITY_DAYS),
+            velocity=report.velocity,
+            months=report.months,
+            topics=[ReportTermForm(term=t.term, count=t.count,
+                registrations=t.registrations) for t in report.topics],
+            sessionTypes=[ReportTermForm(term=t.term, count=t.count)
+                for t in report.sessionTypes],
+            updated=str(report.updated)
+        )
+
+    @staticmethod
+    def _reconcileStats(cursor=None):
+        """Recompute statistics for one batch of conferences; return the
+        cursor for the next batch, or None when done. Used by the
+        reconcile_stats task.
+        """
+        confs, next_cursor, more = Conference.query().fetch_page(
+            STATS_RECONCILE_BATCH, start_cursor=cursor)
+        for conf in confs:
+            reconcileConference(conf)
+        return next_cursor if more else None
+
+    @endpoints.method(CONF_GET_REQUEST, StringMessage,
+            path='conference/{websafeConferenceKey}/calendar',
+            http_method='GET', name='getConferenceCalendarFeed')
+    def getConferenceCalendarFeed(self, request):
+        """Return the URL path of the conference agenda's iCalendar feed."""
+        self._getLoggedInUser()
+        conf = getConference(request.websafeConferenceKey)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        return StringMessage(data=feedUrl(getOrCreateFeed(conf.key)))
+
+    @endpoints.method(message_types.VoidMessage, StringMessage,
+            path='wishlist/calendar',
+            http_method='GET', name='getWishlistCalendarFeed')
+    def getWishlistCalendarFeed(self, request):
+        """Return the URL path of your wishlist's private iCalendar feed."""
+        prof = self._getProfileFromUser()
+        return StringMessage(data=feedUrl(getOrCreateFeed(prof.key)))
 
     #Return sessions by conference.
     @endpoints.method(CONF_GET_REQUEST, 
@@ -491,8 +860,15 @@ class ConferenceApi(remote.Service):
         
         self._getLoggedInUser()
         
-        theConference = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        theSessions = Session.query(ancestor=theConference.key)
+        theConference = getConference(request.websafeConferenceKey)
+        if theConference:
+            theSessions = Session.query(ancestor=theConference.key)
+        else:
+            theConference = getArchivedConference(request.websafeConferenceKey)
+            if not theConference:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' % request.websafeConferenceKey)
+            theSessions = getArchivedSessions(theConference)
         
         return SessionForms(
             items=[self._copySessionToForm(oneSession) for oneSession in theSessions]
@@ -507,56 +883,194 @@ class ConferenceApi(remote.Service):
         user = self._getLoggedInUser()
         user_id = getUserId(user)
 
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        # query by organizer; the ancestor query finds conferences still
+        # under the user's Profile until /tasks/migrate_conference_keys has run
+        p_key = ndb.Key(Profile, user_id)
+        confs = Conference.query(Conference.organizer == p_key).fetch() + \
+            Conference.query(ancestor=p_key).fetch()
+        prof = getProfile(p_key)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName', None)) for conf in confs]
         )
         
     @endpoints.method(CONF_GET_BY_CITY, ConferenceForms,
         path="getConferencesByCity",
         http_method="POST", name="getConferencesByCity")
     def getConferencesByCity(self, request):
-        """Get conferences by city."""
-        confs = Conference.query().filter(getattr(Conference, "city") == request.conferenceCity)
+        """Get conferences by city; truncated, with a pageToken to resume
+        from, when the request budget runs out."""
+        budget = RequestBudget(request.maxResults)
+        filters = [{'field': 'city', 'operator': '=', 'value': request.conferenceCity}]
+        forms = ConferenceForms()
+        confs = []
+        if not self._archiveCursor(request.pageToken):
+            # the pageToken is an offset into the (cached) search result,
+            # and the version of the part of it before the offset
+            try:
+                offset, tokenVersion = (request.pageToken or '0:').split(':')
+                offset = int(offset)
+            except ValueError:
+                raise endpoints.BadRequestException("Invalid pageToken")
+            # one key past the page tells whether there is a next one
+            c_keys, complete = searchConferenceKeysWithin(
+                Conference.query().filter(
+                    getattr(Conference, "city") == request.conferenceCity),
+                filters, budget, offset + budget.maxResults + 1)
+            if len(c_keys) < offset and not complete:
+                # the budget ran out before reaching the page; the keys
+                # read so far are cached, so the same token goes further
+                forms.nextPageToken = request.pageToken
+                forms.truncated = True
+            else:
+                if request.pageToken and \
+                        resultVersion(c_keys[:offset]) != tokenVersion:
+                    raise endpoints.BadRequestException(
+                        "The results have changed since pageToken; start again.")
+                page = c_keys[offset:]
+                confs, count = getWithin(page, budget)
+                if count < len(page) or not complete:
+                    version = resultVersion(c_keys[:offset + count])
+                    forms.nextPageToken = '%d:%s' % (offset + count, version)
+                    forms.truncated = True
+        if request.includeArchived and not forms.truncated:
+            confs += self._withArchive(forms, filters, request.pageToken)
         prof = self._getProfileFromUser()
+
+        forms.items = [self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+        return forms
         
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
-        )
-        
+    @endpoints.method(CONF_NEAR_REQUEST, ConferenceForms,
+        path="getConferencesNear",
+        http_method="GET", name="getConferencesNear")
+    def getConferencesNear(self, request):
+        """Get conferences within radiusKm of a point or known city, nearest
+        first; truncated if a covering cell held more than NEAR_CELL_LIMIT."""
+        if request.latitude is not None and request.longitude is not None:
+            lat, lng = request.latitude, request.longitude
+        elif cityCoordinates(request.city):
+            lat, lng = cityCoordinates(request.city)
+        else:
+            raise endpoints.BadRequestException(
+                "Give latitude and longitude, or a known city.")
+        radius = request.radiusKm or NEAR_DEFAULT_RADIUS_KM
+        if not 0 < radius <= MAX_RADIUS_KM:
+            raise endpoints.BadRequestException(
+                "radiusKm must be between 0 and %d." % MAX_RADIUS_KM)
+        try:
+            fromDate = request.fromDate and \
+                datetime.strptime(request.fromDate[:10], "%Y-%m-%d").date()
+            toDate = request.toDate and \
+                datetime.strptime(request.toDate[:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException("Dates must be YYYY-MM-DD.")
+
+        # one query per covering cell, all in flight at once
+        futures = []
+        for cell in coveringCells(lat, lng, radius):
+            q = Conference.query(Conference.geohashes == cell)
+            if fromDate:
+                q = q.filter(Conference.startDate >= fromDate)
+            if toDate:
+                q = q.filter(Conference.startDate <= toDate)
+            futures.append(q.fetch_async(NEAR_CELL_LIMIT))
+
+        # the cells overshoot the circle; refine by exact distance. A cell
+        # cut off at NEAR_CELL_LIMIT may have left out nearer conferences
+        nearby = []
+        truncated = False
+        for future in futures:
+            confs = future.get_result()
+            truncated = truncated or len(confs) >= NEAR_CELL_LIMIT
+            for conf in confs:
+                distance = distanceKm(lat, lng, conf.location.lat, conf.location.lon)
+                if distance <= radius:
+                    nearby.append((distance, conf))
+        nearby.sort(key=lambda pair: pair[0])
+
+        profiles = ndb.get_multi(set(ndb.Key(Profile, conf.organizerUserId)
+            for distance, conf in nearby))
+        names = dict((prof.key.id(), prof.displayName) for prof in profiles if prof)
+
+        items = []
+        for distance, conf in nearby:
+            cf = self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+            cf.distanceKm = round(distance, 2)
+            items.append(cf)
+        return ConferenceForms(items=items, truncated=truncated)
+
+    @staticmethod
+    def _geocodeConferences(cursor=None):
+        """Place one batch of conferences that have no location yet at
+        their city; return the cursor for the next batch, or None when
+        done. Used by the geocode_conferences task.
+        """
+        confs, next_cursor, more = Conference.query().fetch_page(
+            GEOCODE_BATCH, start_cursor=cursor)
+        located = []
+        for conf in confs:
+            if not conf.location and cityCoordinates(conf.city):
+                ConferenceApi._setConferenceLocation(conf)
+                located.append(conf)
+        ndb.put_multi(located)
+        return next_cursor if more else None
+
     @endpoints.method(CONF_GET_BY_TOPIC, ConferenceForms,
         path="getConferencesByExactTopic",
         http_method="POST", name="getConferencesByExactTopic")
     def getConferencesByExactTopic(self, request):
         """Get conferences by topic.  Must be a complete match; use getConferencesCreated and copy a topic from there."""
-        confs = Conference.query(Conference.topics == request.conferenceTopic)
+        filters = [{'field': 'topics', 'operator': '=', 'value': request.conferenceTopic}]
+        forms = ConferenceForms()
+        confs = []
+        # archive pages come after the one with every live result
+        if not self._archiveCursor(request.pageToken):
+            confs = searchConferences(Conference.query(
+                Conference.topics == request.conferenceTopic), filters)
+        if request.includeArchived:
+            confs += self._withArchive(forms, filters, request.pageToken)
         prof = self._getProfileFromUser()
+
+        forms.items = [self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+        return forms
         
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
-        )
-        
+    @endpoints.method(SUGGEST_REQUEST, SuggestionForms,
+        path="suggest", http_method="GET", name="suggest")
+    def suggestTerms(self, request):
+        """Suggest topics, cities or speakers starting with prefix, most
+        common first; field is 'topics', 'city' or 'speaker'."""
+        try:
+            suggestions = suggest(request.field, request.prefix,
+                                  request.limit or MAX_SUGGESTIONS)
+        except KeyError:
+            raise endpoints.BadRequestException(
+                "field must be 'topics', 'city' or 'speaker'")
+        return SuggestionForms(items=[SuggestionForm(term=term, count=count)
+                                      for term, count in suggestions])
+
     @endpoints.method(GET_SESSIONS_BY_NONTYPE_AND_BEFORE_TIME, SessionForms,
         path="getSessionsNotOfTypeAndBeforeTime",
         http_method="POST", name="getSessionsNotOfTypeAndBeforeTime")
     def getSessionsNotOfTypeAndBeforeTime(self, request):
         """Get sessions that are NOT a given type, and that finish before the given 24H time."""
-
-        sessions = Session.query(Session.typeOfSession != request.sessionType)
-        sessionsToReturn = SessionForms()
-        sessionsToReturn.check_initialized()
-        
+        budget = RequestBudget(request.maxResults)
+        cursor = self._pageCursor(request.pageToken)
         cutoffTime = datetime.strptime(request.endTime, "%H:%M:%S")
-        
-        for sess in sessions:
-            #For each session that finishes before the cutoff time, add it to the list to return.
-            if (cutoffTime > (sess.startTime + timedelta(minutes = sess.duration))):
-                sessionsToReturn.items.append(self._copySessionToForm(sess))
-        
-        return sessionsToReturn
+
+        # A session that finishes before the cutoff starts before it. That
+        # inequality is one query a cursor can resume, unlike != on the
+        # type, which runs as two.
+        sessions = Session.query(Session.startTime < cutoffTime)
+        #For each session that finishes before the cutoff time, add it to the list to return.
+        sessions, next_cursor, truncated = fetchWithin(sessions, budget, cursor,
+            lambda sess: sess.typeOfSession != request.sessionType and
+                cutoffTime > (sess.startTime + timedelta(minutes = sess.duration)))
+
+        return SessionForms(
+            items=[self._copySessionToForm(sess) for sess in sessions],
+            nextPageToken=next_cursor.urlsafe() if truncated else None,
+            truncated=truncated
+        )
 
     @endpoints.method(SESS_GET_BY_TYPE_REQUEST, SessionForms,
             path='getConferenceSessionsByType',
@@ -565,7 +1079,7 @@ class ConferenceApi(remote.Service):
         """Get conference sessions by conference and session type."""
         self._getLoggedInUser()
         
-        theConference = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        theConference = getConference(request.websafeConferenceKey)
         theSessions = Session.query(ancestor=theConference.key).filter(
             getattr(Session, "typeOfSession") == request.sessionType)
         
@@ -577,13 +1091,20 @@ class ConferenceApi(remote.Service):
             path='getConferenceSessionsBySpeaker',
             http_method='POST', name='getConferenceSessionsBySpeaker')
     def getConferenceSessionsBySpeaker(self, request):
-        """Get conference sessions by speaker."""
+        """Get conference sessions by speaker; truncated, with a pageToken
+        to resume from, when the request budget runs out."""
         self._getLoggedInUser()
-            
-        theSessions = Session.query(getattr(Session, "speaker") == request.speaker)
+        budget = RequestBudget(request.maxResults)
+        cursor = self._pageCursor(request.pageToken)
+
+        theSessions, next_cursor, truncated = fetchWithin(
+            Session.query(getattr(Session, "speaker") == request.speaker),
+            budget, cursor)
         
         return SessionForms(
-            items=[self._copySessionToForm(oneSession) for oneSession in theSessions]
+            items=[self._copySessionToForm(oneSession) for oneSession in theSessions],
+            nextPageToken=next_cursor.urlsafe() if truncated else None,
+            truncated=truncated
         )
         
     @endpoints.method(SESS_GET_REQUEST, SessionForms,
@@ -593,6 +1114,20 @@ class ConferenceApi(remote.Service):
         """Add a session to a user's wishist by session websafe key."""
         return self._addSessionToWishlist(request)
             
+    @endpoints.method(message_types.VoidMessage, SessionForms,
+            path='sessions/recommended', http_method='GET',
+            name='getRecommendedSessions')
+    def getRecommendedSessions(self, request):
+        """Return sessions often wishlisted by those who wishlisted yours."""
+        prof = self._getProfileFromUser()
+        wishlisted = [entry.wishlistedSessionKey for entry in
+            UserWishlist.query(ancestor=prof.key).fetch(limit=None)]
+        recommended = getSessions([ndb.Key(urlsafe=wssk)
+            for wssk in recommendedSessionKeys(wishlisted)])
+        return SessionForms(items=[self._copySessionToForm(theSession)
+            for theSession in recommended if theSession])
+
+
     @endpoints.method(message_types.VoidMessage, SessionForms,
             path='getSessionsInWishlist', http_method="GET",
             name="getSessionsInWishlist")
@@ -603,13 +1138,14 @@ class ConferenceApi(remote.Service):
         user = self._getLoggedInUser()
         user_id = getUserId(user)
         
-        prof = ndb.Key(Profile, user_id).get()
+        prof = getProfile(ndb.Key(Profile, user_id))
         
         return self._getUserWishlistByProfile(prof)
         
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
+        """Return formatted query from the submitted filters, and the
+        formatted filters."""
         q = Conference.query()
         inequality_filter, filters = self._formatFilters(request.filters)
 
@@ -625,7 +1161,7 @@ class ConferenceApi(remote.Service):
                 filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
-        return q
+        return q, filters
 
 
     def _formatFilters(self, filters):
@@ -662,7 +1198,20 @@ class ConferenceApi(remote.Service):
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        q, filters = self._getQuery(request)
+        forms = ConferenceForms()
+        conferences = []
+        # archive pages come after the one with every live result
+        if not self._archiveCursor(request.pageToken):
+            conferences = searchConferences(q, filters)
+        if request.includeArchived:
+            # ended conferences live in their own kind; see archive.py.
+            # Merged in the order the query sorts on
+            inequality = next((filtr['field'] for filtr in filters
+                               if filtr['operator'] != '='), None)
+            conferences = sorted(conferences + self._withArchive(
+                forms, filters, request.pageToken, inequality),
+                key=sortKey(filters, inequality))
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
@@ -672,13 +1221,13 @@ class ConferenceApi(remote.Service):
         # put display names in a dict for easier fetching
         names = {}
         for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+            if profile:
+                names[profile.key.id()] = profile.displayName
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
-        )
+        forms.items = [self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                       for conf in conferences]
+        return forms
 
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
@@ -694,6 +1243,8 @@ class ConferenceApi(remote.Service):
                     setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
+        pf.conferenceKeysToAttend = [
+            c_key.urlsafe() for c_key in self._getConferenceKeysToAttend(prof)]
         pf.check_initialized()
         return pf
 
@@ -703,23 +1254,22 @@ class ConferenceApi(remote.Service):
         # make sure user is authed
         user = self._getLoggedInUser()
 
-        # get Profile from datastore
+        # get Profile from the instance cache or datastore
         user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
+        profile = getProfile(ndb.Key(Profile, user_id))
+        # create new Profile if not there; get_or_insert makes concurrent
+        # first requests agree on a single profile
         if not profile:
-            profile = Profile(
-                key = p_key,
+            profile = Profile.get_or_insert(user_id,
                 displayName = user.nickname(),
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
 
         return profile 
 
 
+    @unitOfWork
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
@@ -727,12 +1277,19 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            oldSize = prof.teeShirtSize
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
                     if val:
                         setattr(prof, field, str(val))
-                        prof.put()
+                        current().put(prof)
+            current().afterFlush(invalidateProfiles, [prof.key])
+
+            # move this user's registrations over to the new size
+            if prof.teeShirtSize != oldSize:
+                current().addTask('/tasks/update_tee_shirt_tallies',
+                    params={'websafeProfileKey': prof.key.urlsafe()})
 
         return self._copyProfileToForm(prof)
 
@@ -754,10 +1311,8 @@ class ConferenceApi(remote.Service):
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
+    def _computeAnnouncement():
+        """Return the Announcement for nearly sold out conferences, or ""."""
         confs = Conference.query(ndb.AND(
             Conference.seatsAvailable <= 5,
             Conference.seatsAvailable > 0)
@@ -765,17 +1320,20 @@ class ConferenceApi(remote.Service):
 
         if confs:
             # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
+            # format announcement
+            return ANNOUNCEMENT_TPL % (
                 ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        # an empty announcement is cached too, so it isn't recomputed
+        return ""
+
 
-        return announcement
+    @staticmethod
+    def _cacheAnnouncement():
+        """Create Announcement & assign to memcache; used by
+        memcache cron job & putAnnouncement().
+        """
+        return refreshCached(MEMCACHE_ANNOUNCEMENTS_KEY,
+            ConferenceApi._computeAnnouncement, ANNOUNCEMENT_TTL) or ""
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
@@ -783,12 +1341,14 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        return StringMessage(data=getCached(MEMCACHE_ANNOUNCEMENTS_KEY,
+            ConferenceApi._computeAnnouncement, ANNOUNCEMENT_TTL) or "")
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
     @ndb.transactional(xg=True)
+    @unitOfWork
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
@@ -797,15 +1357,29 @@ class ConferenceApi(remote.Service):
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = getConference(wsck)
         if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % wsck)
+            raise self._conferenceNotFound(wsck)
+
+        # look up the ledger entry directly by key; profiles that have not
+        # been migrated yet may still carry the legacy string list, and a
+        # moved conference may still be registered under its former key
+        c_keys = [conf.key] + ([conf.formerKey] if conf.formerKey else [])
+        r_key = Registration.keyFor(conf.key, prof.key)
+        t_key = TeeShirtTally.keyFor(conf.key)
+        found = ndb.get_multi([t_key] +
+            [Registration.keyFor(c_key, prof.key) for c_key in c_keys])
+        tally = found[0] or TeeShirtTally(key=t_key)
+        registration = next((r for r in found[1:] if r), None)
+        legacy = next((c_key.urlsafe() for c_key in c_keys
+            if c_key.urlsafe() in prof.conferenceKeysToAttend), None)
+        uow = current()
+        uow.put(conf)
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registration or legacy:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -814,37 +1388,144 @@ class ConferenceApi(remote.Service):
                 raise ConflictException(
                     "There are no seats available.")
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
+            # register user, take away one seat, count the t-shirt
+            uow.put(Registration(key=r_key, conference=conf.key,
+                profile=prof.key, teeShirtSize=prof.teeShirtSize))
+            tally.adjust(prof.teeShirtSize, 1)
+            uow.put(tally)
             conf.seatsAvailable -= 1
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if registration or legacy:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
+                if registration:
+                    uow.delete(registration.key)
+                    # delta sync clients learn of it from the tombstone
+                    uow.put(registrationTombstone(registration.key))
+                    if registration.teeShirtSize:
+                        tally.adjust(registration.teeShirtSize, -1)
+                        uow.put(tally)
+                if legacy:
+                    prof.conferenceKeysToAttend.remove(legacy)
+                    uow.put(prof)
+                    uow.afterFlush(invalidateProfiles, [prof.key])
                 conf.seatsAvailable += 1
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # the unit of work writes everything back when this returns
         return BooleanMessage(data=retval)
 
 
+    def _getConferenceKeysToAttend(self, prof):
+        """Return keys of the conferences prof is registered for."""
+        # ancestor keys-only query, so this is strongly consistent and cheap
+        reg_keys = Registration.query(ancestor=prof.key).fetch(keys_only=True)
+        conf_keys = [ndb.Key(urlsafe=r_key.id()) for r_key in reg_keys]
+
+        # include legacy entries until the profile has been migrated
+        for wsck in prof.conferenceKeysToAttend:
+            c_key = ndb.Key(urlsafe=wsck)
+            if c_key not in conf_keys:
+                conf_keys.append(c_key)
+        return currentConferenceKeys(conf_keys)
+
+
+    @staticmethod
+    def _updateTeeShirtTallies(p_key):
+        """Recount a profile's registrations under its current t-shirt size;
+        used by the update_tee_shirt_tallies task.
+        """
+        for r_key in Registration.query(ancestor=p_key).fetch(keys_only=True):
+            ConferenceApi._moveTeeShirtSize(r_key)
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _moveTeeShirtSize(r_key):
+        """Move one registration's tally count to the profile's size."""
+        registration, prof = ndb.get_multi([r_key, r_key.parent()])
+        if not registration or not prof or \
+                registration.teeShirtSize == prof.teeShirtSize:
+            return
+
+        t_key = TeeShirtTally.keyFor(
+            currentConferenceKeys([registration.conference])[0])
+        tally = t_key.get() or TeeShirtTally(key=t_key)
+        if registration.teeShirtSize:
+            tally.adjust(registration.teeShirtSize, -1)
+        tally.adjust(prof.teeShirtSize, 1)
+        registration.teeShirtSize = prof.teeShirtSize
+        ndb.put_multi([registration, tally])
+
+
+    @staticmethod
+    def _migrateRegistrations(cursor=None):
+        """Move one batch of legacy Profile.conferenceKeysToAttend lists
+        into Registration entities; return the cursor for the next batch,
+        or None when done. Used by the migrate_registrations task.
+        """
+        p_keys, next_cursor, more = Profile.query().fetch_page(
+            REGISTRATION_MIGRATION_BATCH, start_cursor=cursor, keys_only=True)
+        for p_key in p_keys:
+            while ConferenceApi._migrateProfileRegistrations(p_key):
+                pass
+        return next_cursor if more else None
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _migrateProfileRegistrations(p_key):
+        """Move the first REGISTRATION_MIGRATION_GROUPS legacy entries of a
+        profile into Registrations, counted in their conferences'
+        TeeShirtTallies; return whether any entries are left.
+        """
+        # re-read in the transaction, so a concurrent unregister or
+        # saveProfile either lands first or makes this retry
+        prof = p_key.get()
+        if not prof or not prof.conferenceKeysToAttend:
+            return False
+
+        # the profile's group plus a ConferenceMove and a tally group per
+        # conference must stay within the cross-group transaction limit
+        wscks = prof.conferenceKeysToAttend[:REGISTRATION_MIGRATION_GROUPS]
+        c_keys = currentConferenceKeys([ndb.Key(urlsafe=wsck) for wsck in wscks])
+        r_keys = [Registration.keyFor(c_key, p_key) for c_key in c_keys]
+        found = ndb.get_multi(r_keys +
+            [TeeShirtTally.keyFor(c_key) for c_key in c_keys])
+
+        registrations = {}
+        tallies = {}
+        for c_key, r_key, registration, tally in zip(c_keys, r_keys,
+                found[:len(r_keys)], found[len(r_keys):]):
+            # an existing Registration is already in the tally
+            if registration or r_key in registrations:
+                continue
+            registrations[r_key] = Registration(key=r_key, conference=c_key,
+                profile=p_key, teeShirtSize=prof.teeShirtSize)
+            t_key = TeeShirtTally.keyFor(c_key)
+            tally = tallies.setdefault(t_key, tally or TeeShirtTally(key=t_key))
+            tally.adjust(prof.teeShirtSize, 1)
+
+        del prof.conferenceKeysToAttend[:len(wscks)]
+        ndb.put_multi(registrations.values() + tallies.values() + [prof])
+        invalidateProfiles([p_key])
+        return bool(prof.conferenceKeysToAttend)
+
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        conf_keys = self._getConferenceKeysToAttend(prof)
+        conferences = [conf for conf in getConferences(conf_keys) if conf]
 
         # get organizers
         organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
@@ -853,10 +1534,11 @@ class ConferenceApi(remote.Service):
         # put display names in a dict for easier fetching
         names = {}
         for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+            if profile:
+                names[profile.key.id()] = profile.displayName
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
+        return ConferenceForms(items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))\
          for conf in conferences]
         )
 
@@ -877,20 +1559,129 @@ class ConferenceApi(remote.Service):
         return self._conferenceRegistration(request, reg=False)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONF_ATTENDEES_REQUEST, AttendeeForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Return one page of attendees; only the organizer may ask."""
+        user = self._getLoggedInUser()
+        user_id = getUserId(user)
+
+        conf = getConference(request.websafeConferenceKey)
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the attendees.')
+
+        cursor = self._pageCursor(request.pageToken)
+
+        # keys-only page of the ledger; the parent of each key is the
+        # attendee. A moved conference may still have registrations under
+        # its former key; cursors over both need the __key__ order
+        c_keys = [conf.key] + ([conf.formerKey] if conf.formerKey else [])
+        reg_keys, next_cursor, more = Registration.query(
+            Registration.conference.IN(c_keys)).order(
+            Registration.key).fetch_page(
+            request.pageSize or ATTENDEES_PAGE_SIZE,
+            start_cursor=cursor, keys_only=True)
+        profiles = ndb.get_multi([r_key.parent() for r_key in reg_keys])
+
+        return AttendeeForms(
+            items=[AttendeeForm(displayName=prof.displayName,
+                mainEmail=prof.mainEmail) for prof in profiles if prof],
+            nextPageToken=next_cursor.urlsafe() if more and next_cursor else None
+        )
+
+
+    @endpoints.method(CONF_GET_REQUEST, TeeShirtTallyForm,
+            path='conference/{websafeConferenceKey}/teeShirtTally',
+            http_method='GET', name='getTeeShirtTally')
+    def getTeeShirtTally(self, request):
+        """Return attendee counts per t-shirt size; only the organizer may ask."""
+        user = self._getLoggedInUser()
+        user_id = getUserId(user)
+
+        c_key = currentConferenceKeys([ndb.Key(urlsafe=request.websafeConferenceKey)])[0]
+        conf, tally = ndb.get_multi([c_key, TeeShirtTally.keyFor(c_key)])
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can see the t-shirt tally.')
+
+        return TeeShirtTallyForm(
+            websafeConferenceKey=c_key.urlsafe(),
+            items=[TeeShirtCountForm(size=getattr(TeeShirtSize, entry.size),
+                count=entry.count) for entry in (tally.counts if tally else [])
+                if entry.count > 0]
+        )
+
+
+    @endpoints.method(SYNC_REQUEST, ChangesForm, path='sync',
+            http_method='GET', name='getChangesSince')
+    def getChangesSince(self, request):
+        """Return what changed since syncToken, one page at a time; with
+        no syncToken, return everything (see sync.py)."""
+        prof = self._getProfileFromUser()
+        try:
+            entities, nextPageToken, syncToken, reset = changesSince(
+                prof, request.syncToken, request.pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid syncToken or pageToken")
+
+        # need to fetch organiser displayName from profiles
+        organisers = [ndb.Key(Profile, entity.organizerUserId)
+                      for entity in entities if isinstance(entity, Conference)]
+        names = dict((profile.key.id(), profile.displayName)
+                     for profile in ndb.get_multi(organisers) if profile)
+
+        # registrations may still name a moved conference by its old key
+        registered = [entity.conference for entity in entities
+                      if isinstance(entity, Registration)]
+        registered = iter(currentConferenceKeys(registered))
+
+        changes = ChangesForm(nextPageToken=nextPageToken,
+                              syncToken=syncToken, reset=reset)
+        for entity in entities:
+            if isinstance(entity, Conference):
+                changes.conferences.append(self._copyConferenceToForm(
+                    entity, names.get(entity.organizerUserId)))
+            elif isinstance(entity, Session):
+                changes.sessions.append(self._copySessionToForm(entity))
+            elif isinstance(entity, Profile):
+                changes.profile = self._copyProfileToForm(entity)
+            elif isinstance(entity, UserWishlist):
+                changes.wishlist.append(entity.wishlistedSessionKey)
+            elif isinstance(entity, Registration):
+                changes.registrations.append(next(registered).urlsafe())
+            else:
+                changes.deleted.append(DeletedForm(kind=entity.kind,
+                                                   websafeKey=entity.websafeKey))
+        return changes
+
+
+    @endpoints.method(FILTER_PLAYGROUND_REQUEST, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
     def filterPlayground(self, request):
         """Filter Playground"""
+        budget = RequestBudget(request.maxResults)
+        cursor = self._pageCursor(request.pageToken)
         q = Conference.query()
         q = q.filter(Conference.city=="London")
         q = q.filter(Conference.topics=="Medical Innovations")
         q = q.filter(Conference.month==6)
+        confs, next_cursor, truncated = fetchWithin(q, budget, cursor)
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf, "") for conf in confs],
+            nextPageToken=next_cursor.urlsafe() if truncated else None,
+            truncated=truncated
         )
         
 
 
-api = endpoints.api_server([ConferenceApi]) # register API
+api = profiled(endpoints.api_server([ConferenceApi])) # register API
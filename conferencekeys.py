@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""conferencekeys.py
+
+Conference key layout. Conferences used to be created as children of
+their organizer's Profile, which put all of one organizer's conferences
+and sessions in a single entity group. They are now root entities with an
+`organizer` KeyProperty; sessions stay children of their conference.
+
+The migration below moves each old conference, together with its sessions
+and t-shirt tally, to a new root key in one transaction and leaves a
+ConferenceMove record keyed by the old websafe key. Until the follow-up
+phases have rewritten Registrations and UserWishlist entries, and for
+clients still holding old keys, the get helpers here follow those records.
+The last phase recounts the statistics of each moved conference under its
+new keys, once the wishlists point there, and drops those under the old.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceMove
+from models import Profile
+from models import Registration
+from models import Session
+from models import TeeShirtTally
+from models import UserWishlist
+
+from searchcache import bumpGenerations
+from stats import moveConferenceStats
+from sync import registrationTombstone
+from sync import tombstones
+
+MIGRATION_BATCH = 50
+MIGRATION_PHASES = ('conferences', 'registrations', 'wishlists', 'stats')
+
+
+def _isOldLayout(c_key):
+    return c_key.parent() is not None
+
+
+def currentConferenceKeys(c_keys):
+    """Return c_keys with moved conferences replaced by their new keys."""
+    old = [c_key for c_key in c_keys if _isOldLayout(c_key)]
+    if not old:
+        return list(c_keys)
+    moves = ndb.get_multi([ndb.Key(ConferenceMove, c_key.urlsafe())
+                           for c_key in old])
+    newKeys = dict((c_key, move.newKey) for c_key, move in zip(old, moves)
+                   if move and move.done)
+    return [newKeys.get(c_key, c_key) for c_key in c_keys]
+
+
+def getConference(websafeConferenceKey):
+    """Return the Conference for a websafe key, old or new, or None; also
+    None for keys of any other kind, such as ArchivedConference."""
+    c_key = ndb.Key(urlsafe=websafeConferenceKey)
+    if c_key.kind() != 'Conference':
+        return None
+    conf = c_key.get()
+    if conf is None and _isOldLayout(c_key):
+        move = ndb.Key(ConferenceMove, c_key.urlsafe()).get()
+        if move and move.done:
+            conf = move.newKey.get()
+    return conf
+
+
+def getConferences(c_keys):
+    """Return the Conferences for c_keys, old or new; None where missing."""
+    confs = ndb.get_multi(c_keys)
+    missing = [c_key for c_key, conf in zip(c_keys, confs)
+               if conf is None and _isOldLayout(c_key)]
+    if not missing:
+        return confs
+    moved = dict(zip(missing, ndb.get_multi(currentConferenceKeys(missing))))
+    return [conf or moved.get(c_key) for c_key, conf in zip(c_keys, confs)]
+
+
+def getSessions(s_keys):
+    """Return the Sessions for s_keys, old or new; None where missing."""
+    sessions = ndb.get_multi(s_keys)
+    missing = [s_key for s_key, sess in zip(s_keys, sessions)
+               if sess is None and _isOldLayout(s_key.parent())]
+    if not missing:
+        return sessions
+    confKeys = currentConferenceKeys([s_key.parent() for s_key in missing])
+    moved = dict(zip(missing, ndb.get_multi([
+        ndb.Key(Session, s_key.id(), parent=c_key)
+        for s_key, c_key in zip(missing, confKeys)])))
+    return [sess or moved.get(s_key) for s_key, sess in zip(s_keys, sessions)]
+
+
+# - - - Migration - - - - - - - - - - - - - - - - - - - - - - -
+
+def moveConference(old_key):
+    """Move one old-layout Conference to a root key; return the new key."""
+    move = ConferenceMove.get_or_insert(old_key.urlsafe(),
+        newKey=ndb.Key(Conference, Conference.allocate_ids(size=1)[0]))
+    if not move.done:
+        _flipConference(old_key, move.key)
+    return move.newKey
+
+
+@ndb.transactional(xg=True)
+def _flipConference(old_key, m_key):
+    # writing both groups in one transaction makes any registration or
+    # update that read the old conference retry against the new one
+    old, move = ndb.get_multi([old_key, m_key])
+    if old is None or move.done:
+        return
+    new_key = move.newKey
+    sessions = Session.query(ancestor=old_key).fetch()
+    tally = TeeShirtTally.keyFor(old_key).get()
+
+    data = old.to_dict()
+    data.update(organizer=ndb.Key(Profile, old.organizerUserId),
+                formerKey=old_key)
+    toPut = [Conference(key=new_key, **data)]
+    toPut += [Session(key=ndb.Key(Session, sess.key.id(), parent=new_key),
+                      **sess.to_dict()) for sess in sessions]
+    if tally:
+        toPut.append(TeeShirtTally(key=TeeShirtTally.keyFor(new_key),
+                                   counts=tally.counts))
+    move.done = True
+    toPut.append(move)
+    # synced clients see the moved entities as new ones; tell them to
+    # drop the copies under the old keys
+    toPut += tombstones([old_key] + [sess.key for sess in sessions])
+
+    ndb.put_multi(toPut)
+    ndb.delete_multi([old_key, TeeShirtTally.keyFor(old_key)] +
+                     [sess.key for sess in sessions])
+    bumpGenerations()
+
+
+@ndb.transactional
+def _moveRegistration(r_key, new_conf_key):
+    # old and new Registration share the attendee's Profile entity group
+    registration = r_key.get()
+    if registration is None:
+        return
+    Registration(key=Registration.keyFor(new_conf_key, r_key.parent()),
+                 conference=new_conf_key, profile=registration.profile,
+                 created=registration.created,
+                 teeShirtSize=registration.teeShirtSize).put()
+    r_key.delete()
+    # delta sync clients drop the old conference key from the tombstone
+    registrationTombstone(r_key).put()
+
+
+def _migrateConferences(cursor):
+    confs, next_cursor, more = Conference.query().fetch_page(
+        MIGRATION_BATCH, start_cursor=cursor, keys_only=True)
+    for c_key in confs:
+        if _isOldLayout(c_key):
+            moveConference(c_key)
+    return next_cursor, more
+
+
+def _migrateRegistrations(cursor):
+    registrations, next_cursor, more = Registration.query().fetch_page(
+        MIGRATION_BATCH, start_cursor=cursor)
+    old = [r for r in registrations if _isOldLayout(r.conference)]
+    newKeys = currentConferenceKeys([r.conference for r in old])
+    for registration, new_key in zip(old, newKeys):
+        if not _isOldLayout(new_key):
+            _moveRegistration(registration.key, new_key)
+    return next_cursor, more
+
+
+def _migrateWishlists(cursor):
+    entries, next_cursor, more = UserWishlist.query().fetch_page(
+        MIGRATION_BATCH, start_cursor=cursor)
+    old = [(entry, ndb.Key(urlsafe=entry.wishlistedSessionKey))
+           for entry in entries]
+    old = [(entry, s_key) for entry, s_key in old
+           if _isOldLayout(s_key.parent())]
+    newKeys = currentConferenceKeys([s_key.parent() for entry, s_key in old])
+    changed = []
+    for (entry, s_key), c_key in zip(old, newKeys):
+        if not _isOldLayout(c_key):
+            entry.wishlistedSessionKey = ndb.Key(
+                Session, s_key.id(), parent=c_key).urlsafe()
+            changed.append(entry)
+    ndb.put_multi(changed)
+    return next_cursor, more
+
+
+def _migrateStats(cursor):
+    moves, next_cursor, more = ConferenceMove.query().fetch_page(
+        MIGRATION_BATCH, start_cursor=cursor)
+    moves = [move for move in moves if move.done]
+    confs = ndb.get_multi([move.newKey for move in moves])
+    for move, conf in zip(moves, confs):
+        if conf:
+            moveConferenceStats(ndb.Key(urlsafe=move.key.id()), conf)
+    return next_cursor, more
+
+
+def migrateConferenceKeys(phase=MIGRATION_PHASES[0], cursor=None):
+    """Run one batch of a migration phase; return the (phase, cursor) to
+    continue with, or None when the migration is complete. Used by the
+    migrate_conference_keys task.
+    """
+    step = {
+        'conferences': _migrateConferences,
+        'registrations': _migrateRegistrations,
+        'wishlists': _migrateWishlists,
+        'stats': _migrateStats,
+    }[phase]
+    next_cursor, more = step(cursor)
+    if more and next_cursor:
+        return phase, next_cursor
+
+    following = MIGRATION_PHASES.index(phase) + 1
+    if following < len(MIGRATION_PHASES):
+        return MIGRATION_PHASES[following], None
+    return None
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""geo.py
+
+Geohash encoding, radius coverings and distances for conference
+proximity search, plus a local table of city coordinates so conferences
+can be placed without an external geocoder.
+
+A conference stores the geohash of its location at every precision from
+1 to GEOHASH_PRECISION, so an equality filter on any one cell finds the
+conferences inside it. A radius is covered by every cell that overlaps
+the circle's latitude/longitude bounding box, at the finest precision
+that needs no more than MAX_COVERING_CELLS of them. Near the poles the
+box spans far more longitude than latitude, so it can take many cells
+even at precision 1; a circle reaching a pole spans every longitude.
+
+"""
+
+import math
+
+GEOHASH_PRECISION = 7
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+MAX_RADIUS_KM = 2000
+MAX_COVERING_CELLS = 16
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+CITY_COORDINATES = {
+    'Amsterdam': (52.3702, 4.8952),
+    'Atlanta': (33.7490, -84.3880),
+    'Austin': (30.2672, -97.7431),
+    'Bangalore': (12.9716, 77.5946),
+    'Barcelona': (41.3851, 2.1734),
+    'Beijing': (39.9042, 116.4074),
+    'Berlin': (52.5200, 13.4050),
+    'Boston': (42.3601, -71.0589),
+    'Buenos Aires': (-34.6037, -58.3816),
+    'Cape Town': (-33.9249, 18.4241),
+    'Chicago': (41.8781, -87.6298),
+    'Copenhagen': (55.6761, 12.5683),
+    'Dallas': (32.7767, -96.7970),
+    'Denver': (39.7392, -104.9903),
+    'Dubai': (25.2048, 55.2708),
+    'Dublin': (53.3498, -6.2603),
+    'Hong Kong': (22.3193, 114.1694),
+    'Istanbul': (41.0082, 28.9784),
+    'Las Vegas': (36.1699, -115.1398),
+    'Lisbon': (38.7223, -9.1393),
+    'London': (51.5074, -0.1278),
+    'Los Angeles': (34.0522, -118.2437),
+    'Madrid': (40.4168, -3.7038),
+    'Melbourne': (-37.8136, 144.9631),
+    'Mexico City': (19.4326, -99.1332),
+    'Miami': (25.7617, -80.1918),
+    'Montreal': (45.5017, -73.5673),
+    'Moscow': (55.7558, 37.6173),
+    'Mumbai': (19.0760, 72.8777),
+    'Munich': (48.1351, 11.5820),
+    'New York': (40.7128, -74.0060),
+    'Oslo': (59.9139, 10.7522),
+    'Paris': (48.8566, 2.3522),
+    'Portland': (45.5152, -122.6784),
+    'Prague': (50.0755, 14.4378),
+    'Rome': (41.9028, 12.4964),
+    'San Diego': (32.7157, -117.1611),
+    'San Francisco': (37.7749, -122.4194),
+    'Sao Paulo': (-23.5505, -46.6333),
+    'Seattle': (47.6062, -122.3321),
+    'Seoul': (37.5665, 126.9780),
+    'Shanghai': (31.2304, 121.4737),
+    'Singapore': (1.3521, 103.8198),
+    'Stockholm': (59.3293, 18.0686),
+    'Sydney': (-33.8688, 151.2093),
+    'Tel Aviv': (32.0853, 34.7818),
+    'Tokyo': (35.6762, 139.6503),
+    'Toronto': (43.6532, -79.3832),
+    'Vancouver': (49.2827, -123.1207),
+    'Vienna': (48.2082, 16.3738),
+    'Warsaw': (52.2297, 21.0122),
+    'Washington': (38.9072, -77.0369),
+    'Zurich': (47.3769, 8.5417),
+}
+_CITY_INDEX = dict((city.lower(), coords)
+                   for city, coords in CITY_COORDINATES.iteritems())
+
+
+def cityCoordinates(city):
+    """Return (lat, lng) for a known city name, or None."""
+    if not city:
+        return None
+    return _CITY_INDEX.get(city.strip().lower())
+
+
+def encode(lat, lng, precision=GEOHASH_PRECISION):
+    """Return the geohash of a point."""
+    latRange, lngRange = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = bit = 0
+    even = True
+    while len(chars) < precision:
+        rng, value = (lngRange, lng) if even else (latRange, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            rng[0] = mid
+        else:
+            bits = bits * 2
+            rng[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(_BASE32[bits])
+            bits = bit = 0
+    return ''.join(chars)
+
+
+def prefixes(geohash):
+    """Return every prefix of geohash, shortest first; this is what a
+    conference stores so it can be found by cells of any precision."""
+    return [geohash[:i] for i in range(1, len(geohash) + 1)]
+
+
+def _cellSize(precision):
+    """Return (height, width) in degrees of cells at precision."""
+    lngBits = (5 * precision + 1) // 2
+    latBits = 5 * precision // 2
+    return 180.0 / 2 ** latBits, 360.0 / 2 ** lngBits
+
+
+def _boundingBox(lat, lng, radiusKm):
+    """Return (south, north, west, east) in degrees bounding the circle;
+    west > east when it crosses the antimeridian, and both are None when
+    it spans every longitude."""
+    angle = radiusKm / EARTH_RADIUS_KM
+    dLat = math.degrees(angle)
+    south, north = max(-90.0, lat - dLat), min(90.0, lat + dLat)
+    if south <= -90.0 or north >= 90.0:
+        return south, north, None, None
+    # widest longitude offset of a spherical cap
+    dLng = math.degrees(math.asin(min(1.0,
+        math.sin(angle) / math.cos(math.radians(lat)))))
+    if dLng >= 180.0:
+        return south, north, None, None
+    west = (lng - dLng + 180.0) % 360.0 - 180.0
+    east = (lng + dLng + 180.0) % 360.0 - 180.0
+    return south, north, west, east
+
+
+def _cellRange(start, end, size, origin, count):
+    """Return the (first, last) grid indexes of cells of size from start
+    to end."""
+    first = int(math.floor((start - origin) / size))
+    last = int(math.floor((end - origin) / size))
+    return max(first, 0), min(last, count - 1)
+
+
+def _gridRanges(box, precision):
+    """Return the row range and the column ranges of the cells at
+    precision that overlap box."""
+    south, north, west, east = box
+    dLat, dLng = _cellSize(precision)
+    rows = int(round(180.0 / dLat))
+    columns = int(round(360.0 / dLng))
+    lats = _cellRange(south, north, dLat, -90.0, rows)
+    if west is None:
+        lngs = [(0, columns - 1)]
+    elif west <= east:
+        lngs = [_cellRange(west, east, dLng, -180.0, columns)]
+    else:
+        lngs = [_cellRange(west, 180.0, dLng, -180.0, columns),
+                _cellRange(-180.0, east, dLng, -180.0, columns)]
+    return lats, lngs
+
+
+def coveringCells(lat, lng, radiusKm):
+    """Return the geohash cells that together cover radiusKm around a point."""
+    box = _boundingBox(lat, lng, radiusKm)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lats, lngs = _gridRanges(box, precision)
+        count = (lats[1] - lats[0] + 1) * \
+            sum(last - first + 1 for first, last in lngs)
+        if count <= MAX_COVERING_CELLS:
+            break
+
+    # precision 1 is used however many cells it takes
+    dLat, dLng = _cellSize(precision)
+    return sorted(set(
+        encode(-90.0 + (i + 0.5) * dLat, -180.0 + (j + 0.5) * dLng, precision)
+        for i in range(lats[0], lats[1] + 1)
+        for first, last in lngs for j in range(first, last + 1)))
+
+
+def distanceKm(lat1, lng1, lat2, lng2):
+    """Return the great-circle distance between two points in km."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dPhi = phi2 - phi1
+    dLambda = math.radians(lng2 - lng1)
+    a = math.sin(dPhi / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(dLambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
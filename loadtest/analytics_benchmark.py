@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+analytics_benchmark.py -- organizer report batch over a synthetic catalog
+
+Feeds generated Conference, Session and Registration pages, shaped like
+the pages computeOrganizerReports() reads, through the aggregation in
+analytics.py and reports the time taken and the peak resident memory.
+Pages are generated one at a time, so the peak is the batch's own.
+
+    python loadtest/analytics_benchmark.py \\
+        --sdk ~/google-cloud-sdk/platform/google_appengine
+
+"""
+
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TYPES = ('Keynote', 'Talk', 'Workshop', 'Lightning talk', 'Panel')
+CITIES = ('London', 'San Francisco', 'Berlin', 'Tokyo', 'New York', 'Paris')
+
+
+def _peakMB():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def conferencePages(models, ndb, rng, args):
+    for first in range(0, args.conferences, args.batch):
+        page = []
+        for i in range(first, min(first + args.batch, args.conferences)):
+            seats = rng.choice((100, 250, 500, 1000))
+            start = date(2016, 1, 1) + timedelta(days=rng.randint(0, 365))
+            page.append(models.Conference(
+                key=ndb.Key(models.Conference, i + 1),
+                name='Conference %d' % i,
+                organizerUserId='%021d' % rng.randint(0, args.organizers - 1),
+                topics=['topic %d' % rng.randint(0, args.topics - 1)
+                        for _ in range(rng.randint(1, 4))],
+                city=rng.choice(CITIES), startDate=start, month=start.month,
+                maxAttendees=seats, seatsAvailable=rng.randint(0, seats)))
+        yield page
+
+
+def sessionPages(models, ndb, rng, args):
+    total = args.conferences * args.sessions
+    for first in range(0, total, args.batch):
+        yield [models.Session(
+            key=ndb.Key(models.Conference, rng.randint(1, args.conferences),
+                        models.Session, i + 1),
+            typeOfSession=rng.choice(TYPES))
+            for i in range(first, min(first + args.batch, total))]
+
+
+def registrationPages(models, ndb, rng, args, now):
+    total = args.conferences * args.registrations
+    for first in range(0, total, args.batch):
+        yield [models.Registration(
+            conference=ndb.Key(models.Conference, rng.randint(1, args.conferences)),
+            profile=ndb.Key(models.Profile, str(i)),
+            created=now - timedelta(days=rng.randint(0, 365)))
+            for i in range(first, min(first + args.batch, total))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', help='App Engine SDK directory')
+    parser.add_argument('--conferences', type=int, default=100000,
+                        help='conferences in the catalog (default 100000)')
+    parser.add_argument('--organizers', type=int, default=5000,
+                        help='distinct organizers (default 5000)')
+    parser.add_argument('--topics', type=int, default=500,
+                        help='distinct topics (default 500)')
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference (default 10)')
+    parser.add_argument('--registrations', type=int, default=20,
+                        help='registrations per conference (default 20)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('APPLICATION_ID', 'dev~benchmark')
+    from google.appengine.ext import ndb
+    import analytics
+    import models
+
+    args.batch = analytics.ANALYTICS_BATCH
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    agg = analytics._Aggregator(now)
+    print 'baseline: %.1f MB' % _peakMB()
+
+    for label, pages, add in (
+            ('conferences', conferencePages(models, ndb, rng, args),
+             agg.addConferences),
+            ('sessions', sessionPages(models, ndb, rng, args), agg.addSessions),
+            ('registrations', registrationPages(models, ndb, rng, args, now),
+             agg.addRegistrations)):
+        start = time.time()
+        for page in pages:
+            add(page)
+        print '%-14s %8.1f s   peak %7.1f MB' % (label, time.time() - start,
+                                                 _peakMB())
+
+    start = time.time()
+    reports = sum(1 for _ in agg.reports())
+    print '%-14s %8.1f s   peak %7.1f MB   (%d reports)' % (
+        'reports', time.time() - start, _peakMB(), reports)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""
+index_audit.py -- index write amplification of the datastore models
+
+Replays loadtest scenarios in-process (see loadtest.py), tracing every
+datastore query and put on the way, then reports for each kind:
+
+- the index rows an average put wrote: built-in ones (one for the kind,
+  plus an ascending and a descending row per indexed property value)
+  and composite ones from index.yaml (one per combination of the listed
+  properties' values, for each ancestor with ancestor: yes);
+- indexed properties that no traced query filtered, sorted or projected
+  on, which are candidates for indexed=False;
+- index.yaml composites that no traced query needed, and traced queries
+  that no index serves, exactly or by merging composites that share
+  their sort order.
+
+Queries issued only by crons and tasks are traced too with --jobs, which
+runs those jobs once after the scenarios. Code that neither reaches
+still goes unseen, so check a property's callers before unindexing it.
+--search-shapes also lists the queryConferences filter combinations
+(equality filters on any search fields, plus an inequality on one more)
+that no index serves, whether or not a scenario sends them.
+
+    python loadtest/index_audit.py \\
+        --sdk ~/google-cloud-sdk/platform/google_appengine --jobs \\
+        --search-shapes
+
+The report for the current models and index.yaml is kept next to this
+file in index_audit.txt; run it again after changing either.
+
+"""
+
+import argparse
+import glob
+import itertools
+import os
+import sys
+import threading
+
+import loadtest
+
+ROOT = loadtest.ROOT
+EQUAL = 5       # datastore_pb.Query_Filter.EQUAL
+SEARCH_FIELDS = ('city', 'maxAttendees', 'month', 'topics')
+
+
+class Trace(object):
+    """Datastore queries and puts seen by a pre-call hook."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = {}       # query shape -> times run
+        self.puts = {}          # kind -> [entities, built-in rows, composite rows]
+        self.indexes = []
+
+    def hook(self, service, call, request, response):
+        if call == 'RunQuery':
+            shape = _shape(request)
+            with self.lock:
+                self.queries[shape] = self.queries.get(shape, 0) + 1
+        elif call == 'Put':
+            for entity in request.entity_list():
+                self._countPut(entity)
+
+    def _countPut(self, entity):
+        path = entity.key().path().element_list()
+        kind = path[-1].type()
+        values = {}
+        for prop in entity.property_list():
+            values[prop.name()] = values.get(prop.name(), 0) + 1
+        builtin = 1 + 2 * sum(values.itervalues())
+        composite = 0
+        for index in self.indexes:
+            if index.kind != kind:
+                continue
+            rows = len(path) if index.ancestor else 1
+            for prop in index.properties:
+                rows *= values.get(prop.name, 0)
+            composite += rows
+        with self.lock:
+            counts = self.puts.setdefault(kind, [0, 0, 0])
+            counts[0] += 1
+            counts[1] += builtin
+            counts[2] += composite
+
+
+def _shape(query):
+    """Return (kind, ancestor, equality properties, sort properties,
+    projection) for a datastore_pb.Query."""
+    equality = set()
+    inequality = []
+    for filtr in query.filter_list():
+        for prop in filtr.property_list():
+            if filtr.op() == EQUAL:
+                equality.add(prop.name())
+            elif prop.name() not in inequality:
+                inequality.append(prop.name())
+    orders = [order.property() for order in query.order_list()]
+    # an inequality property sorts first, whether or not it is ordered on
+    sort = inequality + [name for name in orders if name not in inequality]
+    sort = tuple(name for name in sort if name != '__key__')
+    return (query.kind(), query.has_ancestor(), tuple(sorted(equality)),
+            sort, tuple(sorted(query.property_name_list())))
+
+
+def _serving(shape, indexes):
+    """Return the index.yaml composites that together serve a query
+    shape, [] if built-in indexes do, or None if nothing does."""
+    kind, ancestor, equality, sort, projection = shape
+    equality = [name for name in equality if name not in sort]
+    needed = set(equality) | set(sort) | set(projection)
+    if len(needed) <= 1 and not (ancestor and sort) or \
+            (not sort and not projection):
+        return []   # one property, or only equality filters (merged built-ins)
+
+    candidates = [index for index in indexes if index.kind == kind and
+                  bool(index.ancestor) == ancestor]
+    names = lambda index: [prop.name for prop in index.properties]
+    sortLength = len(sort)
+    for index in candidates:
+        # equality properties, then the sort, then any other projected ones
+        props = names(index)
+        rest = props[len(equality) + sortLength:]
+        if sorted(props[:len(equality)]) == sorted(equality) and \
+                props[len(equality):len(equality) + sortLength] == list(sort) and \
+                set(rest) <= set(projection) and set(projection) <= set(props):
+            return [index]
+    if projection:
+        return None
+    # merge join: composites that each cover some of the equality
+    # properties, followed by the same sort properties
+    parts, covered = [], set()
+    for index in candidates:
+        props = names(index)
+        prefix = props[:len(props) - sortLength]
+        if props[len(props) - sortLength:] == list(sort) and prefix and \
+                set(prefix) <= set(equality) and not set(prefix) <= covered:
+            parts.append(index)
+            covered |= set(prefix)
+    return parts if covered == set(equality) else None
+
+
+def searchShapes():
+    """Return the query shapes of every queryConferences filter
+    combination, as ConferenceApi._getQuery builds them."""
+    shapes = []
+    for n in range(len(SEARCH_FIELDS) + 1):
+        for equality in itertools.combinations(SEARCH_FIELDS, n):
+            for inequality in [None] + [field for field in SEARCH_FIELDS
+                                        if field not in equality]:
+                sort = (inequality, 'name') if inequality else ('name',)
+                shapes.append(('Conference', False, equality, sort, ()))
+    return shapes
+
+
+def backgroundJobs():
+    """Return (name, callable) for the crons and tasks that query."""
+    import analytics
+    import archive
+    import conference
+    import recommend
+    import suggest
+    import sync
+
+    def recommendations():
+        recommend.startRecommendations()
+        recommend.computeRecommendations()
+
+    def vocabulary():
+        for field in suggest.SUGGEST_FIELDS:
+            suggest.recountVocabulary(field)
+
+    def organizerReports():
+        run, step = analytics.newReportRun(), 0
+        while step is not None:
+            step = analytics.computeOrganizerReports(run, step)
+
+    return [
+        ('archive_conferences', archive.archiveEnded),
+        ('compute_recommendations', recommendations),
+        ('purge_tombstones', sync.purgeTombstones),
+        ('rebuild_vocabulary', vocabulary),
+        ('reconcile_stats', conference.ConferenceApi._reconcileStats),
+        ('announcement', conference.ConferenceApi._computeAnnouncement),
+        ('featured_speakers', conference.ConferenceApi._refreshFeaturedSpeakers),
+        ('organizer_reports', organizerReports),
+    ]
+
+
+def modelIndexes():
+    """Return {kind: sorted indexed property names} from models.py."""
+    import models
+    from google.appengine.ext import ndb
+    result = {}
+    for name in dir(models):
+        model = getattr(models, name)
+        if isinstance(model, type) and issubclass(model, ndb.Model) and \
+                model is not ndb.Model:
+            result[model._get_kind()] = sorted(
+                prop._name for prop in model._properties.itervalues()
+                if prop._indexed and
+                not isinstance(prop, ndb.LocalStructuredProperty))
+    return result
+
+
+def report(trace, models, shapes=()):
+    indexes = trace.indexes
+    used = set()
+    missing = []
+    queried = {}
+    for shape, count in sorted(trace.queries.iteritems()):
+        kind, ancestor, equality, sort, projection = shape
+        queried.setdefault(kind, set()).update(equality + sort + projection)
+        serving = _serving(shape, indexes)
+        if serving is None:
+            missing.append((shape, count))
+        else:
+            used.update(id(index) for index in serving)
+
+    print 'Index rows per put'
+    print '%-28s %8s %10s %10s %8s' % ('kind', 'puts', 'built-in',
+                                       'composite', 'total')
+    for kind, (puts, builtin, composite) in sorted(trace.puts.iteritems()):
+        print '%-28s %8d %10.1f %10.1f %8.1f' % (kind, puts,
+            float(builtin) / puts, float(composite) / puts,
+            float(builtin + composite) / puts)
+
+    print
+    print 'Indexed properties no traced query uses'
+    for kind, props in sorted(models.iteritems()):
+        unused = [prop for prop in props if prop not in queried.get(kind, ())]
+        if unused and kind in trace.puts:
+            print '  %s: %s' % (kind, ', '.join(unused))
+
+    print
+    print 'index.yaml composites no traced query needed'
+    for index in indexes:
+        if id(index) not in used:
+            print '  %s(%s%s)' % (index.kind,
+                'ancestor, ' if index.ancestor else '',
+                ', '.join(prop.name for prop in index.properties))
+
+    print
+    print 'Traced queries no index serves'
+    for (kind, ancestor, equality, sort, projection), count in missing:
+        print '  %s x%d: ancestor=%s equality=%s sort=%s projection=%s' % (
+            kind, count, ancestor, list(equality), list(sort), list(projection))
+
+    if shapes:
+        unserved = [shape for shape in shapes
+                    if _serving(shape, indexes) is None]
+        print
+        print 'queryConferences filter combinations no index serves: %d of %d' % (
+            len(unserved), len(shapes))
+        for kind, ancestor, equality, sort, projection in unserved:
+            print '  equality=%s sort=%s' % (list(equality), list(sort))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*',
+        help='scenario files (default: all of loadtest/scenarios)')
+    parser.add_argument('--sdk', help='App Engine SDK directory')
+    parser.add_argument('--jobs', action='store_true',
+        help='also run the cron and task jobs once')
+    parser.add_argument('--search-shapes', action='store_true',
+        help='also check every queryConferences filter combination')
+    args = parser.parse_args()
+
+    target = loadtest.StubbedTarget(sdk=args.sdk)
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_index
+
+    trace = Trace()
+    with open(os.path.join(ROOT, 'index.yaml')) as f:
+        trace.indexes = datastore_index.ParseIndexDefinitions(f).indexes or []
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'index_audit', trace.hook, 'datastore_v3')
+
+    paths = args.scenarios or sorted(
+        glob.glob(os.path.join(ROOT, 'loadtest', 'scenarios', '*.json')))
+    for path in paths:
+        scenario = loadtest.loadScenario(path)
+        print >> sys.stderr, 'replaying %s' % scenario['name']
+        loadtest.run(target, scenario)
+    if args.jobs:
+        for name, job in backgroundJobs():
+            try:
+                job()
+            except Exception, e:
+                print >> sys.stderr, '%s failed: %r' % (name, e)
+
+    report(trace, modelIndexes(), searchShapes() if args.search_shapes else ())
+    target.close()
+
+
+if __name__ == '__main__':
+    main()
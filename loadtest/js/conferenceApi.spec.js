@@ -0,0 +1,301 @@
+'use strict';
+
+/**
+ * Request volume of the conferenceApi data layer, run headless by Karma against the page's own app.js and
+ * controllers.js. gapi.client is replaced by a fake server that counts its round trips and the methods it
+ * answers, and the timers are jasmine's, so every flow is settled before its counts are checked.
+ */
+
+// The pages under test never open a modal; a login prompt here means a call went out signed out.
+angular.module('ui.bootstrap', []).factory('$modal', function () {
+    return {
+        open: function () {
+            throw new Error('Unexpected login modal');
+        }
+    };
+});
+
+describe('conferenceApi', function () {
+    var CONFERENCE = 'c1';
+
+    var server;
+    var injector;
+    var conferenceApi;
+
+    /**
+     * A conference server holding one conference with ten seats, for whoever is signed in.
+     */
+    var fakeServer = function () {
+        var conference = {websafeKey: CONFERENCE, name: 'Conf', seatsAvailable: 10};
+        var profiles = {};
+        var fake = {user: 'ann@example.com', roundTrips: 0, methods: [], refuse: false};
+
+        var profile = function () {
+            profiles[fake.user] = profiles[fake.user] ||
+                {displayName: fake.user, conferenceKeysToAttend: []};
+            return profiles[fake.user];
+        };
+
+        var attend = function (attending) {
+            var attended = profile().conferenceKeysToAttend;
+            var i = attended.indexOf(CONFERENCE);
+            if (fake.refuse || attending == (i >= 0)) {
+                return {data: false};
+            }
+            if (attending) {
+                attended.push(CONFERENCE);
+            } else {
+                attended.splice(i, 1);
+            }
+            conference.seatsAvailable += attending ? -1 : 1;
+            return {data: true};
+        };
+
+        var answers = {
+            getProfile: profile,
+            getConference: function () {
+                return conference;
+            },
+            getConferencesToAttend: function () {
+                return {items: profile().conferenceKeysToAttend.length ? [conference] : []};
+            },
+            getConferencesCreated: function () {
+                return {items: []};
+            },
+            queryConferences: function () {
+                return {items: [conference]};
+            },
+            registerForConference: function () {
+                return attend(true);
+            },
+            unregisterFromConference: function () {
+                return attend(false);
+            }
+        };
+
+        // Each answer is a fresh copy, like a body parsed off the wire.
+        var answer = function (request) {
+            fake.methods.push(request.method);
+            return {result: JSON.parse(JSON.stringify(answers[request.method](request.params)))};
+        };
+
+        var conferenceClient = {};
+        angular.forEach(answers, function (_, method) {
+            conferenceClient[method] = function (params) {
+                var request = {method: method, params: params};
+                request.execute = function (callback) {
+                    fake.roundTrips++;
+                    var resp = answer(request);
+                    setTimeout(function () {
+                        callback(resp);
+                    }, 0);
+                };
+                return request;
+            };
+        });
+
+        fake.gapi = {
+            client: {
+                conference: conferenceClient,
+                newBatch: function () {
+                    var requests = [];
+                    return {
+                        add: function (request, options) {
+                            requests.push({id: options.id, request: request});
+                        },
+                        execute: function (callback) {
+                            fake.roundTrips++;
+                            var responses = {};
+                            angular.forEach(requests, function (entry) {
+                                responses[entry.id] = answer(entry.request);
+                            });
+                            setTimeout(function () {
+                                callback(responses);
+                            }, 0);
+                        }
+                    };
+                }
+            }
+        };
+        return fake;
+    };
+
+    /**
+     * Runs the timers until every queued call and callback has gone through.
+     */
+    var settle = function () {
+        for (var i = 0; i < 5; i++) {
+            jasmine.clock().tick(1);
+        }
+    };
+
+    /**
+     * Creates the named controller on a new scope, as its route would, and returns the scope.
+     */
+    var controller = function (name, locals) {
+        var $scope = injector.get('$rootScope').$new();
+        injector.get('$controller')(name, angular.extend({$scope: $scope}, locals));
+        return $scope;
+    };
+
+    var detailPage = function () {
+        return controller('ConferenceDetailCtrl', {$routeParams: {websafeConferenceKey: CONFERENCE}});
+    };
+
+    var listPage = function (tab) {
+        var $scope = controller('ShowConferenceCtrl');
+        $scope.selectedTab = tab;
+        return $scope;
+    };
+
+    var signIn = function (email) {
+        server.user = email;
+        conferenceApi.setUser(email);
+    };
+
+    beforeEach(function () {
+        window.localStorage.clear();
+        server = fakeServer();
+        window.gapi = server.gapi;
+        jasmine.clock().install();
+        injector = angular.injector(['ng', 'conferenceApp']);
+        injector.get('oauth2Provider').signedIn = true;
+        conferenceApi = injector.get('conferenceApi');
+        signIn('ann@example.com');
+    });
+
+    afterEach(function () {
+        jasmine.clock().uninstall();
+        delete window.gapi;
+    });
+
+    it('sends one getProfile for the pages that load it at once', function () {
+        var profilePage = controller('MyProfileCtrl');
+        var detail = detailPage();
+        profilePage.init();
+        detail.init();
+        settle();
+
+        expect(server.roundTrips).toBe(1);
+        expect(server.methods.sort()).toEqual(['getConference', 'getProfile']);
+        expect(conferenceApi.stats).toEqual({calls: 3, roundTrips: 1, cacheHits: 0, shared: 1});
+        expect(profilePage.profile.displayName).toBe('ann@example.com');
+        expect(detail.conference.seatsAvailable).toBe(10);
+
+        // Opening the profile page again reads it from the cache.
+        var again = controller('MyProfileCtrl');
+        again.init();
+        settle();
+
+        expect(server.roundTrips).toBe(1);
+        expect(conferenceApi.stats).toEqual({calls: 4, roundTrips: 1, cacheHits: 1, shared: 1});
+        expect(again.profile.displayName).toBe('ann@example.com');
+    });
+
+    it('registers and unregisters in one round trip each and refreshes the lists from the cache', function () {
+        var all = listPage('ALL');
+        var attending = listPage('YOU_WILL_ATTEND');
+        var detail = detailPage();
+        var refresh = function () {
+            all.queryConferences();
+            attending.queryConferences();
+            detail.init();
+            settle();
+        };
+        refresh();
+
+        expect(server.roundTrips).toBe(1);
+        expect(server.methods.length).toBe(4);
+
+        detail.registerForConference();
+        // Shown before the server answers.
+        expect(detail.isUserAttending).toBe(true);
+        expect(detail.conference.seatsAvailable).toBe(9);
+        settle();
+
+        expect(server.roundTrips).toBe(2);
+        expect(server.methods[4]).toBe('registerForConference');
+        expect(detail.messages).toBe('Registered for the conference');
+
+        refresh();
+
+        expect(server.roundTrips).toBe(2);
+        expect(conferenceApi.stats.cacheHits).toBe(4);
+        expect(all.conferences[0].seatsAvailable).toBe(9);
+        expect(attending.conferences.length).toBe(1);
+        expect(attending.conferences[0].seatsAvailable).toBe(9);
+        expect(detail.isUserAttending).toBe(true);
+        expect(detail.conference.seatsAvailable).toBe(9);
+
+        detail.unregisterFromConference();
+        settle();
+
+        expect(server.roundTrips).toBe(3);
+        expect(server.methods[5]).toBe('unregisterFromConference');
+
+        refresh();
+
+        expect(server.roundTrips).toBe(3);
+        expect(conferenceApi.stats).toEqual({calls: 14, roundTrips: 3, cacheHits: 8, shared: 0});
+        expect(all.conferences[0].seatsAvailable).toBe(10);
+        expect(attending.conferences.length).toBe(0);
+        expect(detail.conference.seatsAvailable).toBe(10);
+    });
+
+    it('takes back a registration the server refuses', function () {
+        var attending = listPage('YOU_WILL_ATTEND');
+        var detail = detailPage();
+        attending.queryConferences();
+        detail.init();
+        settle();
+
+        server.refuse = true;
+        detail.registerForConference();
+        settle();
+
+        expect(server.roundTrips).toBe(2);
+        expect(detail.isUserAttending).toBe(false);
+        expect(detail.conference.seatsAvailable).toBe(10);
+
+        // The cached reads are as they were before the attempt.
+        attending.queryConferences();
+        detail = detailPage();
+        detail.init();
+        settle();
+
+        expect(server.roundTrips).toBe(2);
+        expect(conferenceApi.stats.cacheHits).toBe(3);
+        expect(attending.conferences.length).toBe(0);
+        expect(detail.isUserAttending).toBe(false);
+        expect(detail.conference.seatsAvailable).toBe(10);
+    });
+
+    it('keeps the reads of each user apart', function () {
+        var profile = function () {
+            var page = controller('MyProfileCtrl');
+            page.init();
+            settle();
+            return page.profile.displayName;
+        };
+
+        expect(profile()).toBe('ann@example.com');
+        signIn('bob@example.com');
+        expect(profile()).toBe('bob@example.com');
+        expect(server.roundTrips).toBe(2);
+
+        signIn('ann@example.com');
+        expect(profile()).toBe('ann@example.com');
+        expect(server.roundTrips).toBe(2);
+        expect(conferenceApi.stats.cacheHits).toBe(1);
+
+        // Until the user is known, their reads go to the server and are not kept.
+        conferenceApi.setUser(null);
+        expect(profile()).toBe('ann@example.com');
+        expect(profile()).toBe('ann@example.com');
+        expect(server.roundTrips).toBe(4);
+        expect(conferenceApi.stats.cacheHits).toBe(1);
+        for (var i = 0; i < window.localStorage.length; i++) {
+            expect(window.localStorage.key(i)).not.toContain('getProfile::');
+        }
+    });
+});
@@ -0,0 +1,20 @@
+/**
+ * Runs the conferenceApi request volume spec headless:
+ *
+ *   cd loadtest/js && npm install && npm test
+ */
+module.exports = function (config) {
+    config.set({
+        basePath: '../..',
+        frameworks: ['jasmine'],
+        files: [
+            'loadtest/js/node_modules/angular/angular.js',
+            'loadtest/js/node_modules/angular-route/angular-route.js',
+            'static/js/app.js',
+            'static/js/controllers.js',
+            'loadtest/js/*.spec.js'
+        ],
+        browsers: ['jsdom'],
+        singleRun: true
+    });
+};
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+
+"""
+loadtest.py -- concurrency load harness for the conference API
+
+Replays a scripted mix of operations from a JSON scenario file (see
+loadtest/scenarios/) on a thread pool, against either an in-process
+ConferenceApi backed by testbed stubs (the default) or a running
+dev_appserver, then reports throughput, latency percentiles, datastore
+transaction retries/aborts and an oversell check.
+
+    python loadtest/loadtest.py loadtest/scenarios/registration_rush.json \\
+        --sdk ~/google-cloud-sdk/platform/google_appengine
+
+    python loadtest/loadtest.py loadtest/scenarios/browse_mix.json \\
+        --target http://localhost:8080 --token ACCESS_TOKEN
+
+In-process, every scripted user is a distinct signed-in user. Against
+dev_appserver all requests carry the one --token identity, so repeated
+registrations show up as conflicts, and transaction retries can't be
+counted from outside the server.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORGANIZER = 'organizer@loadtest.example.com'
+USER_EMAIL = 'user%d@loadtest.example.com'
+# the organizer's conferences are found by an eventually consistent query
+CREATED_POLLS = 50
+CREATED_POLL_DELAY = 0.1    # seconds
+
+
+def _created(find):
+    """Return the websafe key of the last conference find() lists, asking
+    until the new one shows."""
+    for _ in range(CREATED_POLLS):
+        found = find()
+        if found:
+            return found[-1]
+        time.sleep(CREATED_POLL_DELAY)
+    raise RuntimeError('The created conference never showed up')
+
+
+def loadScenario(path):
+    """Read a scenario file, filling in defaults."""
+    with open(path) as f:
+        scenario = json.load(f)
+    scenario.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    scenario.setdefault('users', 100)
+    scenario.setdefault('threads', 20)
+    scenario.setdefault('operations', 1000)
+    scenario.setdefault('duration', 10)
+    scenario.setdefault('seed', 0)
+    scenario.setdefault('conferences', [])
+    scenario.setdefault('sessionsPerConference', 0)
+    return scenario
+
+
+# - - - In-process target - - - - - - - - - - - - - - - - - - -
+
+class StubbedTarget(object):
+    """ConferenceApi called in-process on testbed service stubs."""
+
+    def __init__(self, sdk=None, consistency=1.0):
+        if sdk:
+            sys.path.insert(0, sdk)
+            import dev_appserver
+            dev_appserver.fix_sys_path()
+        sys.path.insert(0, ROOT)
+
+        from google.appengine.api import apiproxy_stub_map
+        from google.appengine.api import users
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        import conference
+        import models
+
+        self.users, self.ndb, self.conference, self.models = \
+            users, ndb, conference, models
+        self.datastore_stub_util = datastore_stub_util
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(consistency_policy=
+            datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=consistency))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_urlfetch_stub()
+
+        # each worker thread acts as whichever user it is replaying
+        self._local = threading.local()
+        conference.ConferenceApi._getLoggedInUser = \
+            lambda api: self._local.user
+        self.api = conference.ConferenceApi()
+
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.commitConflicts = 0
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'loadtest', self._datastoreHook, 'datastore_v3')
+
+    def _datastoreHook(self, service, call, request, response, rpc=None,
+                       error=None):
+        if call == 'Commit':
+            with self._lock:
+                self.commits += 1
+                if error:
+                    self.commitConflicts += 1
+
+    def _call(self, email, method, request):
+        self._local.user = self.users.User(email=email)
+        # start every call with a cold context cache, like a new request
+        self.ndb.get_context().clear_cache()
+        return getattr(self.api, method)(request)
+
+    def _resource(self, container, **kwargs):
+        return container.combined_message_class(**kwargs)
+
+    def classify(self, error):
+        """Return the outcome name for an exception raised by a call."""
+        from google.appengine.api import datastore_errors
+        if isinstance(error, datastore_errors.TransactionFailedError):
+            return 'abort'
+        if isinstance(error, self.models.ConflictException):
+            return 'conflict'
+        return type(error).__name__
+
+    def createConference(self, conf):
+        form = self.models.ConferenceForm(**conf)
+        self._call(ORGANIZER, 'createConference', form)
+        return _created(lambda: [c.websafeKey for c in self._call(ORGANIZER,
+            'getConferencesCreated',
+            self.conference.message_types.VoidMessage()).items
+            if c.name == conf['name']])
+
+    def createSession(self, wsck, sess):
+        self._call(ORGANIZER, 'createSession', self._resource(
+            self.conference.SESS_POST_REQUEST, websafeConferenceKey=wsck,
+            **sess))
+
+    def sessionKeys(self, wsck):
+        return [s.websafeKey for s in self.getConferenceSessions(
+            ORGANIZER, wsck).items]
+
+    def register(self, email, wsck):
+        return self._call(email, 'registerForConference', self._resource(
+            self.conference.CONF_GET_REQUEST, websafeConferenceKey=wsck)).data
+
+    def unregister(self, email, wsck):
+        return self._call(email, 'unregisterFromConference', self._resource(
+            self.conference.CONF_GET_REQUEST, websafeConferenceKey=wsck)).data
+
+    def queryConferences(self, email, filters):
+        return self._call(email, 'queryConferences',
+            self.models.ConferenceQueryForms(filters=[
+                self.models.ConferenceQueryForm(**f) for f in filters]))
+
+    def getConferencesByCity(self, email, city):
+        return self._call(email, 'getConferencesByCity', self._resource(
+            self.conference.CONF_GET_BY_CITY, conferenceCity=city))
+
+    def getConferenceSessions(self, email, wsck):
+        return self._call(email, 'getConferenceSessions', self._resource(
+            self.conference.CONF_GET_REQUEST, websafeConferenceKey=wsck))
+
+    def addSessionToWishlist(self, email, wssk):
+        return self._call(email, 'addSessionToWishlist', self._resource(
+            self.conference.SESS_GET_REQUEST, websafeSessionKey=wssk))
+
+    def updateConference(self, email, wsck, fields):
+        return self._call(ORGANIZER, 'updateConference', self._resource(
+            self.conference.CONF_POST_REQUEST, websafeConferenceKey=wsck,
+            **fields))
+
+    def seats(self, wsck):
+        """Return (maxAttendees, seatsAvailable, Registration count)."""
+        # let every pending write apply before counting
+        self.testbed.get_stub('datastore_v3').SetConsistencyPolicy(
+            self.datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=1))
+        conf = self.ndb.Key(urlsafe=wsck).get(use_cache=False)
+        registered = self.models.Registration.query(
+            self.models.Registration.conference == conf.key).count()
+        return conf.maxAttendees, conf.seatsAvailable, registered
+
+    def transactionStats(self):
+        return {'commits': self.commits,
+                'commitConflicts': self.commitConflicts}
+
+    def close(self):
+        self.testbed.deactivate()
+
+
+# - - - dev_appserver target - - - - - - - - - - - - - - - - - - -
+
+class HttpTarget(object):
+    """ConferenceApi called over HTTP on a running dev_appserver."""
+
+    def __init__(self, base, token=None):
+        self.base = base.rstrip('/') + '/_ah/api/conference/v1/'
+        self.token = token
+
+    def _call(self, httpMethod, path, params=None, body=None):
+        url = self.base + path
+        if params:
+            url += '?' + urllib.urlencode(params)
+        request = urllib2.Request(url, json.dumps(body or {}),
+            {'Content-Type': 'application/json'})
+        request.get_method = lambda: httpMethod
+        if self.token:
+            request.add_header('Authorization', 'Bearer ' + self.token)
+        return json.load(urllib2.urlopen(request))
+
+    def classify(self, error):
+        if isinstance(error, urllib2.HTTPError):
+            return 'conflict' if error.code == 409 else 'http_%d' % error.code
+        return type(error).__name__
+
+    def createConference(self, conf):
+        self._call('POST', 'conference', body=conf)
+        return _created(lambda: [c['websafeKey'] for c in self._call('POST',
+            'getConferencesCreated').get('items', [])
+            if c['name'] == conf['name']])
+
+    def createSession(self, wsck, sess):
+        self._call('POST', 'session', {'websafeConferenceKey': wsck}, sess)
+
+    def sessionKeys(self, wsck):
+        return [s['websafeKey'] for s in self.getConferenceSessions(
+            None, wsck).get('items', [])]
+
+    def register(self, email, wsck):
+        return self._call('POST', 'conference/' + wsck)['data']
+
+    def unregister(self, email, wsck):
+        return self._call('DELETE', 'conference/' + wsck)['data']
+
+    def queryConferences(self, email, filters):
+        return self._call('POST', 'queryConferences', body={'filters': filters})
+
+    def getConferencesByCity(self, email, city):
+        return self._call('POST', 'getConferencesByCity',
+            {'conferenceCity': city})
+
+    def getConferenceSessions(self, email, wsck):
+        return self._call('GET', 'getConferenceSessions/' + wsck)
+
+    def addSessionToWishlist(self, email, wssk):
+        return self._call('POST', 'addSessionToWishlist',
+            {'websafeSessionKey': wssk})
+
+    def updateConference(self, email, wsck, fields):
+        return self._call('PUT', 'conference/' + wsck, body=fields)
+
+    def seats(self, wsck):
+        conf = self._call('GET', 'conference/' + wsck)
+        return int(conf['maxAttendees']), int(conf['seatsAvailable']), None
+
+    def transactionStats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+# - - - Runner - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def setUp(target, scenario):
+    """Create the scenario's conferences and sessions; return their keys."""
+    conferences = []
+    sessions = {}
+    for conf in scenario['conferences']:
+        wsck = target.createConference(conf)
+        for i in range(scenario['sessionsPerConference']):
+            target.createSession(wsck, {
+                'name': '%s session %d' % (conf['name'], i),
+                'speaker': 'Speaker %d' % (i % 5),
+                'typeOfSession': 'Workshop' if i % 3 == 0 else 'Lecture',
+                'duration': 60,
+                'startTime': '%02d:00:00' % (9 + i % 9),
+            })
+        conferences.append(wsck)
+        sessions[wsck] = target.sessionKeys(wsck)
+    return conferences, sessions
+
+
+def buildPlan(scenario, conferences, sessions):
+    """Return the list of (startOffset, op, email, args) to replay."""
+    rng = random.Random(scenario['seed'])
+    mix = scenario['mix']
+    totalWeight = float(sum(step['weight'] for step in mix))
+    interval = float(scenario['duration']) / scenario['operations']
+
+    plan = []
+    for i in range(scenario['operations']):
+        pick = rng.uniform(0, totalWeight)
+        for step in mix:
+            pick -= step['weight']
+            if pick <= 0:
+                break
+        email = USER_EMAIL % rng.randrange(scenario['users'])
+        wsck = conferences[step['conference']] if 'conference' in step \
+            else rng.choice(conferences)
+        op = step['op']
+        if op in ('register', 'unregister', 'getConferenceSessions'):
+            args = (wsck,)
+        elif op == 'addSessionToWishlist':
+            args = (rng.choice(sessions[wsck]),)
+        elif op == 'queryConferences':
+            args = (step.get('filters', []),)
+        elif op == 'getConferencesByCity':
+            args = (step['city'],)
+        elif op == 'updateConference':
+            args = (wsck, step.get('fields', {'description': 'updated %d' % i}))
+        else:
+            raise ValueError('Unknown operation in scenario: %s' % op)
+        plan.append((i * interval, op, email, args))
+    return plan
+
+
+def run(target, scenario):
+    conferences, sessions = setUp(target, scenario)
+    plan = buildPlan(scenario, conferences, sessions)
+    start = time.time()
+
+    def replay(step):
+        offset, op, email, args = step
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        began = time.time()
+        try:
+            result = getattr(target, op)(email, *args)
+            outcome = 'ok' if result is not False else 'noop'
+        except Exception, e:
+            outcome = target.classify(e)
+        return op, args, outcome, time.time() - began
+
+    pool = ThreadPool(scenario['threads'])
+    results = pool.map(replay, plan, chunksize=1)
+    pool.close()
+    pool.join()
+    elapsed = time.time() - start
+    return report(target, scenario, conferences, results, elapsed)
+
+
+def percentile(values, q):
+    return values[int(round(q * (len(values) - 1)))] if values else 0.0
+
+
+def report(target, scenario, conferences, results, elapsed):
+    """Summarize results into a dict."""
+    ops = {}
+    booked = dict((wsck, 0) for wsck in conferences)
+    for op, args, outcome, latency in results:
+        entry = ops.setdefault(op, {'latencies': [], 'outcomes': {}})
+        entry['latencies'].append(latency)
+        entry['outcomes'][outcome] = entry['outcomes'].get(outcome, 0) + 1
+        if outcome == 'ok' and op == 'register':
+            booked[args[0]] += 1
+        elif outcome == 'ok' and op == 'unregister':
+            booked[args[0]] -= 1
+
+    summary = {
+        'scenario': scenario['name'],
+        'operations': len(results),
+        'elapsed': elapsed,
+        'throughput': len(results) / elapsed if elapsed else 0.0,
+        'transactions': target.transactionStats(),
+        'ops': {},
+        'oversell': [],
+    }
+    aborts = 0
+    for op, entry in sorted(ops.items()):
+        latencies = sorted(entry['latencies'])
+        aborts += entry['outcomes'].get('abort', 0)
+        summary['ops'][op] = {
+            'count': len(latencies),
+            'outcomes': entry['outcomes'],
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1],
+        }
+    summary['transactions']['aborts'] = aborts
+
+    for wsck in conferences:
+        maxAttendees, seatsAvailable, registered = target.seats(wsck)
+        problems = []
+        if seatsAvailable < 0:
+            problems.append('negative seatsAvailable')
+        if booked[wsck] > maxAttendees:
+            problems.append('more successful registrations than seats')
+        if registered is not None and \
+                registered + seatsAvailable != maxAttendees:
+            problems.append('registrations + seatsAvailable != maxAttendees')
+        summary['oversell'].append({
+            'websafeConferenceKey': wsck,
+            'maxAttendees': maxAttendees,
+            'seatsAvailable': seatsAvailable,
+            'registrations': registered,
+            'successfulBookings': booked[wsck],
+            'problems': problems,
+        })
+    return summary
+
+
+def printReport(summary):
+    print 'Scenario %(scenario)s: %(operations)d operations in %(elapsed).2fs ' \
+          '(%(throughput).1f ops/s)' % summary
+    print
+    print '%-26s %6s %9s %9s %9s %9s  outcomes' % (
+        'operation', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    for op, entry in sorted(summary['ops'].items()):
+        print '%-26s %6d %9.1f %9.1f %9.1f %9.1f  %s' % (
+            op, entry['count'], entry['p50'] * 1000, entry['p90'] * 1000,
+            entry['p99'] * 1000, entry['max'] * 1000, ', '.join(
+            '%s=%d' % item for item in sorted(entry['outcomes'].items())))
+    print
+    tx = summary['transactions']
+    if 'commits' in tx:
+        print 'Datastore commits: %d, conflicting (retried): %d (%.1f%%)' % (
+            tx['commits'], tx['commitConflicts'],
+            100.0 * tx['commitConflicts'] / tx['commits'] if tx['commits'] else 0)
+    print 'Transactions aborted after retries: %d' % tx['aborts']
+    print
+    for conf in summary['oversell']:
+        print '%s: %d seats, %d left, %s registrations, %d booked -> %s' % (
+            conf['websafeConferenceKey'][-12:], conf['maxAttendees'],
+            conf['seatsAvailable'], conf['registrations'],
+            conf['successfulBookings'],
+            '; '.join(conf['problems']) or 'OK')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', help='scenario JSON file')
+    parser.add_argument('--sdk', help='App Engine SDK directory (in-process)')
+    parser.add_argument('--target', help='dev_appserver URL, e.g. '
+                        'http://localhost:8080; in-process if omitted')
+    parser.add_argument('--token', help='OAuth bearer token for --target')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    scenario = loadScenario(args.scenario)
+    if args.target:
+        target = HttpTarget(args.target, args.token)
+    else:
+        target = StubbedTarget(args.sdk, scenario.get('consistency', 1.0))
+    try:
+        summary = run(target, scenario)
+    finally:
+        target.close()
+
+    printReport(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if any(conf['problems'] for conf in summary['oversell']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+payload_benchmark.py -- JSON vs protobuf payloads of the read endpoints
+
+Builds realistic agenda responses (SessionForms of a full conference
+programme, ConferenceForms of a search) and reports, for protorpc's JSON
+and binary protobuf encodings as served by /api/v1/ in main.py, the
+payload size raw and gzipped and the mean encode and decode times.
+
+    python loadtest/payload_benchmark.py \\
+        --sdk ~/google-cloud-sdk/platform/google_appengine
+
+"""
+
+import argparse
+import gzip
+import os
+import random
+import sys
+import timeit
+from cStringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ('cloud scaling data pipelines mobile offline sync security '
+         'machine learning latency observability design systems open '
+         'source testing python javascript kubernetes serverless storage '
+         'accessibility performance architecture streaming community').split()
+TYPES = ('Keynote', 'Talk', 'Workshop', 'Lightning talk', 'Panel')
+CITIES = ('London', 'San Francisco', 'Berlin', 'Tokyo', 'New York', 'Paris')
+
+
+def _phrase(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def _websafeKey(rng):
+    # the length and alphabet of a websafe Session key
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+    return 'ag' + ''.join(rng.choice(alphabet) for _ in range(68))
+
+
+def agenda(models, rng, sessions):
+    """Return SessionForms for a conference programme."""
+    return models.SessionForms(items=[models.SessionForm(
+        name=_phrase(rng, 5),
+        highlights=[_phrase(rng, 8) for _ in range(rng.randint(2, 6))],
+        speaker='%s %s' % (rng.choice(WORDS).title(), rng.choice(WORDS).title()),
+        duration=rng.choice((15, 30, 45, 60, 90)),
+        typeOfSession=rng.choice(TYPES),
+        startDate='2016-06-%02d' % rng.randint(1, 3),
+        startTime='1900-01-01 %02d:%02d:00' % (rng.randint(8, 18),
+                                               rng.choice((0, 15, 30, 45))),
+        websafeKey=_websafeKey(rng)) for _ in range(sessions)])
+
+
+def search(models, rng, conferences):
+    """Return ConferenceForms for a search result page."""
+    return models.ConferenceForms(items=[models.ConferenceForm(
+        name=_phrase(rng, 3),
+        description=' '.join(_phrase(rng, 10) + '.' for _ in range(3)),
+        organizerUserId='%021d' % rng.randint(0, 10 ** 20),
+        topics=[_phrase(rng, 2) for _ in range(rng.randint(1, 4))],
+        city=rng.choice(CITIES),
+        startDate='2016-06-01', endDate='2016-06-03', month=6,
+        maxAttendees=rng.choice((100, 250, 500, 1000)),
+        seatsAvailable=rng.randint(0, 100),
+        websafeKey=_websafeKey(rng),
+        organizerDisplayName=_phrase(rng, 2)) for _ in range(conferences)])
+
+
+def _gzipped(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return len(buf.getvalue())
+
+
+def measure(name, message, codec, repeat):
+    encoded = codec.encode_message(message)
+    encode = timeit.timeit(lambda: codec.encode_message(message),
+                           number=repeat) / repeat
+    decode = timeit.timeit(lambda: codec.decode_message(type(message), encoded),
+                           number=repeat) / repeat
+    return (name, len(encoded), _gzipped(encoded), encode * 1000, decode * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', help='App Engine SDK directory')
+    parser.add_argument('--sessions', type=int, default=80,
+                        help='sessions in the agenda (default 80)')
+    parser.add_argument('--conferences', type=int, default=50,
+                        help='conferences in the search (default 50)')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='timing iterations (default 200)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    from protorpc import protobuf
+    from protorpc import protojson
+    import models
+
+    rng = random.Random(args.seed)
+    payloads = [
+        ('SessionForms x%d' % args.sessions, agenda(models, rng, args.sessions)),
+        ('ConferenceForms x%d' % args.conferences,
+         search(models, rng, args.conferences)),
+    ]
+
+    print '%-24s %-9s %9s %9s %11s %11s' % (
+        'payload', 'encoding', 'bytes', 'gzipped', 'encode ms', 'decode ms')
+    for label, message in payloads:
+        for codecName, codec in (('json', protojson), ('protobuf', protobuf)):
+            name, size, zipped, encode, decode = measure(
+                codecName, message, codec, args.repeat)
+            print '%-24s %-9s %9d %9d %11.3f %11.3f' % (
+                label, name, size, zipped, encode, decode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+profilecache_benchmark.py -- profilecache.getProfile vs ndb's own caches
+
+Reads one Profile over and over, each read in a fresh ndb context like a
+new request, through a plain key.get() (served by ndb's memcache cache)
+and through profilecache.getProfile(). Reports, per read, the mean time
+and the RPCs made with the bytes they returned, for profiles attending
+no conferences and --attending legacy conferenceKeysToAttend entries.
+
+The memcache and datastore stubs run in process, so the times leave out
+the network; the bytes show what a real memcache round trip carries.
+
+    python loadtest/profilecache_benchmark.py \\
+        --sdk ~/google-cloud-sdk/platform/google_appengine
+
+"""
+
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class RpcCount(object):
+    """RPCs and response bytes by service.call, from a post-call hook."""
+
+    def __init__(self):
+        self.calls = {}
+
+    def hook(self, service, call, request, response, *args):
+        entry = self.calls.setdefault('%s.%s' % (service, call), [0, 0])
+        entry[0] += 1
+        entry[1] += response.ByteSize()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', help='App Engine SDK directory')
+    parser.add_argument('--attending', type=int, default=20,
+                        help='legacy conference keys on the larger profile '
+                             '(default 20)')
+    parser.add_argument('--repeat', type=int, default=2000,
+                        help='reads per variant (default 2000)')
+    args = parser.parse_args()
+
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault('APPLICATION_ID', 'dev~benchmark')
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    import profilecache
+    from models import Profile
+
+    count = RpcCount()
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+        'profilecache_benchmark', count.hook)
+
+    def newRequest():
+        ndb.tasklets.set_context(ndb.tasklets.make_default_context())
+
+    print '%-10s %-13s %8s   %s' % ('attending', 'read', 'ms', 'RPCs per read')
+    for attending in sorted(set([0, args.attending])):
+        p_key = ndb.Key(Profile, 'attending%d' % attending)
+        Profile(key=p_key, displayName='Benchmark User',
+                mainEmail='benchmark@example.com',
+                conferenceKeysToAttend=['%070d' % i
+                                        for i in range(attending)]).put()
+        for name, read in (
+                ('ndb get', p_key.get),
+                ('profilecache', lambda: profilecache.getProfile(p_key))):
+            # the first read fills memcache and the instance cache
+            newRequest()
+            read()
+            count.calls.clear()
+            start = time.time()
+            for _ in range(args.repeat):
+                newRequest()
+                read()
+            ms = (time.time() - start) * 1000 / args.repeat
+            print '%-10d %-13s %8.3f   %s' % (attending, name, ms, '  '.join(
+                '%s x%.2f %.0f bytes' % (call, n / float(args.repeat),
+                                         size / float(args.repeat))
+                for call, (n, size) in sorted(count.calls.items())))
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
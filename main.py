@@ -12,10 +12,58 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import os
+
+import endpoints
+from endpoints import users_id_token
 import webapp2
+from protorpc import messages
+from protorpc import protobuf
+from protorpc import protojson
+from protorpc import protourlencode
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from models import CalendarFeed
+from models import StringMessage
+from conference import MEMCACHE_FEATURED_SPEAKER_KEY
+from conferencekeys import migrateConferenceKeys
+from archive import archiveEnded
+from calendarfeed import feedText
+from calendarfeed import renderTarget
+from sync import purgeTombstones
+from recommend import computeRecommendations
+from recommend import startRecommendations
+from models import RequestProfile
+from profiler import profiled
+from profiler import rawStats
+from profiler import renderList
+from profiler import renderProfile
+from suggest import REBUILD_TASK_URL
+from suggest import SUGGEST_FIELDS
+from suggest import rebuildVocabulary
+from suggest import recountVocabulary
+from analytics import computeOrganizerReports
+from analytics import newReportRun
+from reindex import reindex
+
+PROFILE_LIST_LIMIT = 100
+
+PROTOBUF_TYPE = 'application/x-protobuf'
+JSON_TYPE = 'application/json'
+# read-only ConferenceApi methods served at /api/v1/<name>
+MESSAGE_API_METHODS = frozenset([
+    'getConference', 'getConferenceSessions', 'getConferenceSessionsByType',
+    'getConferenceSessionsBySpeaker', 'getSessionsNotOfTypeAndBeforeTime',
+    'getSessionsInWishlist', 'getRecommendedSessions', 'getFeaturedSpeaker',
+    'queryConferences', 'getConferencesByCity', 'getConferencesByExactTopic',
+    'getConferencesNear', 'getConferencesCreated', 'getConferencesToAttend',
+    'getProfile', 'getChangesSince', 'getAnnouncement',
+])
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -38,7 +86,344 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
-app = webapp2.WSGIApplication([
+class UpdateTeeShirtTalliesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Recount a user's registrations after a t-shirt size change."""
+        ConferenceApi._updateTeeShirtTallies(
+            ndb.Key(urlsafe=self.request.get('websafeProfileKey')))
+
+
+class RenderCalendarHandler(webapp2.RequestHandler):
+    def post(self):
+        """Re-render the iCalendar feeds of a conference or profile."""
+        renderTarget(ndb.Key(urlsafe=self.request.get('target')),
+                     bool(self.request.get('wishlists')))
+
+
+class CalendarFeedHandler(webapp2.RequestHandler):
+    def get(self, token):
+        """Serve a stored iCalendar feed, or 304 if the client has it."""
+        feed = ndb.Key(CalendarFeed, token).get()
+        if not feed or not feed.ics:
+            self.abort(404)
+
+        self.response.headers['ETag'] = feed.etag
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        self.response.headers['Last-Modified'] = \
+            feed.updated.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        self.response.headers['Cache-Control'] = 'private, max-age=300'
+        if self.request.headers.get('If-None-Match') == feed.etag or (
+                not self.request.headers.get('If-None-Match') and
+                self.request.if_modified_since and
+                self.request.if_modified_since.replace(tzinfo=None) >= feed.updated):
+            self.response.set_status(304)
+            return
+
+        # the frontend drops a Content-Encoding set by the app and gzips
+        # the response itself when the client accepts it
+        self.response.headers['Content-Type'] = 'text/calendar; charset=utf-8'
+        self.response.out.write(feedText(feed))
+
+
+class MessageApiHandler(webapp2.RequestHandler):
+    """The read endpoints of ConferenceApi over plain HTTP, answering in
+    protorpc's binary protobuf encoding when the client accepts
+    application/x-protobuf and in JSON otherwise. Requests are the same
+    fields as the endpoint's, in the query string or in a JSON or
+    protobuf body. The frontend gzips responses for clients that accept
+    it."""
+
+    def _setUser(self, method, request):
+        # Endpoints' own user detection, so endpoints.get_current_user()
+        # works in ConferenceApi: ID tokens are checked against the API's
+        # audiences and client ids, OAuth access tokens against its scopes
+        for name in ('ENDPOINTS_AUTH_EMAIL', 'ENDPOINTS_AUTH_DOMAIN',
+                     'ENDPOINTS_USE_OAUTH_SCOPE', 'HTTP_AUTHORIZATION'):
+            os.environ.pop(name, None)
+        if self.request.headers.get('Authorization'):
+            os.environ['HTTP_AUTHORIZATION'] = \
+                self.request.headers['Authorization']
+        users_id_token._maybe_set_current_user_vars(method, request=request)
+
+    def _decode(self, request_type):
+        content_type = self.request.headers.get('Content-Type', '')
+        if not self.request.body:
+            return protourlencode.decode_message(request_type,
+                self.request.query_string)
+        if content_type.startswith(PROTOBUF_TYPE):
+            return protobuf.decode_message(request_type, self.request.body)
+        return protojson.decode_message(request_type, self.request.body)
+
+    def _respond(self, message):
+        accept = self.request.headers.get('Accept', '')
+        if PROTOBUF_TYPE in accept:
+            self.response.headers['Content-Type'] = PROTOBUF_TYPE
+            body = protobuf.encode_message(message)
+        else:
+            self.response.headers['Content-Type'] = JSON_TYPE + '; charset=utf-8'
+            body = protojson.encode_message(message)
+        self.response.headers['Vary'] = 'Accept, Accept-Encoding'
+        self.response.out.write(body)
+
+    def get(self, name):
+        """Call a read endpoint and return its response message."""
+        if name not in MESSAGE_API_METHODS:
+            self.abort(404)
+        method = getattr(ConferenceApi, name)
+        try:
+            request = self._decode(method.remote.request_type)
+        except (messages.Error, ValueError):
+            self.abort(400)
+
+        method = getattr(ConferenceApi(), name)
+        self._setUser(method, request)
+        try:
+            self._respond(method(request))
+        except endpoints.ServiceException as e:
+            self.response.set_status(e.http_status)
+            self.response.headers['Content-Type'] = JSON_TYPE
+            self.response.out.write(protojson.encode_message(
+                StringMessage(data=str(e))))
+
+    post = get
+
+
+class MigrateRegistrationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start migrating Profile registration lists to Registrations."""
+        taskqueue.add(url='/tasks/migrate_registrations')
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch of profiles, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        next_cursor = ConferenceApi._migrateRegistrations(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/migrate_registrations',
+                params={'cursor': next_cursor.urlsafe()})
+
+
+class ReconcileStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start recomputing conference statistics from source data."""
+        taskqueue.add(url='/tasks/reconcile_stats')
+        self.response.set_status(204)
+
+    def post(self):
+        """Reconcile one batch of conferences, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        next_cursor = ConferenceApi._reconcileStats(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/reconcile_stats',
+                params={'cursor': next_cursor.urlsafe()})
+
+
+class MigrateConferenceKeysHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving Conferences out of their organizers' entity groups."""
+        taskqueue.add(url='/tasks/migrate_conference_keys')
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch, then chain the next batch or phase."""
+        cursor = self.request.get('cursor')
+        following = migrateConferenceKeys(
+            self.request.get('phase') or 'conferences',
+            Cursor(urlsafe=cursor) if cursor else None)
+        if following:
+            phase, next_cursor = following
+            params = {'phase': phase}
+            if next_cursor:
+                params['cursor'] = next_cursor.urlsafe()
+            taskqueue.add(url='/tasks/migrate_conference_keys', params=params)
+        else:
+            # featured speaker entries name conferences by their old keys
+            memcache.delete(MEMCACHE_FEATURED_SPEAKER_KEY)
+
+
+class ReindexHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start rewriting entities to drop their unused index rows."""
+        taskqueue.add(url='/tasks/reindex')
+        self.response.set_status(202)
+
+    def post(self):
+        """Rewrite one batch, then chain the next batch or kind."""
+        cursor = self.request.get('cursor')
+        following = reindex(self.request.get('phase') or None,
+            Cursor(urlsafe=cursor) if cursor else None)
+        if following:
+            phase, next_cursor = following
+            params = {'phase': phase}
+            if next_cursor:
+                params['cursor'] = next_cursor.urlsafe()
+            taskqueue.add(url='/tasks/reindex', params=params)
+
+
+class ArchiveConferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start archiving conferences that have ended."""
+        taskqueue.add(url='/tasks/archive_conferences')
+        self.response.set_status(204)
+
+    def post(self):
+        """Archive one batch of conferences, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        next_cursor = archiveEnded(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/archive_conferences',
+                params={'cursor': next_cursor.urlsafe()})
+
+
+class ComputeRecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start counting the wishlists that changed since the last run."""
+        if startRecommendations():
+            taskqueue.add(url='/tasks/compute_recommendations')
+        self.response.set_status(204)
+
+    def post(self):
+        """Count one batch of changed wishlists, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        next_cursor = computeRecommendations(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/compute_recommendations',
+                params={'cursor': next_cursor.urlsafe()})
+
+
+class RebuildVocabularyHandler(webapp2.RequestHandler):
+    def get(self):
+        """Recount every suggestion field from the data (admin, run once
+        after deploying)."""
+        for field in SUGGEST_FIELDS:
+            taskqueue.add(url=REBUILD_TASK_URL,
+                params={'field': field, 'recount': '1'})
+        self.response.set_status(204)
+
+    def post(self):
+        """Rebuild one field's suggestion snapshot."""
+        field = self.request.get('field')
+        if field not in SUGGEST_FIELDS:
+            return
+        if self.request.get('recount'):
+            recountVocabulary(field)
+        else:
+            rebuildVocabulary(field)
+
+
+class OrganizerReportsHandler(webapp2.RequestHandler):
+    def _chain(self, run, step):
+        # named, so a retried step queues its successor only once
+        try:
+            taskqueue.add(url='/tasks/organizer_reports',
+                name='organizer-reports-%s-%d' % (run, step),
+                params={'run': run, 'step': step})
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    def get(self):
+        """Start recomputing every organizer's report."""
+        self._chain(newReportRun(), 0)
+        self.response.set_status(204)
+
+    def post(self):
+        """Aggregate one slice of the data, then chain the next step."""
+        run = self.request.get('run') or newReportRun()
+        following = computeOrganizerReports(run,
+                                            int(self.request.get('step') or 0))
+        if following:
+            self._chain(run, following)
+
+
+class FeaturedSpeakersHandler(webapp2.RequestHandler):
+    def get(self):
+        """Queue a rebuild of the Featured Speaker memcaches."""
+        taskqueue.add(url='/tasks/featured_speakers')
+        self.response.set_status(204)
+
+    def post(self):
+        """Rebuild the Featured Speaker memcaches from every Session."""
+        ConferenceApi._refreshFeaturedSpeakers()
+
+
+class PurgeTombstonesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete delta sync tombstones that have expired."""
+        purgeTombstones()
+        self.response.set_status(204)
+
+
+class ProfileListHandler(webapp2.RequestHandler):
+    def get(self):
+        """List recent request profiles, optionally for one endpoint."""
+        endpoint = self.request.get('endpoint')
+        q = RequestProfile.query()
+        if endpoint:
+            q = q.filter(RequestProfile.endpoint == endpoint)
+        profiles = q.order(-RequestProfile.created).fetch(PROFILE_LIST_LIMIT)
+        self.response.write(renderList(profiles, endpoint))
+
+
+class ProfileHandler(webapp2.RequestHandler):
+    def get(self, profile_id, download):
+        """Show a request profile's top functions, or download its stats."""
+        profile = RequestProfile.get_by_id(int(profile_id))
+        if profile is None:
+            self.abort(404)
+        if download:
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+            self.response.headers['Content-Disposition'] = \
+                'attachment; filename="profile-%s.pstats"' % profile_id
+            self.response.write(rawStats(profile))
+        else:
+            self.response.write(renderProfile(profile,
+                self.request.get('sort', 'cumulative')))
+
+
+class GeocodeConferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start placing existing conferences at their cities."""
+        taskqueue.add(url='/tasks/geocode_conferences')
+        self.response.set_status(202)
+
+    def post(self):
+        """Geocode one batch of conferences, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        next_cursor = ConferenceApi._geocodeConferences(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/geocode_conferences',
+                params={'cursor': next_cursor.urlsafe()})
+
+
+app = profiled(webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-], debug=True)
+    ('/tasks/update_tee_shirt_tallies', UpdateTeeShirtTalliesHandler),
+    ('/tasks/render_calendar', RenderCalendarHandler),
+    (r'/calendar/(\w+)\.ics', CalendarFeedHandler),
+    ('/tasks/migrate_registrations', MigrateRegistrationsHandler),
+    ('/tasks/migrate_conference_keys', MigrateConferenceKeysHandler),
+    ('/tasks/reindex', ReindexHandler),
+    ('/tasks/geocode_conferences', GeocodeConferencesHandler),
+    ('/crons/reconcile_stats', ReconcileStatsHandler),
+    ('/crons/archive_conferences', ArchiveConferencesHandler),
+    ('/tasks/archive_conferences', ArchiveConferencesHandler),
+    ('/tasks/reconcile_stats', ReconcileStatsHandler),
+    ('/crons/purge_tombstones', PurgeTombstonesHandler),
+    ('/crons/compute_recommendations', ComputeRecommendationsHandler),
+    ('/tasks/compute_recommendations', ComputeRecommendationsHandler),
+    (REBUILD_TASK_URL, RebuildVocabularyHandler),
+    ('/crons/organizer_reports', OrganizerReportsHandler),
+    ('/tasks/organizer_reports', OrganizerReportsHandler),
+    ('/crons/featured_speakers', FeaturedSpeakersHandler),
+    ('/tasks/featured_speakers', FeaturedSpeakersHandler),
+    (r'/api/v1/(\w+)', MessageApiHandler),
+    ('/admin/profiles', ProfileListHandler),
+    (r'/admin/profiles/(\d+)(\.pstats)?', ProfileHandler),
+], debug=True))
@@ -21,12 +21,42 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+class ModifiedProperty(ndb.DateTimeProperty):
+    """ModifiedProperty -- auto_now time of the last change, for delta
+    sync. A put of an entity with keepModified set leaves it as it was,
+    for rewrites that change nothing a client sees (reindex.py)."""
+    def __init__(self, *args, **kwargs):
+        kwargs['auto_now'] = True
+        super(ModifiedProperty, self).__init__(*args, **kwargs)
+
+    def _prepare_for_put(self, entity):
+        if not getattr(entity, 'keepModified', False):
+            super(ModifiedProperty, self)._prepare_for_put(entity)
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
-    displayName = ndb.StringProperty()
-    mainEmail = ndb.StringProperty()
-    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    displayName = ndb.StringProperty(indexed=False)
+    mainEmail = ndb.StringProperty(indexed=False)
+    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED', indexed=False)
+    # legacy registration list; superseded by Registration entities and
+    # emptied by the /tasks/migrate_registrations task
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True, indexed=False)
+    modified = ModifiedProperty(indexed=False)
+
+class Registration(ndb.Model):
+    """Registration -- one Profile attending one Conference; child of the
+    attendee's Profile, keyed by the Conference's websafe key"""
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+    profile    = ndb.KeyProperty(kind='Profile', required=True, indexed=False)
+    created    = ndb.DateTimeProperty(auto_now_add=True)
+    modified   = ModifiedProperty()
+    # size counted in the conference's TeeShirtTally for this attendee
+    teeShirtSize = ndb.StringProperty(indexed=False)
+
+    @classmethod
+    def keyFor(cls, conf_key, prof_key):
+        """Return the Registration key for a conference/profile pair."""
+        return ndb.Key(cls, conf_key.urlsafe(), parent=prof_key)
 
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
@@ -40,6 +70,16 @@ class ProfileForm(messages.Message):
     teeShirtSize = messages.EnumField('TeeShirtSize', 3)
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
 
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- Conference attendee outbound form message"""
+    displayName = messages.StringField(1)
+    mainEmail = messages.StringField(2)
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- one page of AttendeeForm outbound messages"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
@@ -51,8 +91,8 @@ class BooleanMessage(messages.Message):
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
-    description     = ndb.StringProperty()
-    organizerUserId = ndb.StringProperty()
+    description     = ndb.StringProperty(indexed=False)
+    organizerUserId = ndb.StringProperty(indexed=False)
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -60,6 +100,35 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    organizer       = ndb.KeyProperty(kind='Profile')
+    location        = ndb.GeoPtProperty(indexed=False)
+    geohashes       = ndb.StringProperty(repeated=True) # every prefix, see geo.py
+    # key this conference had under its organizer's Profile, if it was moved
+    formerKey       = ndb.KeyProperty(kind='Conference', indexed=False)
+    modified        = ModifiedProperty()
+
+class ConferenceMove(ndb.Model):
+    """ConferenceMove -- root key a Conference created under its organizer's
+    Profile is moved to; keyed by the old websafe key, see conferencekeys.py"""
+    newKey = ndb.KeyProperty(kind='Conference', required=True, indexed=False)
+    done   = ndb.BooleanProperty(default=False, indexed=False)
+
+class ArchivedConference(ndb.Model):
+    """ArchivedConference -- Conference that has ended, moved out of the
+    Conference kind by archive.py; same id, indexed only where queried"""
+    name            = ndb.StringProperty(required=True, indexed=False)
+    description     = ndb.StringProperty(indexed=False)
+    organizerUserId = ndb.StringProperty()
+    topics          = ndb.StringProperty(repeated=True)
+    city            = ndb.StringProperty()
+    startDate       = ndb.DateProperty(indexed=False)
+    month           = ndb.IntegerProperty(indexed=False)
+    endDate         = ndb.DateProperty(indexed=False)
+    maxAttendees    = ndb.IntegerProperty(indexed=False)
+    seatsAvailable  = ndb.IntegerProperty(indexed=False)
+    organizer       = ndb.KeyProperty(kind='Profile', indexed=False)
+    location        = ndb.GeoPtProperty(indexed=False)
+    archived        = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -75,10 +144,16 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    latitude        = messages.FloatField(13)
+    longitude       = messages.FloatField(14)
+    distanceKm      = messages.FloatField(15)
 
 class ConferenceForms(messages.Message):
-    """ConferenceForms -- multiple Conference outbound form message"""
+    """ConferenceForms -- multiple Conference outbound form message;
+    truncated when the request budget ran out, see budget.py"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    truncated = messages.BooleanField(3)
     
 
 class TeeShirtSize(messages.Enum):
@@ -108,16 +183,29 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    includeArchived = messages.BooleanField(2)
+    pageToken = messages.StringField(3)
 
 class Session(ndb.Model):
-    name            = ndb.StringProperty(required=True)
-    highlights      = ndb.StringProperty(repeated=True)
+    name            = ndb.StringProperty(required=True, indexed=False)
+    highlights      = ndb.StringProperty(repeated=True, indexed=False)
     speaker         = ndb.StringProperty()
-    duration        = ndb.IntegerProperty()
+    duration        = ndb.IntegerProperty(indexed=False)
     typeOfSession   = ndb.StringProperty()
-    startDate       = ndb.DateProperty()
+    startDate       = ndb.DateProperty(indexed=False)
     startTime       = ndb.DateTimeProperty()
+    modified        = ModifiedProperty()
     
+class ArchivedSession(ndb.Model):
+    """ArchivedSession -- Session of an ArchivedConference, its child"""
+    name            = ndb.StringProperty(required=True, indexed=False)
+    highlights      = ndb.StringProperty(repeated=True, indexed=False)
+    speaker         = ndb.StringProperty(indexed=False)
+    duration        = ndb.IntegerProperty(indexed=False)
+    typeOfSession   = ndb.StringProperty(indexed=False)
+    startDate       = ndb.DateProperty(indexed=False)
+    startTime       = ndb.DateTimeProperty(indexed=False)
+
 class SessionForm(messages.Message):
     name                    = messages.StringField(1)
     highlights              = messages.StringField(2, repeated=True)
@@ -130,17 +218,20 @@ class SessionForm(messages.Message):
     
 class SessionForms(messages.Message):
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    truncated = messages.BooleanField(3)
     
 class UserWishlist(ndb.Model):
     wishlistedSessionKey = ndb.StringProperty(required=True)
+    modified = ModifiedProperty()
 
 class UserWishlistForm(messages.Message):
     wishlistedSessionKey = messages.StringField(1, required=True)
     
 class FeaturedSpeakerMemcacheEntry(ndb.Model):
-    speaker = ndb.StringProperty(required = True)
-    conferenceWebsafeKey = ndb.StringProperty(required=True)
-    sessions = ndb.StringProperty(repeated = True)
+    speaker = ndb.StringProperty(required = True, indexed=False)
+    conferenceWebsafeKey = ndb.StringProperty(required=True, indexed=False)
+    sessions = ndb.StringProperty(repeated = True, indexed=False)
     
 class FeaturedSpeakerMemcacheEntryForm(messages.Message):
     speaker = messages.StringField(1)
@@ -151,4 +242,214 @@ class FeaturedSpeakerMemcacheEntryForms(messages.Message):
     items = messages.MessageField(FeaturedSpeakerMemcacheEntryForm, 1, repeated = True)
 
 class FeaturedSpeakerMemcacheKeys(ndb.Model):
-    items = ndb.StringProperty(repeated = True)
\ No newline at end of file
+    items = ndb.StringProperty(repeated = True)
+
+class CounterShard(ndb.Model):
+    """CounterShard -- one shard of a named counter, see stats.py"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+class SessionRank(ndb.Model):
+    """SessionRank -- one leaderboard entry of a conference's sessions"""
+    websafeKey = ndb.StringProperty(indexed=False)
+    name = ndb.StringProperty(indexed=False)
+    wishlistCount = ndb.IntegerProperty(indexed=False)
+
+class ConferenceStats(ndb.Model):
+    """ConferenceStats -- durable snapshot of a conference's statistics,
+    keyed by the conference's websafe key"""
+    sessionCount = ndb.IntegerProperty(indexed=False)
+    topSessions = ndb.LocalStructuredProperty(SessionRank, repeated=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class WishlistSnapshot(ndb.Model):
+    """WishlistSnapshot -- the part of a Profile's wishlist in one
+    conference as last counted for recommendations; child of the Profile,
+    keyed by the conference's websafe key, see recommend.py"""
+    sessions = ndb.StringProperty(repeated=True, indexed=False)
+
+class SessionCooccurrence(ndb.Model):
+    """SessionCooccurrence -- how many profiles wishlisted each pair of a
+    conference's sessions, keyed by the conference's websafe key"""
+    sessions = ndb.StringProperty(repeated=True, indexed=False)
+    counts = ndb.BlobProperty()     # packed array('I'), see recommend.py
+
+class SessionNeighbors(ndb.Model):
+    """SessionNeighbors -- sessions most often wishlisted together with
+    one session, keyed by its websafe key"""
+    neighbors = ndb.StringProperty(repeated=True, indexed=False)
+    scores = ndb.IntegerProperty(repeated=True, indexed=False)
+
+class RecommendationRun(ndb.Model):
+    """RecommendationRun -- how far the recommendation job has read the
+    UserWishlist changes; see recommend.py"""
+    watermark = ndb.DateTimeProperty(indexed=False)  # done up to here
+    started   = ndb.DateTimeProperty(indexed=False)  # run in progress, if any
+
+class TeeShirtCount(ndb.Model):
+    """TeeShirtCount -- number of attendees wanting one t-shirt size"""
+    size = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(indexed=False)
+
+class TeeShirtTally(ndb.Model):
+    """TeeShirtTally -- registered attendees per t-shirt size; child of the
+    Conference so it is updated in the registration transaction"""
+    counts = ndb.LocalStructuredProperty(TeeShirtCount, repeated=True)
+
+    @classmethod
+    def keyFor(cls, conf_key):
+        """Return the TeeShirtTally key for a conference."""
+        return ndb.Key(cls, 'tally', parent=conf_key)
+
+    def adjust(self, size, delta):
+        """Add delta to the count for size."""
+        for entry in self.counts:
+            if entry.size == size:
+                entry.count += delta
+                return
+        self.counts.append(TeeShirtCount(size=size, count=delta))
+
+class CalendarFeed(ndb.Model):
+    """CalendarFeed -- rendered iCalendar feed of a Conference's sessions or
+    a Profile's wishlist, keyed by the secret token in its URL"""
+    target  = ndb.KeyProperty(required=True)
+    ics     = ndb.BlobProperty()    # text; older feeds gzipped until re-rendered
+    etag    = ndb.StringProperty(indexed=False)
+    updated = ndb.DateTimeProperty(indexed=False)
+
+class CalendarFeedToken(ndb.Model):
+    """CalendarFeedToken -- token of the CalendarFeed of a Conference or
+    Profile, keyed by the target's websafe key"""
+    token = ndb.StringProperty(required=True, indexed=False)
+
+class SessionRankForm(messages.Message):
+    """SessionRankForm -- leaderboard entry outbound form message"""
+    websafeKey = messages.StringField(1)
+    name = messages.StringField(2)
+    wishlistCount = messages.IntegerField(3)
+
+class ConferenceStatsForm(messages.Message):
+    """ConferenceStatsForm -- Conference statistics outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    sessionCount = messages.IntegerField(2)
+    registrationCount = messages.IntegerField(3)
+    maxAttendees = messages.IntegerField(4)
+    fillRate = messages.FloatField(5)
+    topSessions = messages.MessageField(SessionRankForm, 6, repeated=True)
+
+class TeeShirtCountForm(messages.Message):
+    """TeeShirtCountForm -- t-shirt size count outbound form message"""
+    size = messages.EnumField('TeeShirtSize', 1)
+    count = messages.IntegerField(2)
+
+class TeeShirtTallyForm(messages.Message):
+    """TeeShirtTallyForm -- Conference t-shirt tally outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    items = messages.MessageField(TeeShirtCountForm, 2, repeated=True)
+
+class Tombstone(ndb.Model):
+    """Tombstone -- record of a deleted Conference or Session, kept for
+    TOMBSTONE_DAYS so delta sync clients learn of the delete; see sync.py"""
+    kind       = ndb.StringProperty(indexed=False)
+    websafeKey = ndb.StringProperty(indexed=False)
+    deleted    = ndb.DateTimeProperty(auto_now_add=True)
+
+class DeletedForm(messages.Message):
+    """DeletedForm -- deleted entity outbound form message"""
+    kind = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+
+class ChangesForm(messages.Message):
+    """ChangesForm -- one page of delta sync changes outbound form message"""
+    conferences = messages.MessageField(ConferenceForm, 1, repeated=True)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    profile = messages.MessageField(ProfileForm, 3)
+    wishlist = messages.StringField(4, repeated=True)
+    deleted = messages.MessageField(DeletedForm, 5, repeated=True)
+    nextPageToken = messages.StringField(6)
+    syncToken = messages.StringField(7)
+    reset = messages.BooleanField(8)
+    registrations = messages.StringField(9, repeated=True)
+
+class RequestProfile(ndb.Model):
+    """RequestProfile -- cProfile stats of one profiled request; see
+    profiler.py"""
+    endpoint  = ndb.StringProperty()
+    created   = ndb.DateTimeProperty(auto_now_add=True)
+    elapsedMs = ndb.IntegerProperty(indexed=False)
+    stats     = ndb.BlobProperty()  # zlib-compressed marshalled pstats
+
+class VocabularyTerm(ndb.Model):
+    """VocabularyTerm -- how many conferences or sessions use one value of
+    a suggested field, keyed by 'field|term'; see suggest.py"""
+    field = ndb.StringProperty()
+    term  = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+class Vocabulary(ndb.Model):
+    """Vocabulary -- snapshot of the terms of one suggested field, sorted
+    case-insensitively, with their counts; keyed by the field name"""
+    terms   = ndb.StringProperty(repeated=True, indexed=False)
+    counts  = ndb.IntegerProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(indexed=False)
+
+class SuggestionForm(messages.Message):
+    """SuggestionForm -- autocomplete suggestion outbound form message"""
+    term = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+class SuggestionForms(messages.Message):
+    """SuggestionForms -- multiple SuggestionForm outbound form message"""
+    items = messages.MessageField(SuggestionForm, 1, repeated=True)
+
+class ReportTerm(ndb.Model):
+    """ReportTerm -- one topic or session type in an OrganizerReport"""
+    term          = ndb.StringProperty(indexed=False)
+    count         = ndb.IntegerProperty(indexed=False)  # conferences or sessions
+    registrations = ndb.IntegerProperty(indexed=False)
+
+class OrganizerReport(ndb.Model):
+    """OrganizerReport -- analytics snapshot across all of an organizer's
+    conferences, keyed by organizerUserId; see analytics.py"""
+    conferences   = ndb.IntegerProperty(indexed=False)
+    sessions      = ndb.IntegerProperty(indexed=False)  # with a type
+    registrations = ndb.IntegerProperty(indexed=False)
+    maxAttendees  = ndb.IntegerProperty(indexed=False)
+    fillRate      = ndb.FloatProperty(indexed=False)
+    # share of seats taken n days before the start, for n in CURVE_DAYS
+    fillCurve     = ndb.FloatProperty(repeated=True, indexed=False)
+    # registrations made in the last n days, for n in VELOCITY_DAYS
+    velocity      = ndb.IntegerProperty(repeated=True, indexed=False)
+    # registrations by the start month of the conference, January first
+    months        = ndb.IntegerProperty(repeated=True, indexed=False)
+    topics        = ndb.LocalStructuredProperty(ReportTerm, repeated=True)
+    sessionTypes  = ndb.LocalStructuredProperty(ReportTerm, repeated=True)
+    updated       = ndb.DateTimeProperty(indexed=False)
+
+class AnalyticsCheckpoint(ndb.Model):
+    """AnalyticsCheckpoint -- one piece of the pickled state an organizer
+    report run hands from one task to the next, keyed by
+    'run-step-piece'; see analytics.py"""
+    data   = ndb.BlobProperty()
+    pieces = ndb.IntegerProperty(indexed=False)
+
+class ReportTermForm(messages.Message):
+    """ReportTermForm -- topic or session type outbound form message"""
+    term = messages.StringField(1)
+    count = messages.IntegerField(2)
+    registrations = messages.IntegerField(3)
+
+class OrganizerReportForm(messages.Message):
+    """OrganizerReportForm -- organizer analytics outbound form message"""
+    conferences = messages.IntegerField(1)
+    sessions = messages.IntegerField(2)
+    registrations = messages.IntegerField(3)
+    maxAttendees = messages.IntegerField(4)
+    fillRate = messages.FloatField(5)
+    curveDays = messages.IntegerField(6, repeated=True)
+    fillCurve = messages.FloatField(7, repeated=True)
+    velocityDays = messages.IntegerField(8, repeated=True)
+    velocity = messages.IntegerField(9, repeated=True)
+    months = messages.IntegerField(10, repeated=True)
+    topics = messages.MessageField(ReportTermForm, 11, repeated=True)
+    sessionTypes = messages.MessageField(ReportTermForm, 12, repeated=True)
+    updated = messages.StringField(13)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""profilecache.py
+
+Per-instance cache of Profile entities.
+
+Nearly every authenticated endpoint reads the caller's Profile, and ndb's
+context cache only lasts for one request. getProfile() keeps up to
+PROFILE_CACHE_SIZE profiles in instance memory, each for PROFILE_TTL
+seconds at most. A repeat request skips the get: it makes the same one
+memcache round trip that ndb's memcache cache would, but for a small
+counter instead of the entity, and doesn't decode one. Measured on the SDK
+stubs with loadtest/profilecache_benchmark.py, a read costs 0.24 ms and
+97 bytes instead of 0.59 ms and 223 bytes, and 0.35 ms and 98 bytes
+instead of 1.19 ms and 2304 bytes for a profile with 20 legacy
+conferenceKeysToAttend entries.
+
+Each profile has a generation counter in memcache. Code that writes a
+profile calls invalidateProfiles() once the write is done, which bumps
+the counter. A cached copy is only used while the counter still has the
+value it had when the copy was loaded, so a write on any instance is
+seen by the next request everywhere. As in searchcache.py, a counter
+missing from memcache restarts at the current time in milliseconds.
+The counter is read at most once per request and kept on the ndb
+context, so repeated getProfile() calls in a request make no RPCs, as
+ndb's context cache did.
+
+Profiles are only cached when ndb's own cache and memcache policies
+would cache them, and never inside a transaction, which must read what
+it writes back. Callers get their own copy, so changing it leaves the
+cached profile as it was.
+
+"""
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Profile
+
+PROFILE_CACHE_SIZE = 1000
+PROFILE_TTL = 60        # seconds
+GENERATION_PREFIX = 'profile-generation:'
+
+# p_key -> (expires, generation, property values); least recently used first
+_profiles = OrderedDict()
+_lock = threading.Lock()
+
+
+def _requestGenerations():
+    # the ndb context lasts for one request
+    ctx = ndb.get_context()
+    generations = getattr(ctx, '_profileGenerations', None)
+    if generations is None:
+        generations = ctx._profileGenerations = {}
+    return generations
+
+
+def _generation(p_key):
+    generations = _requestGenerations()
+    if p_key in generations:
+        return generations[p_key]
+    key = GENERATION_PREFIX + p_key.urlsafe()
+    generation = memcache.get(key)
+    if generation is None:
+        memcache.add(key, int(time.time() * 1000))
+        generation = memcache.get(key)
+    if generation is not None:
+        generations[p_key] = generation
+    return generation
+
+
+def _ttl(p_key):
+    ctx = ndb.get_context()
+    # the policies return None for "ndb's default"; these resolve it as
+    # ndb's own reads do
+    if not (ctx._use_cache(p_key) and ctx._use_memcache(p_key)):
+        return 0
+    timeout = ctx.get_memcache_timeout_policy()(p_key)
+    return min(PROFILE_TTL, timeout) if timeout else PROFILE_TTL
+
+
+def getProfile(p_key):
+    """Return the Profile with key p_key, or None if there isn't one."""
+    ttl = 0 if ndb.in_transaction() else _ttl(p_key)
+    if not ttl:
+        return p_key.get()
+
+    # read the generation before the profile: a write in between makes
+    # the copy stored here look stale, never the other way round
+    generation = _generation(p_key)
+    if generation is None:
+        return p_key.get()      # memcache unavailable
+    now = time.time()
+    with _lock:
+        entry = _profiles.pop(p_key, None)
+        if entry and entry[0] > now and entry[1] == generation:
+            _profiles[p_key] = entry
+            return Profile(key=p_key, **copy.deepcopy(entry[2]))
+
+    profile = p_key.get()
+    if profile:
+        with _lock:
+            _profiles[p_key] = (now + ttl, generation,
+                                copy.deepcopy(profile.to_dict()))
+            while len(_profiles) > PROFILE_CACHE_SIZE:
+                _profiles.popitem(last=False)
+    return profile
+
+
+def invalidateProfiles(p_keys):
+    """Make every instance reload the profiles with keys p_keys; call once
+    they have been written. Inside a transaction this happens once it has
+    committed."""
+    p_keys = list(p_keys)
+    generations = _requestGenerations()
+    with _lock:
+        for p_key in p_keys:
+            _profiles.pop(p_key, None)
+            generations.pop(p_key, None)
+    if p_keys:
+        # a missing counter is left missing; the next read restarts it
+        ndb.get_context().call_on_commit(lambda: memcache.offset_multi(
+            dict((GENERATION_PREFIX + p_key.urlsafe(), 1) for p_key in p_keys)))
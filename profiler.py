@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""profiler.py
+
+Opt-in cProfile profiling of requests to conference.api and main.app.
+
+A request is profiled when it carries PROFILER_TOKEN (settings.py) in an
+X-Profile header or a `profile` query parameter, or when it falls in the
+PROFILER_SAMPLE_RATE fraction of traffic. The stats are kept in the
+RequestProfile kind, capped at PROFILE_CAP entities, and browsed at
+/admin/profiles (see main.py).
+
+With no token and a zero sample rate, profiled() returns the application
+unwrapped, so switching the profiler off costs nothing.
+
+"""
+
+import cgi
+import logging
+import marshal
+import pstats
+import random
+import time
+import urllib
+import urlparse
+import zlib
+from cProfile import Profile
+from cStringIO import StringIO
+
+from google.appengine.ext import ndb
+
+from models import RequestProfile
+
+from settings import PROFILER_SAMPLE_RATE
+from settings import PROFILER_TOKEN
+
+PROFILE_CAP = 200
+MAX_STATS_BYTES = 900 * 1024    # stay under the 1MB entity limit
+TOP_FUNCTIONS = 40
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+SPI_PREFIX = '/_ah/spi/'
+
+
+def _requested(environ):
+    if PROFILER_TOKEN:
+        if environ.get('HTTP_X_PROFILE') == PROFILER_TOKEN:
+            return True
+        query = environ.get('QUERY_STRING', '')
+        if 'profile=' in query and PROFILER_TOKEN in \
+                urlparse.parse_qs(query).get('profile', []):
+            return True
+    return PROFILER_SAMPLE_RATE and random.random() < PROFILER_SAMPLE_RATE
+
+
+def _endpoint(environ):
+    path = environ.get('PATH_INFO', '')
+    # Endpoints backend calls arrive as /_ah/spi/ConferenceApi.<method>
+    if path.startswith(SPI_PREFIX):
+        return path[len(SPI_PREFIX):]
+    return '%s %s' % (environ.get('REQUEST_METHOD', 'GET'), path)
+
+
+def profiled(app):
+    """Return app wrapped to profile the requests that ask for it."""
+    if not (PROFILER_TOKEN or PROFILER_SAMPLE_RATE):
+        return app
+
+    def wrapper(environ, start_response):
+        if not _requested(environ):
+            return app(environ, start_response)
+
+        prof = Profile()
+        start = time.time()
+        # consume the body inside the profiler; both apps build it eagerly
+        body = prof.runcall(lambda: list(app(environ, start_response)))
+        elapsed = time.time() - start
+        try:
+            _store(_endpoint(environ), prof, elapsed)
+        except Exception:
+            # a profile is never worth failing the request for
+            logging.exception('Could not store request profile')
+        return body
+
+    return wrapper
+
+
+def _store(endpoint, prof, elapsed):
+    prof.create_stats()
+    data = zlib.compress(marshal.dumps(prof.stats))
+    if len(data) > MAX_STATS_BYTES:
+        logging.warning('Profile of %s too large to store (%d bytes)',
+                        endpoint, len(data))
+        return
+    RequestProfile(endpoint=endpoint, elapsedMs=int(elapsed * 1000),
+                   stats=data).put()
+
+    # keep only the newest PROFILE_CAP profiles
+    old = RequestProfile.query().order(-RequestProfile.created).fetch(
+        50, offset=PROFILE_CAP, keys_only=True)
+    ndb.delete_multi(old)
+
+
+class _StoredStats(object):
+    """Stand-in Profile that pstats.Stats loads stored stats from."""
+
+    def __init__(self, data):
+        self.stats = marshal.loads(zlib.decompress(data))
+
+    def create_stats(self):
+        pass
+
+
+def rawStats(profile):
+    """Return a RequestProfile's stats in the pstats file format."""
+    return zlib.decompress(profile.stats)
+
+
+def topFunctions(profile, sort='cumulative', limit=TOP_FUNCTIONS):
+    """Return the pstats report of a RequestProfile's top functions."""
+    if sort not in SORT_KEYS:
+        sort = SORT_KEYS[0]
+    out = StringIO()
+    stats = pstats.Stats(_StoredStats(profile.stats), stream=out)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def renderList(profiles, endpoint=None):
+    """Return an HTML page listing RequestProfiles."""
+    rows = ''.join(
+        '<tr><td>%s</td><td><a href="?endpoint=%s">%s</a></td><td>%d ms</td>'
+        '<td><a href="/admin/profiles/%d">top</a> '
+        '<a href="/admin/profiles/%d.pstats">download</a></td></tr>' % (
+            p.created.strftime('%Y-%m-%d %H:%M:%S'),
+            cgi.escape(urllib.quote(p.endpoint), True),
+            cgi.escape(p.endpoint), p.elapsedMs, p.key.id(), p.key.id())
+        for p in profiles)
+    title = 'Request profiles' + (' for %s' % cgi.escape(endpoint) if endpoint else '')
+    return ('<html><head><title>%s</title></head><body><h1>%s</h1>'
+            '<p><a href="/admin/profiles">all endpoints</a></p>'
+            '<table><tr><th>When (UTC)</th><th>Endpoint</th><th>Time</th>'
+            '<th></th></tr>%s</table></body></html>' % (title, title, rows))
+
+
+def renderProfile(profile, sort='cumulative'):
+    """Return an HTML page with a RequestProfile's top functions."""
+    title = '%s, %d ms, %s UTC' % (cgi.escape(profile.endpoint),
+        profile.elapsedMs, profile.created.strftime('%Y-%m-%d %H:%M:%S'))
+    return ('<html><head><title>%s</title></head><body><h1>%s</h1>'
+            '<p>sort by <a href="?sort=cumulative">cumulative</a> '
+            '<a href="?sort=tottime">tottime</a> '
+            '<a href="?sort=ncalls">calls</a> | '
+            '<a href="/admin/profiles/%d.pstats">download</a></p>'
+            '<pre>%s</pre></body></html>' % (title, title, profile.key.id(),
+                cgi.escape(topFunctions(profile, sort))))
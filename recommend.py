@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+"""recommend.py
+
+"Attendees also wishlisted" session recommendations, computed in batch.
+
+For each conference, SessionCooccurrence counts how many profiles have
+wishlisted each pair of its sessions. The counts are a packed array('I')
+of the lower triangle, where the pair i < j is at j * (j - 1) / 2 + i, so
+a new session only appends a row. From them every session gets a
+SessionNeighbors list of the sessions most often wishlisted with it,
+which getRecommendedSessions merges at request time.
+
+The job (/crons/compute_recommendations, chained over cursors) only
+reads the UserWishlist entries modified since its last run, or all of
+them on the first run. For each profile found, it compares the profile's
+wishlist in each conference with the WishlistSnapshot last counted and
+applies the difference to the counts in the same transaction that
+writes the new snapshot, so a retried batch counts nothing twice.
+
+"""
+
+import heapq
+from array import array
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.ext import ndb
+
+from models import RecommendationRun
+from models import SessionCooccurrence
+from models import SessionNeighbors
+from models import UserWishlist
+from models import WishlistSnapshot
+
+RECOMMEND_BATCH = 100
+TOP_NEIGHBORS = 10
+RECOMMENDATIONS = 10
+RUN_ID = 'wishlist'
+# modified queries are eventually consistent; reread a little of the
+# previous run, which the snapshots make harmless
+RUN_OVERLAP = timedelta(seconds=60)
+# a run still unfinished after this long is taken to have died, and a new
+# start may replace it
+RUN_TIMEOUT = timedelta(hours=6)
+# one conference's counts plus this many snapshots stay within the 25
+# entity groups of a cross-group transaction
+SNAPSHOTS_PER_TRANSACTION = 24
+
+
+class _Counts(object):
+    """Co-occurrence counts of one conference's sessions."""
+
+    def __init__(self, entity):
+        self.entity = entity
+        self.sessions = list(entity.sessions)
+        self.index = dict((wssk, i) for i, wssk in enumerate(self.sessions))
+        self.counts = array('I')
+        if entity.counts:
+            self.counts.fromstring(entity.counts)
+
+    def _indexOf(self, wssk):
+        i = self.index.get(wssk)
+        if i is None:
+            i = self.index[wssk] = len(self.sessions)
+            self.sessions.append(wssk)
+            # the new row holds the pairs (0, i) .. (i - 1, i)
+            self.counts.extend([0] * i)
+        return i
+
+    def add(self, sessions, delta):
+        """Add delta to the count of every pair of sessions."""
+        indexes = sorted(self._indexOf(wssk) for wssk in set(sessions))
+        for b, j in enumerate(indexes):
+            for i in indexes[:b]:
+                pair = j * (j - 1) // 2 + i
+                self.counts[pair] = max(0, self.counts[pair] + delta)
+
+    def save(self):
+        self.entity.sessions = self.sessions
+        self.entity.counts = self.counts.tostring()
+        return self.entity
+
+    def neighbors(self, k=TOP_NEIGHBORS):
+        """Return SessionNeighbors for every session."""
+        rows = [[] for _ in self.sessions]
+        pair = 0
+        for j in range(1, len(self.sessions)):
+            for i in range(j):
+                count = self.counts[pair]
+                pair += 1
+                if count:
+                    rows[i].append((count, j))
+                    rows[j].append((count, i))
+        result = []
+        for wssk, row in zip(self.sessions, rows):
+            top = heapq.nlargest(k, row)
+            result.append(SessionNeighbors(id=wssk,
+                neighbors=[self.sessions[j] for count, j in top],
+                scores=[count for count, j in top]))
+        return result
+
+
+@ndb.transactional(xg=True)
+def _applyWishlists(wsck, wishlists):
+    # wishlists: [(p_key, websafe keys of its sessions in this conference)]
+    s_keys = [ndb.Key(WishlistSnapshot, wsck, parent=p_key)
+              for p_key, sessions in wishlists]
+    found = ndb.get_multi([ndb.Key(SessionCooccurrence, wsck)] + s_keys)
+    counts = _Counts(found[0] or SessionCooccurrence(id=wsck))
+
+    changed = []
+    for s_key, snapshot, (p_key, sessions) in zip(s_keys, found[1:], wishlists):
+        old = snapshot.sessions if snapshot else []
+        if set(old) != set(sessions):
+            counts.add(old, -1)
+            counts.add(sessions, 1)
+            changed.append(WishlistSnapshot(key=s_key, sessions=sessions))
+    if not changed:
+        return None
+    ndb.put_multi([counts.save()] + changed)
+    return counts
+
+
+def _wishlistsByConference(p_keys):
+    """Return {conference websafe key: [(p_key, session websafe keys)]},
+    including the conferences each profile has a snapshot for."""
+    reads = [(p_key, UserWishlist.query(ancestor=p_key).fetch_async(),
+              WishlistSnapshot.query(ancestor=p_key).fetch_async(keys_only=True))
+             for p_key in p_keys]
+    byConference = {}
+    for p_key, entries, snapshots in reads:
+        mine = dict((s_key.id(), set()) for s_key in snapshots.get_result())
+        for entry in entries.get_result():
+            wsck = ndb.Key(urlsafe=entry.wishlistedSessionKey).parent().urlsafe()
+            mine.setdefault(wsck, set()).add(entry.wishlistedSessionKey)
+        for wsck, sessions in mine.iteritems():
+            byConference.setdefault(wsck, []).append((p_key, sorted(sessions)))
+    return byConference
+
+
+@ndb.transactional
+def _beginRun():
+    run = RecommendationRun.get_by_id(RUN_ID) or RecommendationRun(id=RUN_ID)
+    now = datetime.utcnow()
+    if run.started and now - run.started < RUN_TIMEOUT:
+        return run, False
+    run.started = now
+    run.put()
+    return run, True
+
+
+def startRecommendations():
+    """Begin a run of the recommendation job. Return False, and leave it
+    alone, if a run is already in progress."""
+    return _beginRun()[1]
+
+
+def computeRecommendations(cursor=None):
+    """Process one batch of changed wishlists; return the cursor for the
+    next batch, or None when the run is done. Used by the
+    compute_recommendations task."""
+    run = RecommendationRun.get_by_id(RUN_ID)
+    if run is None or run.started is None:
+        if cursor:
+            # left over from a run that has finished
+            return None
+        # enqueued without the cron start
+        run = _beginRun()[0]
+    if run.watermark:
+        q = UserWishlist.query(UserWishlist.modified > run.watermark,
+                               UserWishlist.modified <= run.started) \
+            .order(UserWishlist.modified)
+    else:
+        # first run: key order keeps each profile's entries together
+        q = UserWishlist.query().order(UserWishlist.key)
+    w_keys, next_cursor, more = q.fetch_page(
+        RECOMMEND_BATCH, start_cursor=cursor, keys_only=True)
+
+    p_keys = []
+    for w_key in w_keys:
+        if w_key.parent() not in p_keys:
+            p_keys.append(w_key.parent())
+    for wsck, wishlists in _wishlistsByConference(p_keys).iteritems():
+        counts = None
+        for i in range(0, len(wishlists), SNAPSHOTS_PER_TRANSACTION):
+            counts = _applyWishlists(wsck,
+                wishlists[i:i + SNAPSHOTS_PER_TRANSACTION]) or counts
+        if counts:
+            ndb.put_multi(counts.neighbors())
+
+    if more and next_cursor:
+        return next_cursor
+    run.watermark = run.started - RUN_OVERLAP
+    run.started = None
+    run.put()
+    return None
+
+
+def recommendedSessionKeys(wishlisted, limit=RECOMMENDATIONS):
+    """Return the websafe keys of up to limit sessions most often
+    wishlisted together with the websafe session keys in wishlisted."""
+    scores = {}
+    for neighbors in ndb.get_multi([ndb.Key(SessionNeighbors, wssk)
+                                    for wssk in wishlisted]):
+        if neighbors:
+            for wssk, score in zip(neighbors.neighbors, neighbors.scores):
+                scores[wssk] = scores.get(wssk, 0) + score
+    for wssk in wishlisted:
+        scores.pop(wssk, None)
+    return heapq.nlargest(limit, scores, key=scores.get)
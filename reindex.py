@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""reindex.py
+
+Rewrites stored entities after properties were switched to
+indexed=False, so their old index rows are deleted; until an entity is
+written again the datastore keeps writing and storing those rows. Each
+phase walks one kind in key order and rewrites every entity group of a
+batch in its own transaction, all of them in parallel.
+
+A rewrite changes nothing a client sees, so it keeps each entity's
+`modified` time (keepModified, see ModifiedProperty in models.py) and
+delta sync clients don't fetch the whole dataset again.
+
+Composite indexes dropped from index.yaml are deleted separately, with
+`appcfg.py vacuum_indexes` once the new index.yaml is deployed.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+from models import Registration
+from models import Session
+
+REINDEX_BATCH = 100
+REINDEX_PHASES = (Conference, Session, Profile, Registration)
+
+
+@ndb.transactional_tasklet
+def _rewriteGroup(keys):
+    entities = [entity for entity in (yield ndb.get_multi_async(keys))
+                if entity]
+    for entity in entities:
+        entity.keepModified = True
+    yield ndb.put_multi_async(entities)
+
+
+def reindex(phase=None, cursor=None):
+    """Rewrite one batch of a phase's kind; return the (phase, cursor) to
+    continue with, or None when every kind is done. Used by the reindex
+    task."""
+    phases = [model._get_kind() for model in REINDEX_PHASES]
+    phase = phase or phases[0]
+    model = REINDEX_PHASES[phases.index(phase)]
+    keys, next_cursor, more = model.query().fetch_page(
+        REINDEX_BATCH, start_cursor=cursor, keys_only=True)
+
+    groups = {}
+    for key in keys:
+        groups.setdefault(key.root(), []).append(key)
+    futures = [_rewriteGroup(group) for group in groups.itervalues()]
+    for future in futures:
+        future.get_result()
+
+    if more and next_cursor:
+        return phase, next_cursor
+    following = phases.index(phase) + 1
+    if following < len(phases):
+        return phases[following], None
+    return None
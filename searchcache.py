@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""searchcache.py
+
+Result cache for conference searches (queryConferences,
+getConferencesByCity, getConferencesByExactTopic).
+
+A search is cached as its ordered list of Conference keys. The memcache
+key is built from a canonical form of its filters and order, plus the
+current generation of the catalog and of every field the search filters
+or sorts on. Writes never delete entries; they bump generations so that
+stale entries are no longer looked up:
+
+- creating, archiving or moving a conference changes which conferences
+  exist, so it bumps the catalog generation;
+- updating a conference bumps the generations of the fields that changed;
+- registering only changes seatsAvailable, which no search filters on,
+  so it bumps nothing.
+
+Cached keys are hydrated with get_multi, which ndb serves from its
+memcache entity cache, so a popular search runs no query at all and
+still shows current seat counts.
+
+searchConferenceKeysWithin() reads the keys a page at a time, only as
+many as the caller will show, and stops when the request budget runs
+out. The keys read so far are cached with the query cursor, and the next
+call for the same search resumes the query from there.
+
+A generation missing from memcache starts at the current time in
+milliseconds, so an evicted counter doesn't return to a value that old
+entries were stored under.
+
+"""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+SEARCH_PREFIX = 'search:v2:'
+GENERATION_PREFIX = 'generation:'
+CATALOG = 'catalog'
+SEARCH_FIELDS = ('city', 'topics', 'month', 'maxAttendees', 'name')
+# bounds how long a search run just after a write, which the eventually
+# consistent query may not have seen yet, can stay cached
+SEARCH_TTL = 5 * 60
+# most keys read by one query round trip
+SEARCH_KEYS_BATCH = 1000
+
+
+def _generations(names):
+    keys = [GENERATION_PREFIX + name for name in names]
+    found = memcache.get_multi(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        start = int(time.time() * 1000)
+        memcache.add_multi(dict((key, start) for key in missing))
+        found.update(memcache.get_multi(missing))
+    if len(found) < len(keys):
+        return None     # memcache unavailable
+    return [found[key] for key in keys]
+
+
+def bumpGenerations(fields=None):
+    """Invalidate cached searches on fields, or all of them when fields is
+    None. Inside a transaction this happens once it has committed."""
+    names = [CATALOG] if fields is None else \
+        [field for field in fields if field in SEARCH_FIELDS]
+    if names:
+        # a missing counter is left missing; the next read restarts it
+        ndb.get_context().call_on_commit(lambda: memcache.offset_multi(
+            dict((GENERATION_PREFIX + name, 1) for name in names)))
+
+
+def searchFields(conf):
+    """Return the values of conf that searches filter or sort on, for
+    comparison with changedFields()."""
+    values = dict((field, getattr(conf, field)) for field in SEARCH_FIELDS)
+    # a put converts a repeated property's list in place; keep a copy
+    values['topics'] = list(values['topics'])
+    return values
+
+
+def changedFields(before, conf):
+    """Return the search fields of conf that differ from before."""
+    return [field for field, value in before.iteritems()
+            if getattr(conf, field) != value]
+
+
+def _searchKey(q, filters):
+    """Return the memcache key of q's result, or None when memcache is
+    unavailable."""
+    names = sorted(set([CATALOG, 'name'] + [filtr['field'] for filtr in filters]))
+    generations = _generations(names)
+    if generations is None:
+        return None
+
+    canonical = repr((
+        sorted((f['field'], f['operator'], f['value']) for f in filters),
+        repr(q.orders), zip(names, generations)))
+    return SEARCH_PREFIX + hashlib.md5(canonical).hexdigest()
+
+
+def searchConferenceKeysWithin(q, filters, budget, needed=None):
+    """Return (c_keys, complete): the keys of the Conferences found by q,
+    through the cache, read until there are needed of them, q has no more
+    or budget runs out. complete is False while q may have more.
+
+    filters are q's filters as formatted by ConferenceApi._formatFilters,
+    with month and maxAttendees values as ints; with q's order they must
+    determine its result.
+    """
+    key = _searchKey(q, filters)
+    c_keys, cursor, more = key and memcache.get(key) or ([], None, True)
+    fetched = False
+    while more and (needed is None or len(c_keys) < needed) and \
+            not (budget and budget.expired()):
+        limit = SEARCH_KEYS_BATCH if needed is None else \
+            min(SEARCH_KEYS_BATCH, needed - len(c_keys))
+        page, cursor, more = q.fetch_page(limit, start_cursor=cursor,
+                                          keys_only=True)
+        c_keys = c_keys + page
+        fetched = True
+    if key and fetched:
+        memcache.set(key, (c_keys, cursor, more), time=SEARCH_TTL)
+    return c_keys, not more
+
+
+def searchConferenceKeys(q, filters):
+    """Return the keys of all the Conferences found by q, through the
+    cache; see searchConferenceKeysWithin()."""
+    return searchConferenceKeysWithin(q, filters, None)[0]
+
+
+def resultVersion(c_keys):
+    """Return a short digest of a search result, for page tokens that may
+    only resume the result they were issued for."""
+    return hashlib.md5(''.join(c_key.serialized() for c_key in c_keys)) \
+        .hexdigest()[:12]
+
+
+def searchConferences(q, filters):
+    """Return the Conferences found by q, through the cache; see
+    searchConferenceKeys()."""
+    return [conf for conf in ndb.get_multi(searchConferenceKeys(q, filters))
+            if conf]
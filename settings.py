@@ -16,3 +16,15 @@ WEB_CLIENT_ID = '649222326679-372fa68952cdj82vatu26mni3ehg7olh.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Request profiler (see profiler.py). Requests carrying this token in an
+# X-Profile header or a `profile` query parameter are profiled, as is
+# this fraction of all traffic; leave both empty to turn it off.
+PROFILER_TOKEN = ''
+PROFILER_SAMPLE_RATE = 0.0
+
+# Request budget (see budget.py). Endpoints that iterate over query
+# results stop after this many seconds, or this many results, and return
+# what they have with a pageToken to resume from.
+REQUEST_BUDGET = 45
+MAX_RESULTS = 500
@@ -130,3 +130,404 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+
+/**
+ * @ngdoc service
+ * @name conferenceApi
+ *
+ * @description
+ * Data layer in front of gapi.client.conference. Its methods take the same parameters and return an object
+ * with the same execute(callback) as the generated client, and call back outside the Angular digest like it.
+ *
+ * - Calls made in the same tick are sent together in one gapi.client.newBatch round trip.
+ * - A read that is already queued or in flight with the same parameters shares that request.
+ * - Reads listed in CACHE_TTLS are kept in localStorage for their TTL, under a versioned prefix. Reads in
+ *   USER_METHODS answer for the signed-in user, so they are kept under the user's email, set with setUser,
+ *   and not kept at all until it is known.
+ * - Registering and unregistering update the cached profile, conference and lists at once, and undo the
+ *   update if the server refuses.
+ *
+ * stats counts calls, round trips, cache hits and shared requests, for checking request volume from a
+ * headless browser through angular.element(document.body).injector().get('conferenceApi').stats.
+ */
+app.factory('conferenceApi', function () {
+    var CACHE_PREFIX = 'conferenceApi:v1:';
+
+    /**
+     * Milliseconds each cacheable read is kept for.
+     */
+    var CACHE_TTLS = {
+        getProfile: 5 * 60 * 1000,
+        getConference: 5 * 60 * 1000,
+        getConferencesToAttend: 60 * 1000,
+        getConferencesCreated: 60 * 1000,
+        queryConferences: 60 * 1000
+    };
+
+    /**
+     * Reads whose results depend on who is signed in.
+     */
+    var USER_METHODS = ['getProfile', 'getConferencesToAttend', 'getConferencesCreated'];
+
+    /**
+     * Reads whose results list conferences, whose seat counts registering changes.
+     */
+    var LIST_METHODS = ['getConferencesToAttend', 'getConferencesCreated', 'queryConferences'];
+
+    var READ_METHODS = ['getProfile', 'getConference', 'getConferencesToAttend', 'getConferencesCreated',
+        'queryConferences', 'suggest', 'getConferenceStats', 'getOrganizerReport'];
+
+    var WRITE_METHODS = ['saveProfile', 'createConference', 'updateConference',
+        'registerForConference', 'unregisterFromConference'];
+
+    var conferenceApi = {
+        stats: {calls: 0, roundTrips: 0, cacheHits: 0, shared: 0}
+    };
+
+    var queue = [];
+    var inFlight = {};
+    var flushScheduled = false;
+    var user = null;
+
+    var storage = (function () {
+        try {
+            window.localStorage.setItem(CACHE_PREFIX + 'probe', '1');
+            window.localStorage.removeItem(CACHE_PREFIX + 'probe');
+            return window.localStorage;
+        } catch (e) {
+            // Storage disabled or full: run without the cache.
+            return null;
+        }
+    })();
+
+    var keyFor = function (method, params) {
+        var owner = USER_METHODS.indexOf(method) >= 0 ? encodeURIComponent(user || '') + ':' : '';
+        return method + ':' + owner + JSON.stringify(params || {});
+    };
+
+    /**
+     * Tests if the results of method may be kept in the cache now.
+     */
+    var cacheable = function (method) {
+        return !!CACHE_TTLS[method] && (user !== null || USER_METHODS.indexOf(method) < 0);
+    };
+
+    var readCache = function (key) {
+        if (!storage || key === null) {
+            return null;
+        }
+        var entry = JSON.parse(storage.getItem(CACHE_PREFIX + key) || 'null');
+        if (entry && entry.expires > new Date().getTime()) {
+            return entry;
+        }
+        return null;
+    };
+
+    var writeCache = function (key, body, expires) {
+        if (!storage || key === null) {
+            return;
+        }
+        try {
+            storage.setItem(CACHE_PREFIX + key, JSON.stringify({expires: expires, body: body}));
+        } catch (e) {
+            // Over quota: start again from an empty cache.
+            conferenceApi.clearCache();
+        }
+    };
+
+    var cacheKeys = function (method) {
+        var keys = [];
+        if (storage) {
+            for (var i = 0; i < storage.length; i++) {
+                var key = storage.key(i);
+                if (key.indexOf(CACHE_PREFIX + (method ? method + ':' : '')) == 0) {
+                    keys.push(key.substring(CACHE_PREFIX.length));
+                }
+            }
+        }
+        return keys;
+    };
+
+    var removeCache = function (key) {
+        if (storage && key !== null) {
+            storage.removeItem(CACHE_PREFIX + key);
+        }
+    };
+
+    /**
+     * Applies update to the cached body under key, if there is one, keeping its expiry.
+     */
+    var updateCache = function (key, update) {
+        var entry = readCache(key);
+        if (entry) {
+            update(entry.body);
+            writeCache(key, entry.body, entry.expires);
+        }
+    };
+
+    /**
+     * Shapes a body like the responses of the generated client: its fields, plus result, plus error and
+     * code when it failed.
+     */
+    var response = function (body) {
+        var resp = angular.extend({}, body, {result: body});
+        if (body && body.error) {
+            resp.error = body.error;
+            resp.code = body.error.code;
+        }
+        return resp;
+    };
+
+    var deliver = function (pending, body) {
+        delete inFlight[pending.key];
+        var failed = !body || body.error;
+        if (!failed && pending.cacheable) {
+            writeCache(pending.key, body, new Date().getTime() + CACHE_TTLS[pending.method]);
+        }
+        angular.forEach(pending.callbacks, function (callback) {
+            callback(response(body || {error: {message: 'No response'}}));
+        });
+    };
+
+    var flush = function () {
+        flushScheduled = false;
+        var batch = queue;
+        queue = [];
+        conferenceApi.stats.roundTrips++;
+        if (batch.length == 1) {
+            batch[0].request.execute(function (resp) {
+                deliver(batch[0], resp && resp.result !== undefined ? resp.result : resp);
+            });
+            return;
+        }
+        var httpBatch = gapi.client.newBatch();
+        angular.forEach(batch, function (pending, i) {
+            httpBatch.add(pending.request, {id: String(i)});
+        });
+        httpBatch.execute(function (responses) {
+            angular.forEach(batch, function (pending, i) {
+                var resp = responses && responses[String(i)];
+                deliver(pending, resp && resp.result !== undefined ? resp.result : resp);
+            });
+        });
+    };
+
+    /**
+     * Queues a call for the next round trip, or joins the identical read already queued or in flight.
+     */
+    var send = function (method, params, callback) {
+        conferenceApi.stats.calls++;
+        var key = keyFor(method, params);
+        var shareable = READ_METHODS.indexOf(method) >= 0;
+        if (shareable && inFlight[key]) {
+            conferenceApi.stats.shared++;
+            inFlight[key].callbacks.push(callback);
+            return;
+        }
+        var pending = {
+            key: key,
+            method: method,
+            cacheable: cacheable(method),
+            request: gapi.client.conference[method](params || {}),
+            callbacks: [callback]
+        };
+        if (shareable) {
+            inFlight[key] = pending;
+        }
+        queue.push(pending);
+        if (!flushScheduled) {
+            flushScheduled = true;
+            window.setTimeout(flush, 0);
+        }
+    };
+
+    /**
+     * Returns the cache key of a user's read without parameters, or null while the user is unknown.
+     */
+    var userKey = function (method) {
+        return user === null ? null : keyFor(method);
+    };
+
+    /**
+     * Changes the cached profile, conference and conference lists as if the user had registered for
+     * (attending true) or unregistered from the conference, and returns a function that undoes it.
+     */
+    var applyAttendance = function (websafeConferenceKey, attending) {
+        var keys = [userKey('getProfile'), keyFor('getConference', {websafeConferenceKey: websafeConferenceKey})];
+        angular.forEach(LIST_METHODS, function (method) {
+            keys = keys.concat(cacheKeys(method));
+        });
+        var saved = {};
+        angular.forEach(keys, function (key) {
+            if (key !== null) {
+                saved[key] = readCache(key);
+            }
+        });
+        var seats = attending ? -1 : 1;
+
+        updateCache(keys[0], function (profile) {
+            var attended = profile.conferenceKeysToAttend || [];
+            var i = attended.indexOf(websafeConferenceKey);
+            if (attending && i < 0) {
+                attended.push(websafeConferenceKey);
+            } else if (!attending && i >= 0) {
+                attended.splice(i, 1);
+            }
+            profile.conferenceKeysToAttend = attended;
+        });
+        var conference = null;
+        updateCache(keys[1], function (conf) {
+            conf.seatsAvailable += seats;
+            conference = conf;
+        });
+        angular.forEach(keys.slice(2), function (key) {
+            updateCache(key, function (list) {
+                angular.forEach(list.items || [], function (conf) {
+                    if (conf.websafeKey == websafeConferenceKey) {
+                        conf.seatsAvailable += seats;
+                    }
+                });
+            });
+        });
+        var attendKey = userKey('getConferencesToAttend');
+        if (attending && !conference) {
+            // Nothing to add to the list with; read it again next time.
+            removeCache(attendKey);
+        } else {
+            updateCache(attendKey, function (list) {
+                list.items = (list.items || []).filter(function (conf) {
+                    return conf.websafeKey != websafeConferenceKey;
+                });
+                if (attending) {
+                    list.items.push(conference);
+                }
+            });
+        }
+
+        return function () {
+            angular.forEach(saved, function (entry, key) {
+                if (entry) {
+                    writeCache(key, entry.body, entry.expires);
+                } else {
+                    removeCache(key);
+                }
+            });
+        };
+    };
+
+    /**
+     * Runs the effects of a successful write on the cache.
+     */
+    var afterWrite = {
+        saveProfile: function (params, body) {
+            updateCache(userKey('getProfile'), function (profile) {
+                angular.extend(profile, body);
+            });
+        },
+        createConference: function () {
+            angular.forEach(['getConferencesCreated', 'queryConferences'], function (method) {
+                angular.forEach(cacheKeys(method), removeCache);
+            });
+        },
+        updateConference: function (params) {
+            removeCache(keyFor('getConference', {websafeConferenceKey: params.websafeConferenceKey}));
+            angular.forEach(LIST_METHODS, function (method) {
+                angular.forEach(cacheKeys(method), removeCache);
+            });
+        }
+    };
+
+    var makeMethod = function (method) {
+        var read = READ_METHODS.indexOf(method) >= 0;
+        return function (params) {
+            return {
+                execute: function (callback) {
+                    if (read && cacheable(method)) {
+                        var entry = readCache(keyFor(method, params));
+                        if (entry) {
+                            conferenceApi.stats.calls++;
+                            conferenceApi.stats.cacheHits++;
+                            window.setTimeout(function () {
+                                callback(response(entry.body));
+                            }, 0);
+                            return;
+                        }
+                    }
+                    var undo = null;
+                    if (method == 'registerForConference' || method == 'unregisterFromConference') {
+                        undo = applyAttendance(params.websafeConferenceKey, method == 'registerForConference');
+                    }
+                    send(method, params, function (resp) {
+                        var refused = resp.error || (resp.result && resp.result.data === false);
+                        if (refused && undo) {
+                            undo();
+                        } else if (!refused && afterWrite[method]) {
+                            afterWrite[method](params, resp.result);
+                        }
+                        callback(resp);
+                    });
+                }
+            };
+        };
+    };
+
+    angular.forEach(READ_METHODS.concat(WRITE_METHODS), function (method) {
+        conferenceApi[method] = makeMethod(method);
+    });
+
+    /**
+     * Sets the email of the signed-in user, or null when nobody is, whose cached reads are served.
+     */
+    conferenceApi.setUser = function (email) {
+        user = email || null;
+    };
+
+    /**
+     * Drops every cached response, e.g. when the user signs out.
+     */
+    conferenceApi.clearCache = function () {
+        angular.forEach(cacheKeys(), removeCache);
+    };
+
+    return conferenceApi;
+});
+
+/**
+ * @ngdoc service
+ * @name suggestTerms
+ *
+ * @description
+ * Typeahead source backed by the conference.suggest API. suggestTerms(field, prefix, defaults) returns a
+ * promise of the terms of field ('topics', 'city' or 'speaker') starting with prefix, most common first,
+ * followed by the matching defaults the server does not know yet.
+ */
+app.factory('suggestTerms', function ($q, $rootScope, conferenceApi) {
+    var startsWith = function (term, prefix) {
+        return term.toLowerCase().indexOf(prefix.toLowerCase()) == 0;
+    };
+
+    return function (field, prefix, defaults) {
+        var deferred = $q.defer();
+        if (!prefix) {
+            deferred.resolve([]);
+            return deferred.promise;
+        }
+        conferenceApi.suggest({field: field, prefix: prefix}).
+            execute(function (resp) {
+                $rootScope.$apply(function () {
+                    var terms = resp.error || !resp.items ? [] :
+                        resp.items.map(function (item) {
+                            return item.term;
+                        });
+                    angular.forEach(defaults || [], function (term) {
+                        if (startsWith(term, prefix) && terms.indexOf(term) < 0) {
+                            terms.push(term);
+                        }
+                    });
+                    deferred.resolve(terms);
+                });
+            });
+        return deferred.promise;
+    };
+});
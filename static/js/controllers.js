@@ -25,7 +25,7 @@ conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstr
  * A controller used for the My Profile page.
  */
 conferenceApp.controllers.controller('MyProfileCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, conferenceApi, HTTP_ERRORS) {
         $scope.submitted = false;
         $scope.loading = false;
 
@@ -63,7 +63,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
             var retrieveProfileCallback = function () {
                 $scope.profile = {};
                 $scope.loading = true;
-                gapi.client.conference.getProfile().
+                conferenceApi.getProfile().
                     execute(function (resp) {
                         $scope.$apply(function () {
                             $scope.loading = false;
@@ -94,7 +94,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
         $scope.saveProfile = function () {
             $scope.submitted = true;
             $scope.loading = true;
-            gapi.client.conference.saveProfile($scope.profile).
+            conferenceApi.saveProfile($scope.profile).
                 execute(function (resp) {
                     $scope.$apply(function () {
                         $scope.loading = false;
@@ -135,7 +135,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
  * A controller used for the Create conferences page.
  */
 conferenceApp.controllers.controller('CreateConferenceCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, conferenceApi, suggestTerms, HTTP_ERRORS) {
 
         /**
          * The conference object being edited in the page.
@@ -167,6 +167,40 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
             'Health and Nutrition'
         ];
 
+        /**
+         * Typeahead source for the city and topic inputs.
+         *
+         * @param field 'city' or 'topics'.
+         * @param prefix what has been typed so far.
+         * @returns a promise of the suggested terms.
+         */
+        $scope.suggest = function (field, prefix) {
+            return suggestTerms(field, prefix, field == 'city' ? $scope.cities : $scope.topics);
+        };
+
+        /**
+         * The topic being typed in the page, before it is added.
+         * @type {string}
+         */
+        $scope.newTopic = '';
+
+        /**
+         * Adds $scope.newTopic to the candidates and selects it.
+         */
+        $scope.addTopic = function () {
+            var topic = ($scope.newTopic || '').trim();
+            if (topic) {
+                if ($scope.topics.indexOf(topic) < 0) {
+                    $scope.topics.push(topic);
+                }
+                $scope.conference.topics = $scope.conference.topics || [];
+                if ($scope.conference.topics.indexOf(topic) < 0) {
+                    $scope.conference.topics.push(topic);
+                }
+            }
+            $scope.newTopic = '';
+        };
+
         /**
          * Tests if the arugment is an integer and not negative.
          * @returns {boolean} true if the argument is an integer, false otherwise.
@@ -214,7 +248,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
             }
 
             $scope.loading = true;
-            gapi.client.conference.createConference($scope.conference).
+            conferenceApi.createConference($scope.conference).
                 execute(function (resp) {
                     $scope.$apply(function () {
                         $scope.loading = false;
@@ -249,7 +283,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $q, oauth2Provider, conferenceApi, suggestTerms, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -408,6 +442,25 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         }
     };
 
+    /**
+     * Suggestion fields of the filterable fields that have them.
+     */
+    var suggestFields = {CITY: 'city', TOPIC: 'topics'};
+
+    /**
+     * Typeahead source for a filter value.
+     *
+     * @param enumValue the enumValue of the filter's field.
+     * @param prefix what has been typed so far.
+     * @returns a promise of the suggested terms.
+     */
+    $scope.suggest = function (enumValue, prefix) {
+        if (!suggestFields[enumValue]) {
+            return $q.when([]);
+        }
+        return suggestTerms(suggestFields[enumValue], prefix);
+    };
+
     /**
      * Query the conferences depending on the tab currently selected.
      *
@@ -441,7 +494,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
             }
         }
         $scope.loading = true;
-        gapi.client.conference.queryConferences(sendFilters).
+        conferenceApi.queryConferences(sendFilters).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -473,7 +526,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesCreated = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        conferenceApi.getConferencesCreated().
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -511,7 +564,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesAttend = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
+        conferenceApi.getConferencesToAttend().
             execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.error) {
@@ -547,7 +600,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, oauth2Provider, conferenceApi, HTTP_ERRORS) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
@@ -559,7 +612,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        conferenceApi.getConference({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -581,7 +634,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
         $scope.loading = true;
         // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
+        conferenceApi.getProfile().execute(function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
@@ -602,18 +655,31 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
     };
 
 
+    /**
+     * Shows the user as attending or not, and the seats left accordingly.
+     *
+     * @param attending
+     */
+    var showAttendance = function (attending) {
+        if ($scope.isUserAttending != attending) {
+            $scope.conference.seatsAvailable += attending ? -1 : 1;
+            $scope.isUserAttending = attending;
+        }
+    };
+
     /**
      * Invokes the conference.registerForConference method.
+     * The page shows the registration straight away and takes it back if the server refuses.
      */
     $scope.registerForConference = function () {
-        $scope.loading = true;
-        gapi.client.conference.registerForConference({
+        showAttendance(true);
+        conferenceApi.registerForConference({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
-                $scope.loading = false;
                 if (resp.error) {
                     // The request has failed.
+                    showAttendance(false);
                     var errorMessage = resp.error.message || '';
                     $scope.messages = 'Failed to register for the conference : ' + errorMessage;
                     $scope.alertStatus = 'warning';
@@ -624,13 +690,12 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                         return;
                     }
                 } else {
-                    if (resp.result) {
+                    if (resp.result.data !== false) {
                         // Register succeeded.
                         $scope.messages = 'Registered for the conference';
                         $scope.alertStatus = 'success';
-                        $scope.isUserAttending = true;
-                        $scope.conference.seatsAvailable = $scope.conference.seatsAvailable - 1;
                     } else {
+                        showAttendance(false);
                         $scope.messages = 'Failed to register for the conference';
                         $scope.alertStatus = 'warning';
                     }
@@ -641,16 +706,17 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
     /**
      * Invokes the conference.unregisterForConference method.
+     * The page shows the unregistration straight away and takes it back if the server refuses.
      */
     $scope.unregisterFromConference = function () {
-        $scope.loading = true;
-        gapi.client.conference.unregisterFromConference({
+        showAttendance(false);
+        conferenceApi.unregisterFromConference({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
-                $scope.loading = false;
                 if (resp.error) {
                     // The request has failed.
+                    showAttendance(true);
                     var errorMessage = resp.error.message || '';
                     $scope.messages = 'Failed to unregister from the conference : ' + errorMessage;
                     $scope.alertStatus = 'warning';
@@ -660,17 +726,13 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                         return;
                     }
                 } else {
-                    if (resp.result) {
+                    if (resp.result.data !== false) {
                         // Unregister succeeded.
                         $scope.messages = 'Unregistered from the conference';
                         $scope.alertStatus = 'success';
-                        $scope.conference.seatsAvailable = $scope.conference.seatsAvailable + 1;
-                        $scope.isUserAttending = false;
                         $log.info($scope.messages);
                     } else {
-                        var errorMessage = resp.error.message || '';
-                        $scope.messages = 'Failed to unregister from the conference : ' + $routeParams.websafeKey +
-                            ' : ' + errorMessage;
+                        showAttendance(true);
                         $scope.messages = 'Failed to unregister from the conference';
                         $scope.alertStatus = 'warning';
                         $log.error($scope.messages);
@@ -691,7 +753,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
  * such as user authentications.
  *
  */
-conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider) {
+conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider, conferenceApi) {
 
     /**
      * Returns if the viewLocation is the currently viewed page.
@@ -720,6 +782,7 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
             gapi.client.oauth2.userinfo.get().execute(function (resp) {
                 $scope.$apply(function () {
                     if (resp.email) {
+                        conferenceApi.setUser(resp.email);
                         oauth2Provider.signedIn = true;
                         $scope.alertStatus = 'success';
                         $scope.rootMessages = 'Logged in with ' + resp.email;
@@ -742,6 +805,10 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
                     $scope.$apply(function () {
                         oauth2Provider.signedIn = true;
                     });
+                    // The user's cached reads are served once it is known whose credential this is.
+                    gapi.client.oauth2.userinfo.get().execute(function (resp) {
+                        conferenceApi.setUser(resp.email);
+                    });
                 }
             },
             'clientid': oauth2Provider.CLIENT_ID,
@@ -755,6 +822,8 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
      */
     $scope.signOut = function () {
         oauth2Provider.signOut();
+        conferenceApi.setUser(null);
+        conferenceApi.clearCache();
         $scope.alertStatus = 'success';
         $scope.rootMessages = 'Logged out';
     };
@@ -778,10 +847,11 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
  *
  */
 conferenceApp.controllers.controller('OAuth2LoginModalCtrl',
-    function ($scope, $modalInstance, $rootScope, oauth2Provider) {
+    function ($scope, $modalInstance, $rootScope, oauth2Provider, conferenceApi) {
         $scope.singInViaModal = function () {
             oauth2Provider.signIn(function () {
                 gapi.client.oauth2.userinfo.get().execute(function (resp) {
+                    conferenceApi.clearCache();
                     $scope.$root.$apply(function () {
                         oauth2Provider.signedIn = true;
                         $scope.$root.alertStatus = 'success';
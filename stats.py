@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""stats.py
+
+Incrementally maintained conference statistics: sharded counters and a
+per-conference leaderboard of the most wishlisted sessions.
+
+Counters are split over COUNTER_SHARDS root entities so that concurrent
+increments don't contend on one entity group; their totals are cached in
+memcache. Leaderboards live in memcache and fall back to the durable
+ConferenceStats snapshot written by the reconciliation task.
+
+"""
+
+import logging
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import CounterShard
+from models import ConferenceStats
+from models import Registration
+from models import Session
+from models import SessionRank
+from models import TeeShirtTally
+from models import UserWishlist
+
+COUNTER_SHARDS = 10
+COUNTER_MEMCACHE_PREFIX = "counter:"
+LEADERBOARD_MEMCACHE_PREFIX = "leaderboard:"
+LEADERBOARD_SIZE = 10
+CAS_RETRIES = 5
+
+
+# - - - Sharded counters - - - - - - - - - - - - - - - - - - -
+
+def sessionCounterName(websafeConferenceKey):
+    return "sessions:" + websafeConferenceKey
+
+
+def wishlistCounterName(websafeSessionKey):
+    return "wishlist:" + websafeSessionKey
+
+
+def _shardKeys(name):
+    return [ndb.Key(CounterShard, "%s|%d" % (name, i))
+            for i in range(COUNTER_SHARDS)]
+
+
+@ndb.transactional
+def _incrementShard(shardKey, delta):
+    shard = shardKey.get() or CounterShard(key=shardKey)
+    shard.count += delta
+    shard.put()
+
+
+def incrementCounter(name, delta=1):
+    """Add delta to the named counter and return the cached total, or
+    None when the total isn't cached."""
+    _incrementShard(random.choice(_shardKeys(name)), delta)
+    # incr/decr leave a missing key alone, so the next read recomputes it
+    if delta >= 0:
+        return memcache.incr(COUNTER_MEMCACHE_PREFIX + name, delta)
+    return memcache.decr(COUNTER_MEMCACHE_PREFIX + name, -delta)
+
+
+def _shardTotal(name):
+    return sum(shard.count for shard in ndb.get_multi(_shardKeys(name))
+               if shard)
+
+
+def getCounter(name):
+    """Return the total of the named counter."""
+    key = COUNTER_MEMCACHE_PREFIX + name
+    total = memcache.get(key)
+    if total is None:
+        # an increment that commits while the shards are summed may find
+        # no total to incr yet; the second sum catches it, and the cached
+        # total is dropped so that the next read recomputes it
+        total = _shardTotal(name)
+        memcache.add(key, total)
+        if _shardTotal(name) != total:
+            memcache.delete(key)
+    return total
+
+
+@ndb.transactional(xg=True)
+def _resetShards(name, total):
+    # reading every shard makes a concurrent increment retry, so it is
+    # counted on top of total instead of being absorbed into it
+    keys = _shardKeys(name)
+    shards = ndb.get_multi(keys)
+    current = sum(shard.count for shard in shards if shard)
+    if current != total:
+        shard = shards[0] or CounterShard(key=keys[0])
+        shard.count += total - current
+        shard.put()
+
+
+def resetCounter(name, total):
+    """Bring the named counter to total, e.g. after recounting source data."""
+    _resetShards(name, total)
+    memcache.delete(COUNTER_MEMCACHE_PREFIX + name)
+
+
+# - - - Leaderboards - - - - - - - - - - - - - - - - - - - - -
+
+def _loadSnapshot(websafeConferenceKey):
+    return ndb.Key(ConferenceStats, websafeConferenceKey).get()
+
+
+def getLeaderboard(websafeConferenceKey):
+    """Return the conference's most wishlisted sessions as SessionRanks."""
+    board = memcache.get(LEADERBOARD_MEMCACHE_PREFIX + websafeConferenceKey)
+    if board is None:
+        snapshot = _loadSnapshot(websafeConferenceKey)
+        board = snapshot.topSessions if snapshot else []
+        memcache.add(LEADERBOARD_MEMCACHE_PREFIX + websafeConferenceKey, board)
+    return board
+
+
+def _mergeRank(board, rank):
+    """Return board with rank inserted or updated, or None if unchanged."""
+    others = [r for r in board if r.websafeKey != rank.websafeKey]
+    if len(others) == len(board) and len(board) >= LEADERBOARD_SIZE and \
+            rank.wishlistCount <= board[-1].wishlistCount:
+        return None
+    merged = sorted(others + [rank], key=lambda r: -r.wishlistCount)
+    return merged[:LEADERBOARD_SIZE]
+
+
+def _updateLeaderboard(websafeConferenceKey, rank):
+    key = LEADERBOARD_MEMCACHE_PREFIX + websafeConferenceKey
+    client = memcache.Client()
+    for i in range(CAS_RETRIES):
+        board = client.gets(key)
+        if board is None:
+            # seed from the durable snapshot, then retry with a CAS token
+            getLeaderboard(websafeConferenceKey)
+            continue
+        merged = _mergeRank(board, rank)
+        if merged is None or client.cas(key, merged):
+            return
+
+
+# - - - Write hooks - - - - - - - - - - - - - - - - - - - - -
+
+def recordSessionCreated(websafeConferenceKey):
+    """Called after a Session has been added to a conference. Inside a
+    transaction this happens once it has committed."""
+    ndb.get_context().call_on_commit(lambda: incrementCounter(
+        sessionCounterName(websafeConferenceKey)))
+
+
+def recordSessionWishlisted(theSession):
+    """Called after theSession has been added to a user's wishlist. Inside
+    a transaction this happens once it has committed."""
+    ndb.get_context().call_on_commit(lambda: _recordWishlisted(theSession))
+
+
+def _recordWishlisted(theSession):
+    wssk = theSession.key.urlsafe()
+    total = incrementCounter(wishlistCounterName(wssk))
+    if total is None:
+        total = getCounter(wishlistCounterName(wssk))
+    _updateLeaderboard(theSession.key.parent().urlsafe(), SessionRank(
+        websafeKey=wssk, name=theSession.name, wishlistCount=total))
+
+
+# - - - Reconciliation - - - - - - - - - - - - - - - - - - - -
+
+def reconcileConference(conf):
+    """Recompute a conference's counters and leaderboard from the
+    Session and UserWishlist entities, and store a fresh snapshot."""
+    wsck = conf.key.urlsafe()
+    sessions = Session.query(ancestor=conf.key).fetch()
+
+    # UserWishlist isn't scoped by conference, so count per session
+    futures = [UserWishlist.query(UserWishlist.wishlistedSessionKey ==
+        sess.key.urlsafe()).count_async() for sess in sessions]
+    ranks = []
+    for sess, future in zip(sessions, futures):
+        wssk = sess.key.urlsafe()
+        count = future.get_result()
+        resetCounter(wishlistCounterName(wssk), count)
+        if count:
+            ranks.append(SessionRank(websafeKey=wssk, name=sess.name,
+                wishlistCount=count))
+    resetCounter(sessionCounterName(wsck), len(sessions))
+
+    board = sorted(ranks, key=lambda r: -r.wishlistCount)[:LEADERBOARD_SIZE]
+    ConferenceStats(id=wsck, sessionCount=len(sessions),
+        topSessions=board).put()
+    memcache.set(LEADERBOARD_MEMCACHE_PREFIX + wsck, board)
+
+    reconcileTeeShirtTally(conf)
+
+
+def moveConferenceStats(old_key, conf):
+    """Recount the statistics of conf, moved from old_key, and delete the
+    counters, snapshot and leaderboard kept under the old websafe keys."""
+    reconcileConference(conf)
+    s_keys = Session.query(ancestor=conf.key).fetch(keys_only=True)
+    names = [sessionCounterName(old_key.urlsafe())] + [
+        wishlistCounterName(ndb.Key(Session, s_key.id(), parent=old_key).urlsafe())
+        for s_key in s_keys]
+    ndb.delete_multi([shardKey for name in names for shardKey in _shardKeys(name)]
+                     + [ndb.Key(ConferenceStats, old_key.urlsafe())])
+    memcache.delete_multi([COUNTER_MEMCACHE_PREFIX + name for name in names] +
+                          [LEADERBOARD_MEMCACHE_PREFIX + old_key.urlsafe()])
+
+
+def reconcileTeeShirtTally(conf):
+    """Recount a conference's TeeShirtTally from its Registrations.
+
+    The recount comes from an eventually consistent query, so it only
+    seeds a conference that has no tally yet. An existing tally is kept
+    exact by the registration transactions and is never overwritten;
+    drift from the recount is logged instead.
+    """
+    # registrations of a moved conference may still carry its former key
+    c_keys = [conf.key] + ([conf.formerKey] if conf.formerKey else [])
+    counts = {}
+    for registration in Registration.query(
+            Registration.conference.IN(c_keys)):
+        if registration.teeShirtSize:
+            counts[registration.teeShirtSize] = \
+                counts.get(registration.teeShirtSize, 0) + 1
+    tally = _seedTeeShirtTally(conf.key, counts)
+    found = dict((entry.size, entry.count) for entry in tally.counts
+                 if entry.count)
+    if found != counts:
+        logging.warning('TeeShirtTally of %s is %r; registrations say %r',
+                        conf.key.urlsafe(), found, counts)
+
+
+@ndb.transactional
+def _seedTeeShirtTally(conf_key, counts):
+    t_key = TeeShirtTally.keyFor(conf_key)
+    tally = t_key.get()
+    if tally is None:
+        tally = TeeShirtTally(key=t_key)
+        for size, count in counts.iteritems():
+            tally.adjust(size, count)
+        tally.put()
+    return tally
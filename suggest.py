@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""suggest.py
+
+Prefix autocomplete for conference topics, cities and session speakers.
+
+Write paths call recordTerms() with the values they add and remove. That
+adjusts a VocabularyTerm count per value and queues a coalesced rebuild
+of the field's Vocabulary snapshot: all its terms, sorted, with counts.
+The snapshot is copied to memcache, and each instance keeps it in memory
+as a _PrefixIndex, checking memcache for a newer version at most every
+LOCAL_TTL seconds. A warm suggest() therefore makes no RPCs.
+
+recountVocabulary() rebuilds the counts from the data itself, to fill
+them in the first time or to correct drift.
+
+"""
+
+import heapq
+import time
+from bisect import bisect_left
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Session
+from models import Vocabulary
+from models import VocabularyTerm
+
+SUGGEST_FIELDS = {
+    'topics': (Conference, 'topics'),
+    'city': (Conference, 'city'),
+    'speaker': (Session, 'speaker'),
+}
+MAX_SUGGESTIONS = 10
+SHORT_PREFIX = 2        # answers for prefixes up to this long are precomputed
+LOCAL_TTL = 60          # seconds an instance trusts its copy
+MEMCACHE_PREFIX = 'vocabulary:'
+VERSION_SUFFIX = ':version'
+REBUILD_TASK_URL = '/tasks/rebuild_vocabulary'
+REBUILD_DELAY = 30      # seconds; writes within this window share a rebuild
+RECOUNT_BATCH = 1000
+
+# field -> (recheckAt, version, _PrefixIndex), shared by the instance's threads
+_indexes = {}
+
+
+class _PrefixIndex(object):
+    """Sorted terms with their counts, searchable by prefix."""
+
+    def __init__(self, terms, counts):
+        self.terms = terms
+        self.keys = [term.lower() for term in terms]
+        self.counts = counts
+        # the top terms for every short prefix, most common first
+        top = {'': range(len(terms))}
+        for i, key in enumerate(self.keys):
+            for n in range(1, min(len(key), SHORT_PREFIX) + 1):
+                top.setdefault(key[:n], []).append(i)
+        self.top = dict((prefix, heapq.nlargest(MAX_SUGGESTIONS, indexes,
+                                                key=counts.__getitem__))
+                        for prefix, indexes in top.iteritems())
+
+    def suggest(self, prefix, limit):
+        prefix = prefix.lower()
+        if len(prefix) <= SHORT_PREFIX:
+            indexes = self.top.get(prefix, [])[:limit]
+        else:
+            lo = bisect_left(self.keys, prefix)
+            hi = bisect_left(self.keys, prefix + u'\uffff', lo)
+            indexes = heapq.nlargest(limit, xrange(lo, hi),
+                                     key=self.counts.__getitem__)
+        return [(self.terms[i], self.counts[i]) for i in indexes]
+
+
+def _load(field):
+    # the snapshot, from memcache or else from the datastore
+    data = memcache.get(MEMCACHE_PREFIX + field)
+    if data is None:
+        snapshot = Vocabulary.get_by_id(field)
+        data = (snapshot.updated, snapshot.terms, snapshot.counts) \
+            if snapshot else (None, [], [])
+        memcache.set_multi({MEMCACHE_PREFIX + field: data,
+                            MEMCACHE_PREFIX + field + VERSION_SUFFIX: data[0]})
+    return data
+
+
+def _index(field):
+    entry = _indexes.get(field)
+    now = time.time()
+    if entry and now < entry[0]:
+        return entry[2]
+    version = memcache.get(MEMCACHE_PREFIX + field + VERSION_SUFFIX)
+    if entry and version is not None and version == entry[1]:
+        index = entry[2]
+    else:
+        version, terms, counts = _load(field)
+        index = _PrefixIndex(terms, counts)
+    _indexes[field] = (now + LOCAL_TTL, version, index)
+    return index
+
+
+def suggest(field, prefix, limit=MAX_SUGGESTIONS):
+    """Return up to limit (term, count) pairs of field starting with
+    prefix, most common first. Raises KeyError for an unknown field."""
+    if field not in SUGGEST_FIELDS:
+        raise KeyError(field)
+    limit = max(1, min(limit or MAX_SUGGESTIONS, MAX_SUGGESTIONS))
+    return _index(field).suggest(prefix or '', limit)
+
+
+# - - - Maintenance - - - - - - - - - - - - - - - - - - - - - -
+
+def _termKey(field, term):
+    return ndb.Key(VocabularyTerm, u'%s|%s' % (field, term))
+
+
+# recordTerms() runs this once a transaction has committed, when ndb still
+# has the finished transaction as the current context
+@ndb.transactional(propagation=ndb.TransactionOptions.INDEPENDENT)
+def _adjustTerm(field, term, delta):
+    key = _termKey(field, term)
+    vt = key.get() or VocabularyTerm(key=key, field=field, term=term)
+    vt.count = max(0, vt.count + delta)
+    vt.put()
+
+
+def _record(field, deltas):
+    for term, delta in deltas.iteritems():
+        _adjustTerm(field, term, delta)
+    scheduleRebuild(field)
+
+
+def recordTerms(field, added=(), removed=()):
+    """Count the values a write added to and removed from field. Inside
+    a transaction this happens once it has committed."""
+    deltas = {}
+    for term in added:
+        if term:
+            deltas[term] = deltas.get(term, 0) + 1
+    for term in removed:
+        if term:
+            deltas[term] = deltas.get(term, 0) - 1
+    deltas = dict((term, delta) for term, delta in deltas.iteritems() if delta)
+    if deltas:
+        ndb.get_context().call_on_commit(lambda: _record(field, deltas))
+
+
+def scheduleRebuild(field):
+    """Queue a rebuild of field's snapshot; a burst of writes within
+    REBUILD_DELAY seconds is rebuilt once."""
+    bucket = int(time.time()) // REBUILD_DELAY
+    name = 'vocabulary-%s-%d' % (field, bucket)
+    try:
+        taskqueue.add(url=REBUILD_TASK_URL, name=name, countdown=REBUILD_DELAY,
+                      params={'field': field})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def rebuildVocabulary(field):
+    """Write field's snapshot from its VocabularyTerm counts; used by the
+    rebuild_vocabulary task."""
+    terms = [(vt.term, vt.count) for vt in
+             VocabularyTerm.query(VocabularyTerm.field == field) if vt.count > 0]
+    terms.sort(key=lambda pair: pair[0].lower())
+    snapshot = Vocabulary(id=field, terms=[term for term, count in terms],
+                          counts=[count for term, count in terms],
+                          updated=datetime.utcnow())
+    snapshot.put()
+    data = (snapshot.updated, snapshot.terms, snapshot.counts)
+    memcache.set_multi({MEMCACHE_PREFIX + field: data,
+                        MEMCACHE_PREFIX + field + VERSION_SUFFIX: data[0]})
+
+
+def recountVocabulary(field):
+    """Recount field from the conferences or sessions themselves, then
+    rebuild its snapshot."""
+    model, name = SUGGEST_FIELDS[field]
+    prop = getattr(model, name)
+    counts = {}
+    # a projection on a repeated property yields one result per value
+    q = model.query(projection=[prop])
+    cursor, more = None, True
+    while more:
+        page, cursor, more = q.fetch_page(RECOUNT_BATCH, start_cursor=cursor)
+        for entity in page:
+            value = getattr(entity, name)
+            for term in value if isinstance(value, list) else [value]:
+                if term:
+                    counts[term] = counts.get(term, 0) + 1
+        more = more and cursor
+
+    existing = VocabularyTerm.query(VocabularyTerm.field == field).fetch()
+    for vt in existing:
+        vt.count = counts.pop(vt.term, 0)
+    ndb.put_multi(existing + [VocabularyTerm(key=_termKey(field, term),
+        field=field, term=term, count=count)
+        for term, count in counts.iteritems()])
+    rebuildVocabulary(field)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""sync.py
+
+Delta sync for mobile clients. Conferences, Sessions, Profiles,
+UserWishlist entries and Registrations carry an auto_now `modified`
+timestamp, and deleting a Conference, Session or Registration leaves a
+Tombstone, so getChangesSince only has to read what changed after the
+client's sync token. Registration tombstones are children of the
+attendee's Profile and are only shown to that profile.
+
+A sync token is the time its sync started. `modified` queries are
+eventually consistent, so the next sync reads from SYNC_OVERLAP before
+it; clients apply changes idempotently, and seeing an entity twice is
+harmless. Tombstones are kept for TOMBSTONE_DAYS; a client with an older
+token is told to reset and gets a full sync.
+
+The kinds are read one after another (SYNC_PHASES); the page token holds
+the phase, the cursor within it and the time window of the sync.
+
+"""
+
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Registration
+from models import Session
+from models import Tombstone
+from models import UserWishlist
+
+SYNC_PAGE_SIZE = 100
+SYNC_OVERLAP = timedelta(seconds=60)
+TOMBSTONE_DAYS = 30
+PURGE_BATCH = 500
+SYNC_PHASES = ('Conference', 'Session', 'UserWishlist', 'Tombstone',
+               'Registration', 'RegistrationTombstone')
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _toToken(dt):
+    delta = dt - _EPOCH
+    return str((delta.days * 86400 + delta.seconds) * 1000000 +
+               delta.microseconds)
+
+
+def _fromToken(token):
+    try:
+        return _EPOCH + timedelta(microseconds=int(token))
+    except OverflowError:
+        raise ValueError('Invalid token: %s' % token)
+
+
+def tombstones(keys):
+    """Return Tombstones for the keys of deleted Conferences and Sessions.
+
+    Each is put in its entity's own group, so callers can write them in
+    the transaction that deletes the entities.
+    """
+    return [Tombstone(parent=key.root(), kind=key.kind(),
+                      websafeKey=key.urlsafe()) for key in keys]
+
+
+def registrationTombstone(r_key):
+    """Return the Tombstone for a deleted Registration. It names the
+    conference, and is put in the attendee's Profile entity group."""
+    return Tombstone(parent=r_key.parent(), kind='Registration',
+                     websafeKey=r_key.id())
+
+
+def purgeTombstones():
+    """Delete Tombstones older than TOMBSTONE_DAYS; used by a daily cron."""
+    cutoff = datetime.utcnow() - timedelta(days=TOMBSTONE_DAYS)
+    while True:
+        t_keys = Tombstone.query(Tombstone.deleted < cutoff).fetch(
+            PURGE_BATCH, keys_only=True)
+        ndb.delete_multi(t_keys)
+        if len(t_keys) < PURGE_BATCH:
+            return
+
+
+def _phaseQuery(phase, p_key, since, until):
+    if phase in ('Tombstone', 'RegistrationTombstone'):
+        # a full sync starts from nothing, so it has nothing to delete
+        if since is None:
+            return None
+        q = Tombstone.query(ancestor=p_key) \
+            if phase == 'RegistrationTombstone' else Tombstone.query()
+        return q.filter(Tombstone.deleted > since, Tombstone.deleted <= until) \
+            .order(Tombstone.deleted)
+
+    model = {'Conference': Conference, 'Session': Session,
+             'UserWishlist': UserWishlist, 'Registration': Registration}[phase]
+    q = model.query(ancestor=p_key) \
+        if model in (UserWishlist, Registration) else model.query()
+    if since is None:
+        return q
+    return q.filter(model.modified > since, model.modified <= until) \
+        .order(model.modified)
+
+
+def _shown(phase, entity):
+    # registration tombstones go to their own profile only, in their own
+    # phase; a Profile also parents tombstones of its old-layout conferences
+    if phase == 'Tombstone':
+        return entity.kind != 'Registration'
+    if phase == 'RegistrationTombstone':
+        return entity.kind == 'Registration'
+    return True
+
+
+def _pageToken(phase, since, until, cursor):
+    return ':'.join([str(phase), _toToken(since) if since else '',
+                     _toToken(until), cursor.urlsafe() if cursor else ''])
+
+
+def _parsePageToken(pageToken):
+    try:
+        phase, since, until, cursor = pageToken.split(':', 3)
+        phase = int(phase)
+        if not 0 <= phase < len(SYNC_PHASES):
+            raise ValueError(pageToken)
+        return (phase, _fromToken(since) if since else None,
+                _fromToken(until), ndb.Cursor(urlsafe=cursor) if cursor else None)
+    except Exception:
+        raise ValueError('Invalid pageToken: %s' % pageToken)
+
+
+def changesSince(prof, syncToken=None, pageToken=None):
+    """Return (entities, nextPageToken, syncToken, reset) for one page of
+    the changes visible to the Profile prof.
+
+    entities mixes Conferences, Sessions, prof itself (first page only),
+    its UserWishlist entries and Registrations, and Tombstones. nextPageToken is None on the
+    last page, which is the only one to carry the new syncToken. reset is
+    True when the client's data is too old for a delta and this is a full
+    sync instead. Raises ValueError for a malformed token.
+    """
+    reset = False
+    entities = []
+    if pageToken:
+        phase, since, until, cursor = _parsePageToken(pageToken)
+    else:
+        phase, cursor = 0, None
+        until = datetime.utcnow()
+        since = _fromToken(syncToken) - SYNC_OVERLAP if syncToken else None
+        if since and since < until - timedelta(days=TOMBSTONE_DAYS):
+            since, reset = None, True
+        if since is None or (prof.modified and prof.modified > since):
+            entities.append(prof)
+
+    while phase < len(SYNC_PHASES) and len(entities) < SYNC_PAGE_SIZE:
+        q = _phaseQuery(SYNC_PHASES[phase], prof.key, since, until)
+        more = False
+        if q is not None:
+            page, cursor, more = q.fetch_page(
+                SYNC_PAGE_SIZE - len(entities), start_cursor=cursor)
+            entities += [entity for entity in page
+                         if _shown(SYNC_PHASES[phase], entity)]
+        if not (more and cursor):
+            phase, cursor = phase + 1, None
+
+    if phase < len(SYNC_PHASES):
+        return entities, _pageToken(phase, since, until, cursor), None, reset
+    return entities, None, _toToken(until), reset
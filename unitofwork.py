@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""unitofwork.py
+
+Request-scoped unit of work. Write paths register changed ndb entities,
+deletions and tasks with current() instead of writing them one at a time;
+when the method decorated with @unitOfWork returns, everything is written
+with one put_multi_async/delete_multi_async and one batched task add.
+
+When the decorated method runs inside a transaction (put @unitOfWork
+below @ndb.transactional), the flush happens inside it too and the tasks
+are added transactionally. Each transaction attempt gets a fresh unit, so
+a retried attempt doesn't flush the changes of the one that failed. If
+the method raises, nothing is written.
+
+"""
+
+import functools
+import threading
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+_local = threading.local()
+
+
+class UnitOfWork(object):
+    """Pending entity writes, deletions and tasks."""
+
+    def __init__(self):
+        self._puts = []
+        self._deletes = []
+        self._tasks = []
+        self._callbacks = []
+
+    def put(self, entity):
+        """Write entity at flush; registering it again is harmless."""
+        if not any(pending is entity for pending in self._puts):
+            self._puts.append(entity)
+
+    def delete(self, key):
+        """Delete key at flush."""
+        if key not in self._deletes:
+            self._deletes.append(key)
+
+    def addTask(self, url, params=None, **kwargs):
+        """Add a push task to the default queue at flush."""
+        self._tasks.append(taskqueue.Task(url=url, params=params, **kwargs))
+
+    def afterFlush(self, callback, *args):
+        """Call callback(*args) once everything has been written."""
+        self._callbacks.append((callback, args))
+
+    def flush(self):
+        futures = []
+        if self._puts:
+            futures += ndb.put_multi_async(self._puts)
+        if self._deletes:
+            futures += ndb.delete_multi_async(self._deletes)
+        # the datastore RPCs run while the tasks are being added
+        if self._tasks:
+            taskqueue.Queue().add(self._tasks,
+                                  transactional=ndb.in_transaction())
+        for future in futures:
+            future.get_result()
+        for callback, args in self._callbacks:
+            callback(*args)
+        self._puts, self._deletes, self._tasks = [], [], []
+        self._callbacks = []
+
+
+def current():
+    """Return the innermost active unit of work, or None outside one."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def unitOfWork(func):
+    """Run func with a fresh unit of work and flush it when func returns."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = _local.__dict__.setdefault('stack', [])
+        stack.append(UnitOfWork())
+        try:
+            result = func(*args, **kwargs)
+            stack[-1].flush()
+            return result
+        finally:
+            stack.pop()
+    return wrapper